@@ -2,8 +2,8 @@
 import torch
 
 from foldflow.data import residue_constants
+from foldflow.utils.frames import Frames, rot_vec_mul
 from openfold.data import data_transforms
-from openfold.utils import feats
 from openfold.utils import rigid_utils as ru
 
 Rigid = ru.Rigid
@@ -146,17 +146,41 @@ def frames_to_atom14_pos(
 
 
 def compute_backbone(bb_rigids, psi_torsions):
-    torsion_angles = torch.tile(
-        psi_torsions[..., None, :],
-        tuple([1 for _ in range(len(bb_rigids.shape))]) + (7, 1),
-    ).to(bb_rigids.device)
-    aatype = torch.zeros(bb_rigids.shape).long()
-    # aatype = torch.zeros(bb_rigids.shape).long().to(bb_rigids.device)
-    all_frames = feats.torsion_angles_to_frames(
-        bb_rigids, torsion_angles, aatype, DEFAULT_FRAMES.to(bb_rigids.device)
-    )
-    atom14_pos = frames_to_atom14_pos(all_frames, aatype)
-    atom37_bb_pos = torch.zeros(bb_rigids.shape + (37, 3))
+    """Backbone atoms of alanine residues with the backbone frames `bb_rigids` and the psi torsions [..., N, 2].
+
+    The backbone frames are a `Rigid` or `Frames`. The atoms of an alanine are either in the backbone rigid group or,
+    for the oxygen, in the psi group, so only these two groups are computed instead of the 8 groups of
+    `torsion_angles_to_frames`. The outputs are on the device of the frames.
+    """
+    if isinstance(bb_rigids, Frames):
+        rot_mats, trans = bb_rigids.rot_mats, bb_rigids.trans
+    else:
+        rot_mats, trans = bb_rigids.get_rots().get_rot_mats(), bb_rigids.get_trans()
+    aatype = torch.zeros(trans.shape[:-1], dtype=torch.long, device=trans.device)
+    default_frames = DEFAULT_FRAMES[0].to(trans)  # [8, 4, 4]
+    lit_positions = IDEALIZED_POS[0].to(trans)  # [14, 3]
+
+    # Positions of the atoms of the backbone group in the backbone frame: [14, 3]
+    bb_group_pos = rot_vec_mul(default_frames[0, :3, :3], lit_positions) + default_frames[0, :3, 3]
+
+    # Positions of the atoms of the psi group in the backbone frame: [..., N, 14, 3]
+    # The psi group is rotated around its x axis, R_psi = R_default @ [[1, 0, 0], [0, cos, -sin], [0, sin, cos]].
+    psi_torsions = psi_torsions.to(trans)
+    sin, cos = psi_torsions[..., 0, None], psi_torsions[..., 1, None]
+    x, y, z = torch.unbind(lit_positions, dim=-1)
+    rot_y, rot_z = cos * y - sin * z, sin * y + cos * z
+    psi_rot = default_frames[3, :3, :3]
+    psi_group_pos = (
+        x[:, None] * psi_rot[:, 0] + rot_y[..., None] * psi_rot[:, 1] + rot_z[..., None] * psi_rot[:, 2]
+    ) + default_frames[3, :3, 3]
+
+    # [..., N, 14, 3]
+    in_psi_group = GROUP_IDX[0].to(trans.device)[:, None] == 3
+    local_pos = torch.where(in_psi_group, psi_group_pos, bb_group_pos)
+    atom14_pos = rot_vec_mul(rot_mats[..., None, :, :], local_pos) + trans[..., None, :]
+    atom14_pos = atom14_pos * ATOM_MASK[0].to(trans)[:, None]
+
+    atom37_bb_pos = atom14_pos.new_zeros(trans.shape[:-1] + (37, 3))
     # atom14 bb order = ['N', 'CA', 'C', 'O', 'CB']
     # atom37 bb order = ['N', 'CA', 'C', 'CB', 'O']
     atom37_bb_pos[..., :3, :] = atom14_pos[..., :3, :]
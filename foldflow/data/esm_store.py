@@ -0,0 +1,165 @@
+"""Memory-mapped store of precomputed ESM representations.
+
+The ESM language model is frozen, so the representations of the unmasked training sequences never change. The store
+keeps them in two flat float16 files (single and pair representations) next to a JSON index, which maps the hash of
+the ESM input of a chain to the offsets of its representations. Entries are read through `np.memmap`, so a lookup is
+a disk read and the store can be shared by all the data loader workers.
+"""
+
+import hashlib
+import json
+import os
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import torch
+
+ESM_STORE_VERSION = 1
+_INDEX_FILE = "index.json"
+_SINGLE_FILE = "single.bin"
+_PAIR_FILE = "pair.bin"
+_DTYPE = np.float16
+
+
+def esm_store_key(aatype, res_mask) -> str:
+    """Hash of the ESM input of a chain: its AF2 residue types, with the residues outside `res_mask` masked out.
+
+    `FrozenEsmModel` turns the residues outside of the attention mask into padding tokens, so two chains with the same
+    key have the same ESM tokens.
+    """
+    aatype = torch.as_tensor(aatype).long()
+    res_mask = torch.as_tensor(res_mask)
+    tokens = ((aatype + 1) * (res_mask == 1)).numpy().astype(np.int64)
+    return hashlib.sha1(tokens.tobytes()).hexdigest()
+
+
+class EsmEmbeddingStore:
+    """Read-only access to a store written by `EsmEmbeddingStoreWriter`.
+
+    The memory maps are opened lazily, so the store can be created before the data loader workers are forked.
+
+    Args:
+        path: directory of the store.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, _INDEX_FILE)) as f:
+            index = json.load(f)
+        if index["version"] != ESM_STORE_VERSION:
+            raise ValueError(f"ESM store {path} has version {index['version']}, expected {ESM_STORE_VERSION}.")
+        self.model_key: str = index["model_key"]
+        self.single_shape: Tuple[int, int] = tuple(index["single_shape"])  # [num_layers + 1, single_dim]
+        self.pair_dim: Optional[int] = index["pair_dim"]  # None if the attention maps were not stored.
+        self._entries: Dict[str, Dict[str, int]] = index["entries"]
+        self._single = None
+        self._pair = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    @property
+    def has_pair(self) -> bool:
+        return self.pair_dim is not None
+
+    def check_model_key(self, model_key: str):
+        """Raises if the store was built with another ESM model than `model_key`."""
+        if self.model_key != model_key:
+            raise ValueError(f"The ESM store {self.path} was built with {self.model_key}, the model uses {model_key}.")
+
+    def _open(self):
+        if self._single is None:
+            self._single = np.memmap(os.path.join(self.path, _SINGLE_FILE), dtype=_DTYPE, mode="r")
+            if self.has_pair:
+                self._pair = np.memmap(os.path.join(self.path, _PAIR_FILE), dtype=_DTYPE, mode="r")
+
+    def get(self, key: str) -> Optional[Tuple[torch.Tensor, Optional[torch.Tensor]]]:
+        """Returns the [N, num_layers + 1, single_dim] single and [N, N, pair_dim] pair representations, or None."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._open()
+        num_res = entry["length"]
+        single_numel = num_res * int(np.prod(self.single_shape))
+        single = self._single[entry["single_offset"] : entry["single_offset"] + single_numel]
+        single = torch.from_numpy(np.array(single).reshape(num_res, *self.single_shape))
+        pair = None
+        if self.has_pair:
+            pair_numel = num_res * num_res * self.pair_dim
+            pair = self._pair[entry["pair_offset"] : entry["pair_offset"] + pair_numel]
+            pair = torch.from_numpy(np.array(pair).reshape(num_res, num_res, self.pair_dim))
+        return single, pair
+
+
+class EsmEmbeddingStoreWriter:
+    """Appends ESM representations to a store, resuming an existing store at `path` if there is one.
+
+    Args:
+        path: directory of the store.
+        model_key: key of the ESM model in `ESM_REGISTRY`.
+        single_shape: [num_layers + 1, single_dim] shape of the single representation of a residue.
+        pair_dim: number of attention maps per residue pair, None to store only the single representations.
+    """
+
+    def __init__(self, path: str, model_key: str, single_shape: Tuple[int, int], pair_dim: Optional[int]):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.index = {
+            "version": ESM_STORE_VERSION,
+            "model_key": model_key,
+            "single_shape": list(single_shape),
+            "pair_dim": pair_dim,
+            "entries": {},
+        }
+        index_path = os.path.join(path, _INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+            for name in ("version", "model_key", "single_shape", "pair_dim"):
+                if index[name] != self.index[name]:
+                    raise ValueError(f"Can't resume the ESM store {path}, its {name} is {index[name]}.")
+            self.index = index
+            self._truncate_to_index()
+
+    def _file_numel(self, file_name: str) -> int:
+        entries = self.index["entries"].values()
+        if file_name == _SINGLE_FILE:
+            numel = int(np.prod(self.index["single_shape"]))
+            return max((entry["single_offset"] + entry["length"] * numel for entry in entries), default=0)
+        pair_dim = self.index["pair_dim"]
+        return max((entry["pair_offset"] + entry["length"] ** 2 * pair_dim for entry in entries), default=0)
+
+    def _truncate_to_index(self):
+        # Drops the representations written after the last flush of the index, e.g. by an interrupted run.
+        file_names = [_SINGLE_FILE] + ([_PAIR_FILE] if self.index["pair_dim"] is not None else [])
+        for file_name in file_names:
+            file_path = os.path.join(self.path, file_name)
+            if os.path.exists(file_path):
+                with open(file_path, "r+b") as f:
+                    f.truncate(self._file_numel(file_name) * np.dtype(_DTYPE).itemsize)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index["entries"]
+
+    def add(self, key: str, single: torch.Tensor, pair: Optional[torch.Tensor]):
+        """Appends the [N, num_layers + 1, single_dim] single and [N, N, pair_dim] pair representations of a chain."""
+        if key in self:
+            return
+        entry = {"length": single.shape[0]}
+        with open(os.path.join(self.path, _SINGLE_FILE), "ab") as f:
+            entry["single_offset"] = f.tell() // np.dtype(_DTYPE).itemsize
+            f.write(single.detach().cpu().numpy().astype(_DTYPE).tobytes())
+        if self.index["pair_dim"] is not None:
+            with open(os.path.join(self.path, _PAIR_FILE), "ab") as f:
+                entry["pair_offset"] = f.tell() // np.dtype(_DTYPE).itemsize
+                f.write(pair.detach().cpu().numpy().astype(_DTYPE).tobytes())
+        self.index["entries"][key] = entry
+
+    def flush(self):
+        tmp_path = os.path.join(self.path, f"{_INDEX_FILE}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, os.path.join(self.path, _INDEX_FILE))
@@ -24,6 +24,7 @@ from torch.utils import data
 from tqdm import tqdm
 
 from foldflow.data import utils as du
+from foldflow.data.esm_store import EsmEmbeddingStore, esm_store_key
 from foldflow.utils.rigid_helpers import assemble_rigid_mat, extract_trans_rots_mat
 from foldflow.utils.so3_helpers import so3_relative_angle
 from openfold.data import data_transforms
@@ -199,6 +200,10 @@ class PdbDataset(data.Dataset):
         self._store_result_tuples = None
         self._local_cache = None
 
+        # Precomputed ESM representations of the unmasked sequences.
+        esm_store_path = data_conf.get("esm_store_path", None)
+        self._esm_store = EsmEmbeddingStore(esm_store_path) if esm_store_path else None
+
         if self._cache_dataset:
             # self._build_dataset_cache()
             self._build_dataset_cache_v2()
@@ -237,6 +242,28 @@ class PdbDataset(data.Dataset):
     def data_conf(self):
         return self._data_conf
 
+    @property
+    def esm_store(self) -> Optional[EsmEmbeddingStore]:
+        return self._esm_store
+
+    def _add_esm_store_feats(self, chain_feats):
+        """Adds the stored ESM representations of the chain, or zeros if the chain is not in the store.
+
+        Every example gets the features, so that examples with and without stored representations can be batched.
+        """
+        num_res = chain_feats["aatype"].shape[0]
+        stored = self._esm_store.get(esm_store_key(chain_feats["aatype"], chain_feats["res_mask"]))
+        if stored is None:
+            single = torch.zeros((num_res, *self._esm_store.single_shape), dtype=torch.float16)
+            pair = torch.zeros((num_res, num_res, self._esm_store.pair_dim or 0), dtype=torch.float16)
+        else:
+            single, pair = stored
+            if pair is None:
+                pair = torch.zeros((num_res, num_res, 0), dtype=torch.float16)
+        chain_feats["esm_single_repns"] = single
+        chain_feats["esm_pair_repns"] = pair
+        chain_feats["esm_store_hit"] = float(stored is not None)
+
     def _init_metadata(self):
         """Initialize metadata."""
 
@@ -552,6 +579,8 @@ class PdbDataset(data.Dataset):
             )
         chain_feats.update(gen_feats_t)
         chain_feats["t"] = t
+        if self._esm_store is not None:
+            self._add_esm_store_feats(chain_feats)
 
         # Convert all features to tensors.
         final_feats = tree.map_structure(lambda x: x if torch.is_tensor(x) else torch.tensor(x), chain_feats)
@@ -28,9 +28,10 @@ UNPADDED_FEATS = [
     "trans_vectorfield_scaling",
     "t_seq",
     "t_struct",
+    "esm_store_hit",
 ]
 RIGID_FEATS = ["rigids_0", "rigids_t"]
-PAIR_FEATS = ["rel_rots"]
+PAIR_FEATS = ["rel_rots", "esm_pair_repns"]
 
 
 def read_pkl(read_path: str, verbose=True, use_torch=False, map_location=None):
@@ -274,10 +275,16 @@ def create_data_loader(
 
 
 def calc_distogram(pos, min_bin, max_bin, num_bins):
-    dists_2d = torch.linalg.norm(pos[:, :, None, :] - pos[:, None, :, :], axis=-1)[..., None]
-    lower = torch.linspace(min_bin, max_bin, num_bins, device=pos.device)
+    dists_2d = torch.linalg.norm(pos[:, :, None, :] - pos[:, None, :, :], axis=-1)
+    return dists_to_distogram(dists_2d, min_bin, max_bin, num_bins)
+
+
+def dists_to_distogram(dists, min_bin, max_bin, num_bins):
+    """One-hot distance bins of `calc_distogram` for any set of pair distances: [..., num_bins]."""
+    dists = dists[..., None]
+    lower = torch.linspace(min_bin, max_bin, num_bins, device=dists.device)
     upper = torch.cat([lower[1:], lower.new_tensor([1e8])], dim=-1)
-    dgram = ((dists_2d > lower) * (dists_2d < upper)).type(pos.dtype)
+    dgram = ((dists > lower) * (dists < upper)).type(dists.dtype)
     return dgram
 
 
@@ -1,7 +1,8 @@
 """Fork of Openfold's IPA."""
 
+import functools
 import math
-from typing import Callable, List, Optional, Sequence
+from typing import Callable, List, Optional, Sequence, Union
 
 import ipdb
 import numpy as np
@@ -19,6 +20,9 @@ from foldflow.data import utils as du
 from openfold.utils import rigid_utils as ru
 from openfold.utils.rigid_utils import Rigid
 
+from foldflow.utils import frames as fu
+from foldflow.utils.checkpointing import check_checkpointing_policy, maybe_checkpoint
+
 # from layers import CrossAttentionTransformerEncoderLayer
 
 
@@ -38,6 +42,46 @@ def ipa_point_weights_init_(weights):
         weights.fill_(softplus_inverse_1)
 
 
+def gather_neighbours(x: torch.Tensor, neighbour_idx: torch.Tensor) -> torch.Tensor:
+    """Features [B, N, K, ...] of the neighbours of every residue, from the residue features x [B, N, ...]."""
+    batch_idx = torch.arange(x.shape[0], device=x.device)[:, None, None]
+    return x[batch_idx, neighbour_idx]
+
+
+def pair_mask(node_mask: torch.Tensor, neighbour_idx: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """Mask of the residue pairs, [B, N, N] or [B, N, K] for the neighbours of the sparse IPA."""
+    if neighbour_idx is None:
+        return node_mask[..., None] * node_mask[..., None, :]
+    return node_mask[..., None] * gather_neighbours(node_mask, neighbour_idx)
+
+
+def sparse_neighbours(
+    pos: torch.Tensor,
+    mask: torch.Tensor,
+    num_neighbours: int,
+    seq_window: int,
+    seq_idx: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Neighbours [B, N, K] of every residue in the sparse IPA.
+
+    These are the residues at most `seq_window` apart in `seq_idx`, the residue itself included, completed by the
+    spatially nearest ones up to `num_neighbours`. The chain window is ranked by sequence separation, so the nearest
+    residues in the chain are kept if `num_neighbours < 2 * seq_window + 1`. Without `seq_idx`, the window is taken
+    over the positions in the array, which ignores chain breaks. Padded residues are only picked by the chains
+    shorter than `num_neighbours`.
+    """
+    num_res = pos.shape[-2]
+    dists = torch.cdist(pos.detach(), pos.detach())
+    if seq_idx is None:
+        seq_idx = torch.arange(num_res, device=pos.device)
+    seq_sep = (seq_idx[..., :, None] - seq_idx[..., None, :]).abs()
+    is_local = seq_sep <= seq_window
+    # Negative, below every spatial distance, and increasing with the sequence separation.
+    dists = torch.where(is_local, seq_sep.to(dists.dtype) - (seq_window + 1), dists)
+    dists = dists.masked_fill(~mask.bool()[..., None, :], float("inf"))
+    return torch.topk(dists, min(num_neighbours, num_res), dim=-1, largest=False).indices
+
+
 def _prod(nums):
     out = 1
     for n in nums:
@@ -229,20 +273,31 @@ class EdgeTransition(nn.Module):
         self.final_layer = Linear(hidden_size, edge_embed_out, init="final")
         self.layer_norm = nn.LayerNorm(edge_embed_out)
 
-    def forward(self, node_embed, edge_embed):
+    def forward(self, node_embed, edge_embed, neighbour_idx=None):
         node_embed = self.initial_embed(node_embed)
         batch_size, num_res, _ = node_embed.shape
-        edge_bias = torch.cat(
-            [
-                torch.tile(node_embed[:, :, None, :], (1, 1, num_res, 1)),
-                torch.tile(node_embed[:, None, :, :], (1, num_res, 1, 1)),
-            ],
-            axis=-1,
-        )
-        edge_embed = torch.cat([edge_embed, edge_bias], axis=-1).reshape(batch_size * num_res**2, -1)
+        if neighbour_idx is None:
+            edge_bias = torch.cat(
+                [
+                    torch.tile(node_embed[:, :, None, :], (1, 1, num_res, 1)),
+                    torch.tile(node_embed[:, None, :, :], (1, num_res, 1, 1)),
+                ],
+                axis=-1,
+            )
+        else:
+            # Sparse edges [B, N, K, C] between every residue and its neighbours.
+            edge_bias = torch.cat(
+                [
+                    node_embed[:, :, None, :].expand(-1, -1, neighbour_idx.shape[-1], -1),
+                    gather_neighbours(node_embed, neighbour_idx),
+                ],
+                axis=-1,
+            )
+        num_edges = edge_embed.shape[2]
+        edge_embed = torch.cat([edge_embed, edge_bias], axis=-1).reshape(batch_size * num_res * num_edges, -1)
         edge_embed = self.final_layer(self.trunk(edge_embed) + edge_embed)
         edge_embed = self.layer_norm(edge_embed)
-        edge_embed = edge_embed.reshape(batch_size, num_res, num_res, -1)
+        edge_embed = edge_embed.reshape(batch_size, num_res, num_edges, -1)
         return edge_embed
 
 
@@ -310,25 +365,279 @@ class InvariantPointAttention(nn.Module):
         self.softmax = nn.Softmax(dim=-1)
         self.softplus = nn.Softplus()
 
+        # Chunked attention over query blocks, and key blocks with an online softmax, see `_chunked_attention`.
+        # `chunk_bytes` sets the query block size from a memory budget if `chunk_size` is None.
+        self.chunk_size = getattr(ipa_conf, "chunk_size", None)
+        self.key_chunk_size = getattr(ipa_conf, "key_chunk_size", None)
+        self.chunk_bytes = getattr(ipa_conf, "chunk_bytes", None)
+        # "reference" attention of Algorithm 22, or "dot_product" which expands the point distances into the
+        # query/key dot product, see `_dot_product_attention`.
+        self.attn_impl = getattr(ipa_conf, "attn_impl", "reference")
+        if self.attn_impl not in ("reference", "dot_product"):
+            raise ValueError(f"Unknown IPA attention implementation: {self.attn_impl}")
+        if self.attn_impl == "dot_product" and (
+            self.chunk_size is not None or self.key_chunk_size is not None or self.chunk_bytes is not None
+        ):
+            raise ValueError("The dot_product IPA attention can't be chunked.")
+        # Sparse attention of every residue to `num_neighbours` neighbours, see `sparse_neighbours`.
+        self.num_neighbours = getattr(ipa_conf, "num_neighbours", None)
+        self.seq_window = getattr(ipa_conf, "seq_window", 8)
+        if self.num_neighbours is not None and (
+            self.attn_impl != "reference" or self.chunk_size is not None or self.chunk_bytes is not None
+        ):
+            raise ValueError("The sparse IPA attention can't be chunked nor use the dot_product attention.")
+        if self.num_neighbours is not None and self.num_neighbours < 2 * self.seq_window + 1:
+            raise ValueError(
+                f"The sparse IPA needs num_neighbours >= 2 * seq_window + 1 = {2 * self.seq_window + 1} to attend to "
+                f"its whole chain window, got {self.num_neighbours}."
+            )
+
+    def query_chunk_size(self, batch_numel: int, num_res: int) -> Optional[int]:
+        """Number of queries per block of the chunked attention, None to run the reference attention."""
+        if self.chunk_size is not None:
+            return self.chunk_size
+        if self.chunk_bytes is None:
+            if self.key_chunk_size is None:
+                return None
+            return num_res
+        num_keys = min(self.key_chunk_size or num_res, num_res)
+        # The largest activations per query/key pair: the point displacements, the logits and the weights of each head.
+        pair_bytes = 4 * self.no_heads * (3 * self.no_qk_points + 3)
+        return max(1, self.chunk_bytes // (batch_numel * num_keys * pair_bytes))
+
+    def _point_head_weights(self) -> torch.Tensor:
+        head_weights = self.softplus(self.head_weights)
+        return head_weights * math.sqrt(1.0 / (3 * (self.no_qk_points * 9.0 / 2)))
+
+    def _block_logits(self, q, k, q_pts, k_pts, b, q_mask, k_mask, head_weights) -> torch.Tensor:
+        """Attention logits of a block of queries and keys, as in `forward`: [*, H, N_q, N_k]."""
+        a = torch.matmul(permute_final_dims(q, (1, 0, 2)), permute_final_dims(k, (1, 2, 0)))
+        a = a * math.sqrt(1.0 / (3 * self.c_hidden))
+        a = a + math.sqrt(1.0 / 3) * permute_final_dims(b, (2, 0, 1))
+        # [*, N_q, N_k, H, P_q]
+        pt_att = torch.sum((q_pts.unsqueeze(-4) - k_pts.unsqueeze(-5)) ** 2, dim=-1)
+        pt_att = torch.sum(pt_att * head_weights[..., None], dim=-1) * (-0.5)
+        a = a + permute_final_dims(pt_att, (2, 0, 1))
+        square_mask = self.inf * (q_mask.unsqueeze(-1) * k_mask.unsqueeze(-2) - 1)
+        return a + square_mask.unsqueeze(-3)
+
+    def _chunked_attention(self, q, k, v, q_pts, k_pts, v_pts, b, pair_z, mask, query_chunk):
+        """Attention of `forward` over blocks of `query_chunk` queries, and over blocks of `key_chunk_size` keys with an
+        online softmax. Only the [*, N_q, N_k, H, P_q, 3] point displacements of a block are materialized, and the
+        point values are averaged with a matmul.
+
+        Returns the scalar [*, N, H, C_hidden], point [*, N, H, P_v, 3] (global frame) and pair [*, N, H, C_z // 4]
+        outputs.
+        """
+        num_res = q.shape[-3]
+        key_chunk = min(self.key_chunk_size or num_res, num_res)
+        head_weights = self._point_head_weights()
+        # [*, H, N, C_hidden] and [*, H, N, P_v * 3]
+        v = permute_final_dims(v, (1, 0, 2))
+        v_pts = permute_final_dims(flatten_final_dims(v_pts, 2), (1, 0, 2))
+
+        o_blocks, o_pt_blocks, o_pair_blocks = [], [], []
+        for q_start in range(0, num_res, query_chunk):
+            qs = slice(q_start, q_start + query_chunk)
+            max_logit = None
+            for k_start in range(0, num_res, key_chunk):
+                ks = slice(k_start, k_start + key_chunk)
+                logits = self._block_logits(
+                    q[..., qs, :, :],
+                    k[..., ks, :, :],
+                    q_pts[..., qs, :, :, :],
+                    k_pts[..., ks, :, :, :],
+                    b[..., qs, ks, :],
+                    mask[..., qs],
+                    mask[..., ks],
+                    head_weights,
+                )
+                block_max = logits.amax(dim=-1, keepdim=True)
+                if max_logit is None:
+                    new_max = block_max
+                else:
+                    new_max = torch.maximum(max_logit, block_max)
+                weights = torch.exp(logits - new_max)
+                o_block = torch.matmul(weights, v[..., ks, :].to(dtype=weights.dtype))
+                o_pt_block = torch.matmul(weights, v_pts[..., ks, :].to(dtype=weights.dtype))
+                o_pair_block = torch.matmul(weights.transpose(-2, -3), pair_z[..., qs, ks, :].to(dtype=weights.dtype))
+                if max_logit is None:
+                    denom = weights.sum(dim=-1, keepdim=True)
+                    o, o_pt, o_pair = o_block, o_pt_block, o_pair_block
+                else:
+                    rescale = torch.exp(max_logit - new_max)
+                    denom = denom * rescale + weights.sum(dim=-1, keepdim=True)
+                    o = o * rescale + o_block
+                    o_pt = o_pt * rescale + o_pt_block
+                    o_pair = o_pair * rescale.transpose(-2, -3) + o_pair_block
+                max_logit = new_max
+            o_blocks.append((o / denom).transpose(-2, -3))
+            o_pt_blocks.append((o_pt / denom).transpose(-2, -3))
+            o_pair_blocks.append(o_pair / denom.transpose(-2, -3))
+
+        o = torch.cat(o_blocks, dim=-3)
+        o_pt = torch.cat(o_pt_blocks, dim=-3)
+        o_pt = o_pt.view(o_pt.shape[:-1] + (self.no_v_points, 3))
+        o_pair = torch.cat(o_pair_blocks, dim=-3)
+        return o, o_pt, o_pair
+
+    def _dot_product_attention(self, q, k, v, q_pts, k_pts, v_pts, b, pair_z, mask):
+        """Attention of `forward` with the point term folded into the query/key dot product.
+
+        -0.5 * w_h * |q_pts - k_pts|² = w_h * q_pts·k_pts - 0.5 * w_h * |k_pts|² - 0.5 * w_h * |q_pts|². The last term
+        is the same for all the keys of a query, so it cancels in the softmax, the second one is a per-key bias added
+        to the pair bias and the mask. The logits are a single matmul of augmented queries and keys, without the
+        [*, N, N, H, P_q, 3] point displacements of the reference. The pair values depend on the query, so the
+        [*, H, N, N] attention weights are materialized once and average the scalar, point and pair values alike; a
+        fused `scaled_dot_product_attention` would have to recompute them.
+
+        Returns the scalar [*, N, H, C_hidden], point [*, N, H, P_v, 3] (global frame) and pair [*, N, H, C_z // 4]
+        outputs.
+        """
+        head_weights = self._point_head_weights()
+        # Augmented queries and keys: [*, H, N, C_hidden + P_q * 3]
+        # The points of both are scaled by sqrt(w_h), so that their dot product is w_h * q_pts·k_pts.
+        q_aug = torch.cat(
+            [
+                q * math.sqrt(1.0 / (3 * self.c_hidden)),
+                flatten_final_dims(q_pts, 2) * head_weights.sqrt()[..., None],
+            ],
+            dim=-1,
+        )
+        k_aug = torch.cat([k, flatten_final_dims(k_pts, 2) * head_weights.sqrt()[..., None]], dim=-1)
+        q_aug = permute_final_dims(q_aug, (1, 0, 2))
+        k_aug = permute_final_dims(k_aug, (1, 0, 2))
+
+        # Pair bias, per-key point bias and mask: [*, H, N_q, N_k]
+        k_pt_bias = -0.5 * torch.sum(k_pts**2, dim=(-1, -2)) * head_weights
+        a = torch.matmul(q_aug, k_aug.transpose(-1, -2))
+        a = a + math.sqrt(1.0 / 3) * permute_final_dims(b, (2, 0, 1))
+        a = a + permute_final_dims(k_pt_bias, (1, 0)).unsqueeze(-2)
+        a = a + (self.inf * (mask.unsqueeze(-1) * mask.unsqueeze(-2) - 1)).unsqueeze(-3)
+        a = self.softmax(a)
+
+        # Scalar and point values: [*, H, N, C_hidden + P_v * 3]
+        v_aug = torch.cat([v, flatten_final_dims(v_pts, 2)], dim=-1)
+        v_aug = permute_final_dims(v_aug, (1, 0, 2)).to(dtype=a.dtype)
+        o_aug = torch.matmul(a, v_aug)
+        o, o_pt = torch.split(o_aug.transpose(-2, -3), [self.c_hidden, self.no_v_points * 3], dim=-1)
+        o_pt = o_pt.reshape(o_pt.shape[:-1] + (self.no_v_points, 3))
+
+        o_pair = torch.matmul(a.transpose(-2, -3), pair_z.to(dtype=a.dtype))
+        return o, o_pt, o_pair
+
+    def _sparse_attention(self, q, k, v, q_pts, k_pts, v_pts, b, pair_z, mask, neighbour_idx):
+        """Attention of `forward` of every residue to its K neighbours, with the pair bias b [*, N, K, H] and the pair
+        values pair_z [*, N, K, C_z // 4] of the sparse edges.
+
+        Returns the scalar [*, N, H, C_hidden], point [*, N, H, P_v, 3] (global frame) and pair [*, N, H, C_z // 4]
+        outputs.
+        """
+        # Keys, values and their mask per neighbour: [*, N, K, H, ...]
+        k, v = gather_neighbours(k, neighbour_idx), gather_neighbours(v, neighbour_idx)
+        k_pts, v_pts = gather_neighbours(k_pts, neighbour_idx), gather_neighbours(v_pts, neighbour_idx)
+        square_mask = self.inf * (pair_mask(mask, neighbour_idx) - 1)
+
+        # [*, N, K, H]
+        a = torch.sum(q.unsqueeze(-3) * k, dim=-1) * math.sqrt(1.0 / (3 * self.c_hidden))
+        a = a + math.sqrt(1.0 / 3) * b
+        pt_att = torch.sum((q_pts.unsqueeze(-4) - k_pts) ** 2, dim=-1)
+        a = a + torch.sum(pt_att * self._point_head_weights()[..., None], dim=-1) * (-0.5)
+        a = torch.softmax(a + square_mask.unsqueeze(-1), dim=-2)
+
+        o = torch.sum(a[..., None] * v.to(dtype=a.dtype), dim=-3)
+        o_pt = torch.sum(a[..., None, None] * v_pts.to(dtype=a.dtype), dim=-4)
+        o_pair = torch.matmul(a.transpose(-1, -2), pair_z.to(dtype=a.dtype))
+        return o, o_pt, o_pair
+
+    def _attention(self, q, k, v, q_pts, k_pts, v_pts, b, z, mask, _offload_inference):
+        """Reference attention of Algorithm 22.
+
+        Returns the scalar [*, N, H * C_hidden], point [*, N, H, P_v, 3] (global frame) and pair [*, N, H, C_z // 4]
+        outputs.
+        """
+        # Compute attention weights of the scalar inputs Q and K per each head: [*, H, N_res, N_res]
+        a = torch.matmul(
+            permute_final_dims(q, (1, 0, 2)),  # [*, H, N_res, C_hidden]
+            permute_final_dims(k, (1, 2, 0)),  # [*, H, C_hidden, N_res]
+        )
+        a *= math.sqrt(1.0 / (3 * self.c_hidden))  # Normalize to keep variance close to 1
+        a += math.sqrt(1.0 / 3) * permute_final_dims(b, (2, 0, 1))  # Add normalized bias term
+
+        # Compute invariant point attention term. It is the norm of the transformed distance between residues:
+        # use broadcasting --> [*, N_res, N_res, H, P_q, 3]
+        pt_displacement = q_pts.unsqueeze(-4) - k_pts.unsqueeze(-5)
+        pt_att = pt_displacement**2
+
+        # Sum across all coordinates, apply learnable head weights and normalize to keep variance close to 1
+        # [*, N_res, N_res, H, P_q]
+        pt_att = sum(torch.unbind(pt_att, dim=-1))
+        head_weights = self.softplus(self.head_weights).view(*((1,) * len(pt_att.shape[:-2]) + (-1, 1)))
+        head_weights = head_weights * math.sqrt(1.0 / (3 * (self.no_qk_points * 9.0 / 2)))
+        pt_att = pt_att * head_weights
+
+        # Sum across all points: [*, N_res, N_res, H]
+        pt_att = torch.sum(pt_att, dim=-1) * (-0.5)
+        # Create mask to see what residues to mask: [*, N_res, N_res]
+        square_mask = mask.unsqueeze(-1) * mask.unsqueeze(-2)
+        square_mask = self.inf * (square_mask - 1)
+
+        # Reshape/spread across each head: [*, H, N_res, N_res]
+        pt_att = permute_final_dims(pt_att, (2, 0, 1))
+
+        # Add the point attention term to the scalar attention term: [*, H, N_res, N_res]
+        a = a + pt_att
+        a = a + square_mask.unsqueeze(-3)
+        a = self.softmax(a)
+
+        ################
+        # Compute output
+        ################
+        # Line 9 - compute weighted avg of the scalar values: [*, N_res, H, C_hidden]
+        o = torch.matmul(a, v.transpose(-2, -3).to(dtype=a.dtype)).transpose(-2, -3)
+
+        # Combine all heads: [*, N_res, H * C_hidden]
+        o = flatten_final_dims(o, 2)
+
+        # Line 10 - compute weighted avg of the point values: [*, H, 3, N_res, P_v]
+        o_pt = torch.sum(
+            (a[..., None, :, :, None] * permute_final_dims(v_pts, (1, 3, 0, 2))[..., None, :, :]),
+            dim=-2,
+        )
+
+        # [*, N_res, H, P_v, 3]
+        o_pt = permute_final_dims(o_pt, (2, 0, 3, 1))
+
+        if _offload_inference:
+            z[0] = z[0].to(o_pt.device)
+
+        # Line 8 - compute weighted avg of pair representations: [*, N_res, H, C_z // 4]
+        pair_z = self.down_z(z[0]).to(dtype=a.dtype)
+        o_pair = torch.matmul(a.transpose(-2, -3), pair_z)
+        return o, o_pt, o_pair
+
     def forward(
         self,
         s: torch.Tensor,
         z: Optional[torch.Tensor],
-        r: Rigid,
+        r: Union[Rigid, fu.Frames],
         mask: torch.Tensor,
         _offload_inference: bool = False,
         _z_reference_list: Optional[Sequence[torch.Tensor]] = None,
+        neighbour_idx: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
         """
         Args:
             s:
                 [*, N_res, C_s] single representation
             z:
-                [*, N_res, N_res, C_z] pair representation
+                [*, N_res, N_res, C_z] pair representation, or [*, N_res, K, C_z] with `neighbour_idx`
             r:
-                [*, N_res] transformation object
+                [*, N_res] transformation object, `Rigid` or `Frames`
             mask:
                 [*, N_res] mask
+            neighbour_idx:
+                [*, N_res, K] neighbours of every residue for the sparse attention, see `sparse_neighbours`
         Returns:
             [*, N_res, C_s] single representation update
         """
@@ -336,6 +645,8 @@ class InvariantPointAttention(nn.Module):
             z = _z_reference_list
         else:
             z = [z]
+        if isinstance(r, Rigid):
+            r = fu.frames_from_rigid(r)
 
         ##############################################################
         # Generate scalar and point activations, using node embeddings
@@ -361,7 +672,7 @@ class InvariantPointAttention(nn.Module):
         # It's apart of the line 7 in the algorithm (T * q_pts)
         q_pts = torch.split(q_pts, q_pts.shape[-1] // 3, dim=-1)
         q_pts = torch.stack(q_pts, dim=-1)
-        q_pts = r[..., None].apply(q_pts)
+        q_pts = fu.apply(r, q_pts)
 
         # Reshape/spread across each head: [*, N_res, H, P_q, 3]
         q_pts = q_pts.view(q_pts.shape[:-2] + (self.no_heads, self.no_qk_points, 3))
@@ -373,7 +684,7 @@ class InvariantPointAttention(nn.Module):
         # We apply rigids to V points but skip that step when computing the outputs --> all correct
         kv_pts = torch.split(kv_pts, kv_pts.shape[-1] // 3, dim=-1)
         kv_pts = torch.stack(kv_pts, dim=-1)
-        kv_pts = r[..., None].apply(kv_pts)
+        kv_pts = fu.apply(r, kv_pts)
 
         # Reshape/spread across each head: [*, N_res, H, (P_q + P_v), 3]
         kv_pts = kv_pts.view(kv_pts.shape[:-2] + (self.no_heads, -1, 3))
@@ -390,58 +701,28 @@ class InvariantPointAttention(nn.Module):
         if _offload_inference:
             z[0] = z[0].cpu()
 
-        # Compute attention weights of the scalar inputs Q and K per each head: [*, H, N_res, N_res]
-        a = torch.matmul(
-            permute_final_dims(q, (1, 0, 2)),  # [*, H, N_res, C_hidden]
-            permute_final_dims(k, (1, 2, 0)),  # [*, H, C_hidden, N_res]
-        )
-        a *= math.sqrt(1.0 / (3 * self.c_hidden))  # Normalize to keep variance close to 1
-        a += math.sqrt(1.0 / 3) * permute_final_dims(b, (2, 0, 1))  # Add normalized bias term
-
-        # Compute invariant point attention term. It is the norm of the transformed distance between residues:
-        # use broadcasting --> [*, N_res, N_res, H, P_q, 3]
-        pt_displacement = q_pts.unsqueeze(-4) - k_pts.unsqueeze(-5)
-        pt_att = pt_displacement**2
-
-        # Sum across all coordinates, apply learnable head weights and normalize to keep variance close to 1
-        # [*, N_res, N_res, H, P_q]
-        pt_att = sum(torch.unbind(pt_att, dim=-1))
-        head_weights = self.softplus(self.head_weights).view(*((1,) * len(pt_att.shape[:-2]) + (-1, 1)))
-        head_weights = head_weights * math.sqrt(1.0 / (3 * (self.no_qk_points * 9.0 / 2)))
-        pt_att = pt_att * head_weights
-
-        # Sum across all points: [*, N_res, N_res, H]
-        pt_att = torch.sum(pt_att, dim=-1) * (-0.5)
-        # Create mask to see what residues to mask: [*, N_res, N_res]
-        square_mask = mask.unsqueeze(-1) * mask.unsqueeze(-2)
-        square_mask = self.inf * (square_mask - 1)
-
-        # Reshape/spread across each head: [*, H, N_res, N_res]
-        pt_att = permute_final_dims(pt_att, (2, 0, 1))
-
-        # Add the point attention term to the scalar attention term: [*, H, N_res, N_res]
-        a = a + pt_att
-        a = a + square_mask.unsqueeze(-3)
-        a = self.softmax(a)
-
-        ################
-        # Compute output
-        ################
-        # Line 9 - compute weighted avg of the scalar values: [*, N_res, H, C_hidden]
-        o = torch.matmul(a, v.transpose(-2, -3).to(dtype=a.dtype)).transpose(-2, -3)
-
-        # Combine all heads: [*, N_res, H * C_hidden]
-        o = flatten_final_dims(o, 2)
-
-        # Line 10 - compute weighted avg of the point values: [*, H, 3, N_res, P_v]
-        o_pt = torch.sum(
-            (a[..., None, :, :, None] * permute_final_dims(v_pts, (1, 3, 0, 2))[..., None, :, :]),
-            dim=-2,
-        )
+        query_chunk = self.query_chunk_size(_prod(s.shape[:-2]), s.shape[-2])
+        if neighbour_idx is not None:
+            o, o_pt, o_pair = self._sparse_attention(
+                q, k, v, q_pts, k_pts, v_pts, b, self.down_z(z[0]), mask, neighbour_idx
+            )
+            o = flatten_final_dims(o, 2)
+        elif self.attn_impl == "dot_product":
+            if _offload_inference:
+                z[0] = z[0].to(q.device)
+            o, o_pt, o_pair = self._dot_product_attention(q, k, v, q_pts, k_pts, v_pts, b, self.down_z(z[0]), mask)
+            o = flatten_final_dims(o, 2)
+        elif query_chunk is not None:
+            if _offload_inference:
+                z[0] = z[0].to(q.device)
+            pair_z = self.down_z(z[0])
+            o, o_pt, o_pair = self._chunked_attention(q, k, v, q_pts, k_pts, v_pts, b, pair_z, mask, query_chunk)
+            o = flatten_final_dims(o, 2)
+        else:
+            o, o_pt, o_pair = self._attention(q, k, v, q_pts, k_pts, v_pts, b, z, mask, _offload_inference)
 
         # Apply inverse rigid: [*, N_res, H, P_v, 3]
-        o_pt = permute_final_dims(o_pt, (2, 0, 3, 1))
-        o_pt = r[..., None, None].invert_apply(o_pt)
+        o_pt = fu.invert_apply(r, o_pt)
 
         # Compute norms of point outputs and merge heads: [*, N_res, H * P_v]
         o_pt_dists = torch.sqrt(torch.sum(o_pt**2, dim=-1) + self.eps)
@@ -450,13 +731,6 @@ class InvariantPointAttention(nn.Module):
         # Merge heads of o_pt: [*, N_res, H * P_v, 3]
         o_pt = o_pt.reshape(*o_pt.shape[:-3], -1, 3)
 
-        if _offload_inference:
-            z[0] = z[0].to(o_pt.device)
-
-        # Line 8 - compute weighted avg of pair representations: [*, N_res, H, C_z // 4]
-        pair_z = self.down_z(z[0]).to(dtype=a.dtype)
-        o_pair = torch.matmul(a.transpose(-2, -3), pair_z)
-
         # Merge heads: [*, N_res, H * C_z // 4]
         o_pair = flatten_final_dims(o_pair, 2)
 
@@ -590,14 +864,19 @@ class IpaNetwork(nn.Module):
         self._ipa_conf = ipa_conf
         self.flow_matcher = flow_matcher
         self.update_edge_all = getattr(ipa_conf, "do_last_edge_update", False)
+        # Activation checkpointing of the blocks in training, see `foldflow.utils.checkpointing`.
+        self.checkpointing = check_checkpointing_policy(getattr(ipa_conf, "checkpointing", "none") or "none")
+        # Sparse IPA, where every residue attends to `num_neighbours` neighbours and edges are [B, N, K, C_z].
+        self.num_neighbours = getattr(ipa_conf, "num_neighbours", None)
+        self.seq_window = getattr(ipa_conf, "seq_window", 8)
 
         # self.context_embed_size = ipa_conf.context_embed_size
 
         self.scale_pos = lambda x: x * ipa_conf.coordinate_scaling
-        self.scale_rigids = lambda x: x.apply_trans_fn(self.scale_pos)
+        self.scale_rigids = lambda x: x._replace(trans=self.scale_pos(x.trans))
 
         self.unscale_pos = lambda x: x / ipa_conf.coordinate_scaling
-        self.unscale_rigids = lambda x: x.apply_trans_fn(self.unscale_pos)
+        self.unscale_rigids = lambda x: x._replace(trans=self.unscale_pos(x.trans))
         self.trunk = nn.ModuleDict()
 
         for b in range(ipa_conf.num_blocks):
@@ -632,56 +911,90 @@ class IpaNetwork(nn.Module):
 
         self.torsion_pred = TorsionAngles(ipa_conf.c_s, 1)
 
-    def forward(self, init_node_embed, edge_embed, input_feats, use_context=False, encoder_mode=False):
+    def neighbours(
+        self, rigids_t: torch.Tensor, res_mask: torch.Tensor, seq_idx: Optional[torch.Tensor] = None
+    ) -> Optional[torch.Tensor]:
+        """Neighbours [B, N, K] of the residues in the frames `rigids_t` for the sparse IPA, None if it is dense.
+
+        The embedder and `forward` must use the same neighbours.
+        """
+        if self.num_neighbours is None:
+            return None
+        return sparse_neighbours(rigids_t[..., 4:], res_mask, self.num_neighbours, self.seq_window, seq_idx)
+
+    def _block(
+        self, b, init_node_embed, node_embed, edge_embed, curr_frames, node_mask, flow_mask, edge_mask, neighbour_idx
+    ):
+        """Block `b` of the trunk: IPA, sequence transformer, backbone update and edge transition."""
+        selective = self.checkpointing == "selective"
+        ipa = functools.partial(self.trunk[f"ipa_{b}"], neighbour_idx=neighbour_idx)
+        ipa_embed = maybe_checkpoint(selective, ipa, node_embed, edge_embed, curr_frames, node_mask)
+        ipa_embed *= node_mask[..., None]
+        node_embed = self.trunk[f"ipa_ln_{b}"](node_embed + ipa_embed)
+        seq_tfmr_in = torch.cat([node_embed, self.trunk[f"skip_embed_{b}"](init_node_embed)], dim=-1)
+
+        # Use src_key_padding_mask to mask out the padded positions and ignore them in the attention calculation
+        # src_mask would ONLY restrict the attention weights computation
+        seq_tfmr_out = self.trunk[f"seq_tfmr_{b}"](seq_tfmr_in, src_key_padding_mask=1 - node_mask)
+        # Looks like it differs from FrameDiff paper implementation cause they wrote there
+        # that the skip connection should actually be init_node_embed
+        node_embed = node_embed + self.trunk[f"post_tfmr_{b}"](seq_tfmr_out)
+        node_embed = self.trunk[f"node_transition_{b}"](node_embed)
+        node_embed = node_embed * node_mask[..., None]
+        rigid_update = self.trunk[f"bb_update_{b}"](node_embed * flow_mask[..., None])
+        curr_frames = fu.compose_q_update_vec(curr_frames, rigid_update, flow_mask[..., None])
+
+        # Update the edge embeddings
+        if b < self._ipa_conf.num_blocks - 1 or self.update_edge_all:
+            edge_transition = functools.partial(self.trunk[f"edge_transition_{b}"], neighbour_idx=neighbour_idx)
+            edge_embed = maybe_checkpoint(selective, edge_transition, node_embed, edge_embed)
+            edge_embed *= edge_mask[..., None]
+        return node_embed, edge_embed, curr_frames
+
+    def forward(
+        self, init_node_embed, edge_embed, input_feats, use_context=False, encoder_mode=False, neighbour_idx=None
+    ):
         node_mask = input_feats["res_mask"].type(torch.float32)
         flow_mask = (1 - input_feats["fixed_mask"].type(torch.float32)) * node_mask
-        edge_mask = node_mask[..., None] * node_mask[..., None, :]
-        init_frames = input_feats["rigids_t"].type(torch.float32)
-        curr_rigids = Rigid.from_tensor_7(torch.clone(init_frames))  # get quats and trans
-        init_rigids = Rigid.from_tensor_7(init_frames)
+        edge_mask = pair_mask(node_mask, neighbour_idx)
+        # The frames are kept as `Frames` in the trunk, with their rotation matrices, see `foldflow.utils.frames`.
+        init_frames = fu.frames_from_tensor_7(input_feats["rigids_t"].type(torch.float32))
 
         # Main trunk
-        curr_rigids = self.scale_rigids(curr_rigids)
+        curr_frames = self.scale_rigids(init_frames)
         init_node_embed = init_node_embed * node_mask[..., None]
         node_embed = init_node_embed * node_mask[..., None]
         for b in range(self._ipa_conf.num_blocks):
-            ipa_embed = self.trunk[f"ipa_{b}"](s=node_embed, z=edge_embed, r=curr_rigids, mask=node_mask)
-            ipa_embed *= node_mask[..., None]
-            node_embed = self.trunk[f"ipa_ln_{b}"](node_embed + ipa_embed)
-            seq_tfmr_in = torch.cat([node_embed, self.trunk[f"skip_embed_{b}"](init_node_embed)], dim=-1)
-
-            # Use src_key_padding_mask to mask out the padded positions and ignore them in the attention calculation
-            # src_mask would ONLY restrict the attention weights computation
-            seq_tfmr_out = self.trunk[f"seq_tfmr_{b}"](seq_tfmr_in, src_key_padding_mask=1 - node_mask)
-            # Looks like it differs from FrameDiff paper implementation cause they wrote there
-            # that the skip connection should actually be init_node_embed
-            node_embed = node_embed + self.trunk[f"post_tfmr_{b}"](seq_tfmr_out)
-            node_embed = self.trunk[f"node_transition_{b}"](node_embed)
-            node_embed = node_embed * node_mask[..., None]
-            rigid_update = self.trunk[f"bb_update_{b}"](node_embed * flow_mask[..., None])
-            curr_rigids = curr_rigids.compose_q_update_vec(rigid_update, flow_mask[..., None])
-
-            # Update the edge embeddings
-            if b < self._ipa_conf.num_blocks - 1 or self.update_edge_all:
-                edge_embed = self.trunk[f"edge_transition_{b}"](node_embed, edge_embed)
-                edge_embed *= edge_mask[..., None]
+            node_embed, edge_embed, curr_frames = maybe_checkpoint(
+                self.checkpointing == "block",
+                functools.partial(self._block, b),
+                init_node_embed,
+                node_embed,
+                edge_embed,
+                curr_frames,
+                node_mask,
+                flow_mask,
+                edge_mask,
+                neighbour_idx,
+            )
 
         t = input_feats["t"].requires_grad_(True)
 
         # Compute the rotation vector field
         _, rot_vectorfield = self.flow_matcher.calc_rot_vectorfield(
-            rot_0=curr_rigids.get_rots().get_rot_mats(),
-            rot_t=init_rigids.get_rots().get_rot_mats(),
+            rot_0=curr_frames.rot_mats,
+            rot_t=init_frames.rot_mats,
             t=t,
         )
         rot_vectorfield = rot_vectorfield * node_mask[..., None, None]
 
         # Compute the torsion angles
-        curr_rigids = self.unscale_rigids(curr_rigids)
+        curr_frames = self.unscale_rigids(curr_frames)
         _, psi_pred = self.torsion_pred(node_embed)
         model_out = {
             "psi": psi_pred,
-            "final_rigids": curr_rigids,
+            "final_rigids": fu.frames_to_rigid(curr_frames),
+            "final_frames": curr_frames,
         }
         if encoder_mode:
             model_out["node_embed"] = node_embed
@@ -690,8 +1003,8 @@ class IpaNetwork(nn.Module):
 
         # Compute the translation vector field
         trans_vectorfield = self.flow_matcher.calc_trans_vectorfield(
-            curr_rigids.get_trans(),
-            init_rigids.get_trans(),
+            curr_frames.trans,
+            init_frames.trans,
             input_feats["t"][:, None, None],
             use_torch=True,
         )
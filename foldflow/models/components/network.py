@@ -13,6 +13,8 @@ from torch.nn import functional as F
 
 from foldflow.data import all_atom
 from foldflow.data import utils as du
+from foldflow.utils import frames as fu
+from foldflow.utils.step_cache import StepInvariantCache, get_or_compute
 
 
 def get_index_embedding(indices, embed_size, max_len=2056):
@@ -79,8 +81,12 @@ class Embedder(nn.Module):
             nn.LayerNorm(node_embed_size),
         )
 
+        # Sizes of the blocks of the edge features: time features of residues i and j, relative offsets, distogram.
+        self._edge_in_sizes = [t_embed_size + 1, t_embed_size + 1, index_embed_size]
         if self._embed_conf.embed_self_conditioning:
             edge_in += self._embed_conf.num_bins
+            self._edge_in_sizes.append(self._embed_conf.num_bins)
+        self._factorized_edge_embedder = getattr(self._embed_conf, "factorized_edge_embedder", False)
         edge_embed_size = self._model_conf.edge_embed_size
         self.edge_embedder = nn.Sequential(
             nn.Linear(edge_in, edge_embed_size),
@@ -93,6 +99,8 @@ class Embedder(nn.Module):
 
         self.timestep_embedder = fn.partial(get_timestep_embedding, embedding_dim=self._embed_conf.index_embed_size)
         self.index_embedder = fn.partial(get_index_embedding, embed_size=self._embed_conf.index_embed_size)
+        # `StepInvariantCache` of the sampling trajectory for the features that don't depend on t, set by the model.
+        self.step_cache = None
 
     def _cross_concat(self, feats_1d, num_batch, num_res):
         return (
@@ -114,6 +122,7 @@ class Embedder(nn.Module):
         t,
         fixed_mask,
         self_conditioning_ca,
+        neighbour_idx=None,
     ):
         """Embeds a set of inputs
 
@@ -123,10 +132,12 @@ class Embedder(nn.Module):
             fixed_mask: mask of fixed (motif) residues.
             self_conditioning_ca: [..., N, 3] Ca positions of self-conditioning
                 input.
+            neighbour_idx: [..., N, K] neighbours of each residue in the sparse IPA,
+                only the edges to them are embedded.
 
         Returns:
             node_embed: [B, N, D_node]
-            edge_embed: [B, N, N, D_edge]
+            edge_embed: [B, N, N, D_edge], or [B, N, K, D_edge] with neighbour_idx
         """
         num_batch, num_res = seq_idx.shape
         node_feats = []
@@ -136,15 +147,16 @@ class Embedder(nn.Module):
         prot_t_embed = torch.tile(self.timestep_embedder(t)[:, None, :], (1, num_res, 1))
         prot_t_embed = torch.cat([prot_t_embed, fixed_mask], dim=-1)
         node_feats = [prot_t_embed]
-        pair_feats = [self._cross_concat(prot_t_embed, num_batch, num_res)]
 
         # Positional index features.
-        node_feats.append(self.index_embedder(seq_idx))
+        node_feats.append(get_or_compute(self.step_cache, "embedder.index_embed", lambda: self.index_embedder(seq_idx)))
+        node_embed = self.node_embedder(torch.cat(node_feats, dim=-1).float())
+        if neighbour_idx is not None:
+            return node_embed, self._sparse_edge_embed(prot_t_embed, seq_idx, self_conditioning_ca, neighbour_idx)
         rel_seq_offset = seq_idx[:, :, None] - seq_idx[:, None, :]
-        rel_seq_offset = rel_seq_offset.reshape([num_batch, num_res**2])
-        pair_feats.append(self.index_embedder(rel_seq_offset))
 
         # Self-conditioning distogram.
+        sc_dgram = None
         if self._embed_conf.embed_self_conditioning:
             # Build a distogram of residue relative positions based on the predicted CA positions at the previous epoch
             # 22 bins are equally spaced in the range [min_bin=1e-5, max_bin=20A angström].
@@ -156,13 +168,68 @@ class Embedder(nn.Module):
                 self._embed_conf.max_bin,
                 self._embed_conf.num_bins,
             )
-            pair_feats.append(sc_dgram.reshape([num_batch, num_res**2, -1]))
 
-        node_embed = self.node_embedder(torch.cat(node_feats, dim=-1).float())
-        edge_embed = self.edge_embedder(torch.cat(pair_feats, dim=-1).float())
+        if self._factorized_edge_embedder:
+            edge_embed = self._factorized_edge_embed(prot_t_embed, rel_seq_offset, sc_dgram)
+        else:
+            pair_feats = [
+                self._cross_concat(prot_t_embed, num_batch, num_res),
+                get_or_compute(
+                    self.step_cache,
+                    "embedder.rel_offset_embed",
+                    lambda: self.index_embedder(rel_seq_offset.reshape([num_batch, num_res**2])),
+                ),
+            ]
+            if sc_dgram is not None:
+                pair_feats.append(sc_dgram.reshape([num_batch, num_res**2, -1]))
+            edge_embed = self.edge_embedder(torch.cat(pair_feats, dim=-1).float())
         edge_embed = edge_embed.reshape([num_batch, num_res, num_res, -1])
         return node_embed, edge_embed
 
+    def _sparse_edge_embed(self, prot_t_embed, seq_idx, self_conditioning_ca, neighbour_idx):
+        """`edge_embedder` of the edges between every residue and its neighbours only: [B, N, K, D_edge].
+
+        The neighbours change with the frames, so nothing is taken from the step cache.
+        """
+        num_neighbours = neighbour_idx.shape[-1]
+        pair_feats = [
+            prot_t_embed[:, :, None, :].expand(-1, -1, num_neighbours, -1),
+            ipa_pytorch.gather_neighbours(prot_t_embed, neighbour_idx),
+            self.index_embedder(seq_idx[:, :, None] - ipa_pytorch.gather_neighbours(seq_idx, neighbour_idx)),
+        ]
+        if self._embed_conf.embed_self_conditioning:
+            ca_neighbours = ipa_pytorch.gather_neighbours(self_conditioning_ca, neighbour_idx)
+            pair_feats.append(
+                du.dists_to_distogram(
+                    torch.linalg.norm(self_conditioning_ca[:, :, None, :] - ca_neighbours, axis=-1),
+                    self._embed_conf.min_bin,
+                    self._embed_conf.max_bin,
+                    self._embed_conf.num_bins,
+                )
+            )
+        return self.edge_embedder(torch.cat(pair_feats, dim=-1).float())
+
+    def _factorized_edge_embed(self, prot_t_embed, rel_seq_offset, sc_dgram):
+        """`edge_embedder` without building its [B, N^2, edge_in] input.
+
+        The first linear layer is split by the blocks of its input, so it reads the weights of the unfactorized layer.
+        The time features of residues i and j are projected per residue and broadcast, the relative offset embeddings
+        are projected per distinct offset and gathered.
+        """
+        first_linear = self.edge_embedder[0]
+        weights = torch.split(first_linear.weight, self._edge_in_sizes, dim=-1)
+        prot_t_embed = prot_t_embed.float()
+        edge_embed = (prot_t_embed @ weights[0].T)[:, :, None] + (prot_t_embed @ weights[1].T)[:, None, :]
+
+        def offset_embed():
+            offsets, offset_idx = torch.unique(rel_seq_offset, return_inverse=True)
+            return (self.index_embedder(offsets).float() @ weights[2].T)[offset_idx]
+
+        edge_embed = edge_embed + get_or_compute(self.step_cache, "embedder.rel_offset_proj", offset_embed)
+        if sc_dgram is not None:
+            edge_embed = edge_embed + sc_dgram.float() @ weights[3].T
+        return self.edge_embedder[1:](edge_embed + first_linear.bias)
+
 
 class VectorFieldNetwork(nn.Module):
     def __init__(self, model_conf, flow_matcher):
@@ -172,6 +239,30 @@ class VectorFieldNetwork(nn.Module):
         self.embedding_layer = Embedder(model_conf)
         self.flow_matcher = flow_matcher
         self.vectorfield = ipa_pytorch.IpaNetwork(model_conf, flow_matcher)
+        self._step_cache = StepInvariantCache() if model_conf.get("step_invariant_cache", True) else None
+        self.embedding_layer.step_cache = self._step_cache
+
+    @property
+    def step_cache(self):
+        return self._step_cache
+
+    def reset_step_cache(self):
+        """Drops the step-invariant features. Call it at the start of every new sampling trajectory."""
+        if self._step_cache is not None:
+            self._step_cache.reset()
+
+    def _check_step_cache(self, input_feats):
+        # The features are reused across the steps of a trajectory only, training always recomputes them.
+        if self._step_cache is None:
+            return
+        if self.training:
+            self._step_cache.reset()
+            return
+        self._step_cache.check(
+            seq_idx=input_feats["seq_idx"],
+            res_mask=input_feats["res_mask"],
+            fixed_mask=input_feats["fixed_mask"],
+        )
 
     def _apply_mask(self, aatype_diff, aatype_0, diff_mask):
         return diff_mask * aatype_diff + (1 - diff_mask) * aatype_0
@@ -191,8 +282,11 @@ class VectorFieldNetwork(nn.Module):
         # Frames as [batch, res, 7] tensors.
         bb_mask = input_feats["res_mask"].type(torch.float32)  # [B, N]
         fixed_mask = input_feats["fixed_mask"].type(torch.float32)
+        # Neighbours of every residue if the IPA is sparse, their edges are the only ones embedded.
+        neighbour_idx = self.vectorfield.neighbours(input_feats["rigids_t"], bb_mask, input_feats["seq_idx"])
         # Create edge mask to see which edges to construct. It uses torch broadcasting to get dim (B, N, N)
-        edge_mask = bb_mask[..., None] * bb_mask[..., None, :]
+        edge_mask = ipa_pytorch.pair_mask(bb_mask, neighbour_idx)
+        self._check_step_cache(input_feats)
 
         # Initial embeddings of positonal and relative indices.
         init_node_embed, init_edge_embed = self.embedding_layer(
@@ -200,12 +294,13 @@ class VectorFieldNetwork(nn.Module):
             t=input_feats["t"],
             fixed_mask=fixed_mask,
             self_conditioning_ca=input_feats["sc_ca_t"],
+            neighbour_idx=neighbour_idx,
         )
         edge_embed = init_edge_embed * edge_mask[..., None]
         node_embed = init_node_embed * bb_mask[..., None]
 
         # Run main network
-        model_out = self.vectorfield(node_embed, edge_embed, input_feats)
+        model_out = self.vectorfield(node_embed, edge_embed, input_feats, neighbour_idx=neighbour_idx)
 
         # Psi angle prediction (# angles = (pre_omega, phi, psi, chi1, chi2, chi3, chi4))
         gt_psi = input_feats["torsion_angles_sin_cos"][..., 2, :]
@@ -216,9 +311,9 @@ class VectorFieldNetwork(nn.Module):
             "rot_vectorfield": model_out["rot_vectorfield"],
             "trans_vectorfield": model_out["trans_vectorfield"],
         }
-        rigids_pred = model_out["final_rigids"]
-        pred_out["rigids"] = rigids_pred.to_tensor_7()
-        bb_representations = all_atom.compute_backbone(bb_rigids=rigids_pred, psi_torsions=psi_pred)
-        pred_out["atom37"] = bb_representations[0].to(rigids_pred.device)
-        pred_out["atom14"] = bb_representations[-1].to(rigids_pred.device)
+        frames_pred = model_out["final_frames"]
+        pred_out["rigids"] = fu.frames_to_tensor_7(frames_pred)
+        bb_representations = all_atom.compute_backbone(bb_rigids=frames_pred, psi_torsions=psi_pred)
+        pred_out["atom37"] = bb_representations[0]
+        pred_out["atom14"] = bb_representations[-1]
         return pred_out
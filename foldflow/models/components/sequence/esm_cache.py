@@ -0,0 +1,167 @@
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+import torch
+import tree
+
+
+def tensor_nbytes(structure) -> int:
+    return sum(x.numel() * x.element_size() for x in tree.flatten(structure) if isinstance(x, torch.Tensor))
+
+
+def map_tensors(fn, structure):
+    """`tree.map_structure` over the tensors of `structure`, leaving the other leaves, e.g. a missing pair output."""
+    return tree.map_structure(lambda x: fn(x) if isinstance(x, torch.Tensor) else x, structure)
+
+
+def hash_tokens(tokens: torch.Tensor, *extra: Hashable) -> str:
+    """Content hash of a token tensor, its shape and the `extra` fields, e.g. the model key and the dtype."""
+    digest = hashlib.sha1(repr((tuple(tokens.shape), str(tokens.dtype)) + extra).encode())
+    digest.update(tokens.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+class LRUTensorCache:
+    """Least-recently-used cache of tensor structures, bounded by the total size of the cached tensors.
+
+    The most recent entry is always kept, even if it alone exceeds `max_bytes`, so that the cache is never worse than
+    remembering the last call.
+
+    Args:
+        max_bytes: maximum total size of the cached tensors in bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[Any, int]]" = OrderedDict()
+        self.num_bytes = 0
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.num_misses += 1
+            return None
+        self.num_hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: str, value: Any):
+        if key in self._entries:
+            self.num_bytes -= self._entries.pop(key)[1]
+        nbytes = tensor_nbytes(value)
+        self._entries[key] = (value, nbytes)
+        self.num_bytes += nbytes
+        while self.num_bytes > self.max_bytes and len(self._entries) > 1:
+            _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+            self.num_bytes -= evicted_nbytes
+
+    def clear(self):
+        self._entries.clear()
+        self.num_bytes = 0
+
+    @property
+    def hit_rate(self) -> float:
+        num_calls = self.num_hits + self.num_misses
+        return self.num_hits / num_calls if num_calls > 0 else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "hits": self.num_hits,
+            "misses": self.num_misses,
+            "hit_rate": self.hit_rate,
+            "entries": len(self._entries),
+            "bytes": self.num_bytes,
+        }
+
+
+class AllMaskEsmTable:
+    """Per-length table of the ESM representations of fully masked sequences.
+
+    When every residue is masked, the ESM tokens of a chain are the same for all sequences of the same padded length,
+    so unconditional sampling needs one ESM call per length. The entries are computed lazily and, if `cache_dir` is
+    set, saved there and reloaded by the later runs. The entries kept on the device are bounded by `max_bytes`, so
+    that a sweep over many lengths does not hold all their [1, N, N, C] pair representations at once.
+
+    Args:
+        cache_dir: directory of the saved entries, None to keep them in memory only.
+        max_bytes: maximum total size of the entries kept on the device, the least recently used are evicted.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: int = 2**30):
+        self.cache_dir = cache_dir
+        self._entries = LRUTensorCache(max_bytes)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _entry_name(esm_model, num_res: int, device: torch.device, layer_weights, pair_projection) -> str:
+        backend = esm_model.prepare_backend(device)
+        attn = "pair" if esm_model.use_esm_attn_map else "single"
+        readout_key = esm_model.readout_key(layer_weights, pair_projection if esm_model.use_esm_attn_map else None)
+        readout = "" if readout_key is None else f"_readout{readout_key[:12]}"
+        return f"all_mask_{esm_model.model_key}_{backend}_{attn}{readout}_L{num_res}.pt"
+
+    def _load(self, name: str) -> Optional[Tuple[torch.Tensor, Optional[torch.Tensor]]]:
+        if self.cache_dir is None:
+            return None
+        path = os.path.join(self.cache_dir, name)
+        if not os.path.exists(path):
+            return None
+        return torch.load(path, map_location="cpu")
+
+    def _save(self, name: str, value: Tuple[torch.Tensor, Optional[torch.Tensor]]):
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = os.path.join(self.cache_dir, name)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save(map_tensors(lambda x: x.cpu(), value), tmp_path)
+        os.replace(tmp_path, path)
+
+    def get(
+        self,
+        esm_model,
+        batch_size: int,
+        num_res: int,
+        device: torch.device,
+        layer_weights: Optional[torch.Tensor] = None,
+        pair_projection: Optional[torch.nn.Module] = None,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Returns the single and pair representations of `batch_size` fully masked sequences of length `num_res`, as
+        computed by the `FrozenEsmModel` `esm_model` with the `layer_weights` and `pair_projection` readouts."""
+        name = self._entry_name(esm_model, num_res, device, layer_weights, pair_projection)
+        value = self._entries.get(name)
+        if value is None:
+            value = self._load(name)
+            if value is None:
+                tokens = torch.zeros(1, num_res, dtype=torch.long, device=device)
+                value = esm_model(
+                    tokens,
+                    tokens,
+                    attn_mask=torch.ones_like(tokens),
+                    seq_mask=torch.ones_like(tokens),
+                    cache_last_call=False,
+                    layer_weights=layer_weights,
+                    pair_projection=pair_projection,
+                )
+                self._save(name, value)
+            value = map_tensors(lambda x: x.to(device), value)
+            self._entries.put(name, value)
+        return map_tensors(lambda x: x.to(device).expand(batch_size, *x.shape[1:]), value)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        return self._entries.stats()
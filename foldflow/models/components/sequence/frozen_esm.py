@@ -1,13 +1,16 @@
+import contextlib
 import dataclasses
-from typing import Optional, Tuple
+from functools import partial
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import esm
 import torch
-import tree
 from esm.data import Alphabet
 from openfold.np import residue_constants
 from torch import nn
 
+from foldflow.models.components.sequence.esm_cache import LRUTensorCache, hash_tokens, map_tensors
+
 load_fn = esm.pretrained.load_model_and_alphabet
 ESM_REGISTRY = {
     "esm2_8M_270K": esm.pretrained.esm2_t6_8M_UR50D,
@@ -18,6 +21,101 @@ ESM_REGISTRY = {
 }
 
 SINGLE_REPNS_SEQ_LEN_SHAPE_IDX = 1
+DEFAULT_CACHE_MAX_BYTES = 2**30
+
+ESM_BACKENDS = ("auto", "fp32", "fp16", "bf16", "int8")
+# Dtype of the ESM weights for every backend, int8 quantizes a float32 copy of the linear layers.
+ESM_BACKEND_DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16, "int8": torch.float16}
+
+
+def resolve_esm_backend(backend: str, device) -> str:
+    """Backend to run ESM with on `device`.
+
+    "auto" is fp16 on GPUs, as ESM was always run, and fp32 on CPUs, where fp16 matmuls are slow or unsupported. The
+    int8 dynamic quantization of the linear layers is faster on CPUs but changes the representations, so it has to be
+    selected explicitly, after checking its error with `esm_backend_error`.
+    """
+    if backend not in ESM_BACKENDS:
+        raise ValueError(f"Unknown ESM backend {backend}, expected one of {ESM_BACKENDS}.")
+    device = torch.device(device)
+    if backend == "auto":
+        return "fp32" if device.type == "cpu" else "fp16"
+    if backend == "int8" and device.type != "cpu":
+        raise ValueError(f"The int8 ESM backend only runs on CPU, got device {device}.")
+    return backend
+
+
+def length_buckets(lengths: Sequence[int], min_fill: float) -> List[List[int]]:
+    """Groups the indices of `lengths`, longest first, so that every length of a group is at least `min_fill` times
+    the longest length of the group."""
+    buckets = []
+    for idx in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        if buckets and lengths[idx] >= min_fill * lengths[buckets[-1][0]]:
+            buckets[-1].append(idx)
+        else:
+            buckets.append([idx])
+    return buckets
+
+
+def weighted_layer_sum(single_repns: torch.Tensor, layer_weights: torch.Tensor) -> torch.Tensor:
+    """[B, N, num_layers + 1, C] representations of every ESM layer to their [B, N, C] weighted sum."""
+    return (layer_weights.unsqueeze(0) @ single_repns.to(layer_weights.dtype)).squeeze(-2)
+
+
+class StreamingPairProjection:
+    """`Linear(LayerNorm(x))` over channels that arrive in equal contiguous blocks, without concatenating them.
+
+    The Linear layer is applied block by block with the LayerNorm scale folded in, while the mean and variance of the
+    channels are merged across blocks with the parallel algorithm of Chan et al. The normalization is applied at the
+    end, as it is affine per position: `W((x - m) / s * g + b) = (Wg x - m Wg 1) / s + W b`.
+
+    Args:
+        layer_norm: LayerNorm over all the channels.
+        linear: Linear layer applied after the LayerNorm.
+        num_blocks: number of blocks the channels arrive in.
+    """
+
+    def __init__(self, layer_norm: nn.LayerNorm, linear: nn.Linear, num_blocks: int):
+        num_channels = linear.in_features
+        assert num_channels % num_blocks == 0, f"{num_channels} channels can't be split in {num_blocks} blocks."
+        weight = linear.weight.float()
+        bias = torch.zeros_like(weight[:, 0]) if linear.bias is None else linear.bias.float()
+        if layer_norm.weight is not None:
+            weight = weight * layer_norm.weight.float()
+        if layer_norm.bias is not None:
+            bias = bias + linear.weight.float() @ layer_norm.bias.float()
+        self.weight = weight  # [C_out, C_in]
+        self.weight_sum = weight.sum(-1)
+        self.bias = bias
+        self.eps = layer_norm.eps
+        self.num_blocks = num_blocks
+        self.block_size = num_channels // num_blocks
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.out = None
+
+    def add(self, block_idx: int, block: torch.Tensor):
+        """Adds the `block_idx`-th [..., block_size] block of channels."""
+        block = block.float()
+        block_weight = self.weight[:, block_idx * self.block_size : (block_idx + 1) * self.block_size]
+        block_out = block @ block_weight.T
+        block_mean = block.mean(-1)
+        block_m2 = (block - block_mean[..., None]).square().sum(-1)
+        if self.count == 0:
+            self.out, self.mean, self.m2 = block_out, block_mean, block_m2
+        else:
+            count = self.count + self.block_size
+            delta = block_mean - self.mean
+            self.mean += delta * (self.block_size / count)
+            self.m2 += block_m2 + delta.square() * (self.count * self.block_size / count)
+            self.out += block_out
+        self.count += self.block_size
+
+    def result(self) -> torch.Tensor:
+        assert self.count == self.num_blocks * self.block_size, f"Got {self.count} of the channels."
+        rstd = torch.rsqrt(self.m2 / self.count + self.eps)
+        return (self.out - self.mean[..., None] * self.weight_sum) * rstd[..., None] + self.bias
 
 
 @dataclasses.dataclass
@@ -35,14 +133,63 @@ class FrozenEsmModel(nn.Module):
         self,
         model_key: str,
         use_esm_attn_map: bool = True,
+        cache_max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+        backend: str = "auto",
+        length_bucket_min_fill: Optional[float] = None,
     ):
         super().__init__()
+        if backend not in ESM_BACKENDS:
+            raise ValueError(f"Unknown ESM backend {backend}, expected one of {ESM_BACKENDS}.")
+        self.model_key = model_key
+        self.backend = backend
+        # Backend `esm` is set up for, see `prepare_backend`.
+        self.active_backend: Optional[str] = None
         self.esm, self.esm_dict = ESM_REGISTRY[model_key]()
         self.register_buffer("af2_to_esm", FrozenEsmModel._af2_to_esm(self.esm_dict))
         self.use_esm_attn_map = use_esm_attn_map
         # num transformer layers + 1 for the last projection layer = num representation layers
         self._repr_layers = tuple(range(self.esm.num_layers + 1))
-        self._previous_call = None
+        # Outputs of the previous calls, keyed by the hash of the ESM tokens.
+        self.cache = LRUTensorCache(cache_max_bytes)
+        # Mixed-length batches are run in sub-batches of similar lengths, see `length_buckets`. None runs them whole.
+        self.length_bucket_min_fill = length_bucket_min_fill
+        # Quantized copy of `esm` for the int8 backend. Kept out of the registered submodules, so that the state dict
+        # always holds the original weights.
+        self.__dict__["_quantized_esm"] = None
+        # CPU copy of the fp32 weights of `esm`, kept once a backend rounds them so that fp32 and int8 can be rebuilt.
+        self.__dict__["_fp32_state_dict"] = None
+
+    def prepare_backend(self, device) -> str:
+        """Sets ESM up for the backend it runs with on `device`, and returns that backend."""
+        backend = resolve_esm_backend(self.backend, device)
+        if backend == self.active_backend:
+            return backend
+        if next(self.esm.parameters()).dtype != torch.float32:
+            # The weights were rounded by a previous backend, every backend is built from the fp32 ones.
+            self.esm.float().load_state_dict(self._fp32_state_dict)
+        elif backend != "fp32" and self._fp32_state_dict is None:
+            fp32_state_dict = {k: v.detach().to("cpu", copy=True) for k, v in self.esm.state_dict().items()}
+            self.__dict__["_fp32_state_dict"] = fp32_state_dict
+        quantized_esm = None
+        if backend == "int8":
+            quantized_esm = torch.ao.quantization.quantize_dynamic(self.esm, {nn.Linear}, dtype=torch.qint8)
+        self.esm.to(ESM_BACKEND_DTYPES[backend])
+        self.__dict__["_quantized_esm"] = quantized_esm
+        self.active_backend = backend
+        return backend
+
+    @property
+    def runtime_esm(self) -> nn.Module:
+        """The ESM module that is run, i.e. the quantized copy of `esm` with the int8 backend."""
+        return self._quantized_esm if self.active_backend == "int8" else self.esm
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # The weights are loaded in fp32, and the quantized copy is made again from them.
+        self.esm.float()
+        self.__dict__["_quantized_esm"] = None
+        self.__dict__["_fp32_state_dict"] = None
+        self.active_backend = None
+        super()._load_from_state_dict(*args, **kwargs)
 
     @property
     def repr_layers(self):
@@ -69,7 +216,12 @@ class FrozenEsmModel(nn.Module):
         seq_mask: Optional[torch.Tensor] = None,
         convert_to_esm: bool = True,
         cache_last_call: bool = True,
+        layer_weights: Optional[torch.Tensor] = None,
+        pair_projection: Optional[nn.Sequential] = None,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Returns the [B, N, num_layers + 1, C] single representations of every layer, or their [B, N, C] weighted
+        sum if the [num_layers + 1] `layer_weights` are given, and the [B, N, N, num_layers * heads] attention maps,
+        or their projection by the (LayerNorm, Linear) `pair_projection` if it is given."""
         # preprocesss
         if convert_to_esm:
             # TODO: need to mask sequence after adding linkers ?
@@ -78,37 +230,179 @@ class FrozenEsmModel(nn.Module):
         sequence_data = self._add_special_tokens(aa_sequence, chain_idx)
 
         # run
-        if (
-            cache_last_call
-            and self._previous_call is not None
-            and self._previous_call["inputs"].shape == sequence_data.aa_sequence.shape
-            and torch.all(self._previous_call["inputs"] == sequence_data.aa_sequence)
-        ):
-            return self._previous_call["outputs"]
-        res = self.esm(
-            sequence_data.aa_sequence,
-            repr_layers=self.repr_layers,
-            need_head_weights=self.use_esm_attn_map,
-        )
+        tokens = sequence_data.aa_sequence
+        backend = self.prepare_backend(tokens.device)
+        stream_pair = self.use_esm_attn_map and pair_projection is not None
+        if cache_last_call:
+            readout_key = self.readout_key(layer_weights, pair_projection if stream_pair else None)
+            cache_key = hash_tokens(tokens, self.model_key, backend, self.use_esm_attn_map, readout_key)
+            cached_outputs = self.cache.get(cache_key)
+            if cached_outputs is not None:
+                return cached_outputs
+        single_repns, pair_repns = self._run_length_buckets(tokens, layer_weights, pair_projection)
+
+        if cache_last_call:
+            self.cache.put(cache_key, map_tensors(lambda x: x.clone().detach(), (single_repns, pair_repns)))
+
+        # By default we return attn weights as pair representations.
+        return single_repns, pair_repns
+
+    def _run(
+        self, tokens: torch.Tensor, layer_weights: Optional[torch.Tensor], pair_projection: Optional[nn.Sequential]
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        stream_pair = self.use_esm_attn_map and pair_projection is not None
+        with contextlib.ExitStack() as stack:
+            if layer_weights is not None:
+                readout = stack.enter_context(self._layer_readout(layer_weights))
+            if stream_pair:
+                pair_readout = stack.enter_context(self._pair_readout(pair_projection, tokens))
+            res = self.runtime_esm(
+                tokens,
+                repr_layers=self.repr_layers if layer_weights is None else (),
+                need_head_weights=self.use_esm_attn_map and not stream_pair,
+            )
 
         # postprocess
-        single_repns = torch.stack([v for _, v in sorted(res["representations"].items())], dim=2)
+        if layer_weights is None:
+            single_repns = torch.stack([v for _, v in sorted(res["representations"].items())], dim=2)
+        else:
+            single_repns = readout["single"]
         # Get rid of the first and last tokens, which are the special tokens.
-        # B, residues, nLayers, C
+        # B, residues, (nLayers,) C
         single_repns = single_repns[:, 1:-1]
-        pair_repns = (
-            res["attentions"].permute(0, 4, 3, 1, 2).flatten(3, 4)[:, 1:-1, 1:-1, :] if self.use_esm_attn_map else None
-        )
+        if stream_pair:
+            # Already without the special tokens.
+            pair_repns = pair_readout.result()
+        elif self.use_esm_attn_map:
+            pair_repns = res["attentions"].permute(0, 4, 3, 1, 2).flatten(3, 4)[:, 1:-1, 1:-1, :]
+        else:
+            pair_repns = None
 
-        if cache_last_call:
-            self._previous_call = {
-                "inputs": sequence_data.aa_sequence.clone().detach(),
-                "outputs": tree.map_structure(lambda x: x.clone().detach(), (single_repns, pair_repns)),
-            }
+        return single_repns, pair_repns
 
-        # By default we return attn weights as pair representations.
+    def _run_length_buckets(
+        self, tokens: torch.Tensor, layer_weights: Optional[torch.Tensor], pair_projection: Optional[nn.Sequential]
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Runs ESM on sub-batches of sequences of similar lengths, each cropped to its longest sequence, and scatters
+        the representations back to the padded layout of `tokens`.
+
+        The padding tokens are not attended to, so cropping them does not change the representations of the other
+        tokens. The representations of the cropped positions are zeros, or the projection of zeros for the pair
+        representations with `pair_projection`, as ESM returns for the attention maps of padding tokens.
+        """
+        num_batch, num_tokens = tokens.shape
+        if self.length_bucket_min_fill is None or num_batch == 1:
+            return self._run(tokens, layer_weights, pair_projection)
+        # Up to the last token that is not padding, plus one column so that `[:, 1:-1]` keeps it.
+        not_padding = tokens != self.esm_dict.padding_idx
+        positions = torch.arange(1, num_tokens + 1, device=tokens.device)
+        token_lengths = ((positions * not_padding).amax(-1) + 1).clamp(max=num_tokens).tolist()
+        buckets = length_buckets(token_lengths, self.length_bucket_min_fill)
+        if len(buckets) == 1 and max(token_lengths) == num_tokens:
+            return self._run(tokens, layer_weights, pair_projection)
+
+        bucket_outputs = []
+        for rows in buckets:
+            bucket_tokens = tokens[rows, : max(token_lengths[row] for row in rows)]
+            bucket_outputs.append((rows, self._run(bucket_tokens, layer_weights, pair_projection)))
+
+        num_res = num_tokens - 2
+        single_ref, pair_ref = bucket_outputs[0][1]
+        single_repns = single_ref.new_zeros(num_batch, num_res, *single_ref.shape[2:])
+        pair_repns = None
+        if pair_ref is not None:
+            pair_repns = pair_ref.new_zeros(num_batch, num_res, num_res, pair_ref.shape[-1])
+            if pair_projection is not None:
+                layer_norm, linear = pair_projection
+                pair_repns[:] = linear(layer_norm(linear.weight.new_zeros(linear.in_features))).to(pair_repns)
+        for rows, (bucket_single, bucket_pair) in bucket_outputs:
+            rows = torch.as_tensor(rows, device=tokens.device)
+            bucket_res = bucket_single.shape[1]
+            single_repns[rows, :bucket_res] = bucket_single
+            if pair_repns is not None:
+                pair_repns[rows, :bucket_res, :bucket_res] = bucket_pair
         return single_repns, pair_repns
 
+    @contextlib.contextmanager
+    def _layer_readout(self, layer_weights: torch.Tensor):
+        """Accumulates the `layer_weights` weighted sum of the ESM hidden representations while they are computed, so
+        that the representations of all the layers are never held at once.
+
+        The hooks read the same tensors as `repr_layers`: the input of the first transformer layer, the outputs of the
+        next ones, and the output of the final layer norm instead of the output of the last layer.
+        """
+        readout: Dict[str, torch.Tensor] = {}
+        layer_weights = layer_weights.float()
+
+        def accumulate(layer_idx: int, x: torch.Tensor):
+            # ESM layers work on [T, B, C] tensors.
+            weighted = layer_weights[layer_idx] * x.transpose(0, 1).float()
+            if "single" in readout:
+                readout["single"].add_(weighted)
+            else:
+                readout["single"] = weighted
+
+        esm_model = self.runtime_esm
+        layers = esm_model.layers
+        handles = [layers[0].register_forward_pre_hook(lambda module, args: accumulate(0, args[0]))]
+        for layer_idx, layer in enumerate(layers[:-1], start=1):
+            handles.append(layer.register_forward_hook(partial(self._accumulate_output, accumulate, layer_idx)))
+        handles.append(
+            esm_model.emb_layer_norm_after.register_forward_hook(
+                partial(self._accumulate_output, accumulate, len(layers))
+            )
+        )
+        try:
+            yield readout
+        finally:
+            for handle in handles:
+                handle.remove()
+
+    @contextlib.contextmanager
+    def _pair_readout(self, pair_projection: nn.Sequential, tokens: torch.Tensor):
+        """Projects the attention maps of every ESM layer as soon as the layer has computed them."""
+        layer_norm, linear = pair_projection
+        readout = StreamingPairProjection(layer_norm, linear, num_blocks=self.num_layers)
+        # ESM zeroes the attention maps of the padding tokens once they are all stacked.
+        not_padding = (tokens != self.esm_dict.padding_idx).float()
+        pair_mask = (not_padding[:, :, None] * not_padding[:, None, :])[:, 1:-1, 1:-1, None]
+
+        def force_head_weights(module, args, kwargs):
+            return args, {**kwargs, "need_head_weights": True}
+
+        def project(layer_idx, module, args, output):
+            # [heads, B, T_query, T_key] to the [B, T_key, T_query, heads] layout of the stacked attention maps.
+            attn = output[1].permute(1, 3, 2, 0)[:, 1:-1, 1:-1]
+            readout.add(layer_idx, attn * pair_mask.to(attn.dtype))
+
+        handles = []
+        for layer_idx, layer in enumerate(self.runtime_esm.layers):
+            handles.append(layer.register_forward_pre_hook(force_head_weights, with_kwargs=True))
+            handles.append(layer.register_forward_hook(partial(project, layer_idx)))
+        try:
+            yield readout
+        finally:
+            for handle in handles:
+                handle.remove()
+
+    @staticmethod
+    def readout_key(
+        layer_weights: Optional[torch.Tensor], pair_projection: Optional[nn.Sequential]
+    ) -> Optional[str]:
+        """Hash of the readout arguments of `forward`, which change its outputs for the same tokens."""
+        tensors = [] if layer_weights is None else [layer_weights]
+        if pair_projection is not None:
+            tensors += list(pair_projection.parameters())
+        if not tensors:
+            return None
+        flat = torch.cat([x.detach().float().flatten().cpu() for x in tensors])
+        return hash_tokens(flat, layer_weights is None, pair_projection is None)
+
+    @staticmethod
+    def _accumulate_output(accumulate, layer_idx, module, args, output):
+        # Transformer layers return (x, attn), the final layer norm returns x.
+        accumulate(layer_idx, output[0] if isinstance(output, tuple) else output)
+
     @staticmethod
     def _af2_to_esm(d: Alphabet):
         # Remember that t is shifted from residue_constants by 1 (0 is padding).
@@ -147,3 +441,27 @@ class FrozenEsmModel(nn.Module):
         sequence_data.aa_sequence[range(batch_size), (sequence_data.aa_sequence != 1).sum(1)] = eosi
         # return aa_sequence
         return sequence_data
+
+
+@torch.no_grad()
+def esm_backend_error(
+    model: FrozenEsmModel, reference: FrozenEsmModel, aatype: torch.Tensor, attn_mask: Optional[torch.Tensor] = None
+) -> Dict[str, float]:
+    """Error of the ESM representations of `model` against those of `reference`, e.g. the fp32 backend.
+
+    Returns the relative Frobenius error of the single and pair representations, and the lowest cosine similarity
+    between the single representations of a residue in a layer.
+    """
+    chain_idx = torch.zeros_like(aatype)
+    attn_mask = torch.ones_like(aatype) if attn_mask is None else attn_mask
+    outputs = model(aatype, chain_idx, attn_mask=attn_mask, cache_last_call=False)
+    ref_outputs = reference(aatype, chain_idx, attn_mask=attn_mask, cache_last_call=False)
+    single, ref_single = outputs[0].float(), ref_outputs[0].float()
+    errors = {
+        "single_rel_error": ((single - ref_single).norm() / ref_single.norm()).item(),
+        "single_min_cos": nn.functional.cosine_similarity(single, ref_single, dim=-1)[attn_mask == 1].min().item(),
+    }
+    if outputs[1] is not None:
+        pair, ref_pair = outputs[1].float(), ref_outputs[1].float()
+        errors["pair_rel_error"] = ((pair - ref_pair).norm() / ref_pair.norm()).item()
+    return errors
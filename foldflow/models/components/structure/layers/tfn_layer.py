@@ -1,4 +1,7 @@
+from typing import Optional
+
 import torch
+from torch.utils.checkpoint import checkpoint
 from torch_scatter import scatter
 import e3nn
 
@@ -24,6 +27,8 @@ class TensorProductConvLayer(torch.nn.Module):
         aggr="add",
         batch_norm=False,
         gate=False,
+        edge_chunk_size: Optional[int] = None,
+        edge_chunk_bytes: Optional[int] = None,
     ):
         """
         Args:
@@ -35,6 +40,8 @@ class TensorProductConvLayer(torch.nn.Module):
             aggr: (str) Message passing aggregator
             batch_norm: (bool) Whether to apply equivariant batch norm
             gate: (bool) Whether to apply gated non-linearity
+            edge_chunk_size: (int) Number of edges processed at once, None processes all the edges at once
+            edge_chunk_bytes: (int) Memory budget of the per-edge tensors of a chunk, used if edge_chunk_size is None
         """
         super().__init__()
         self.in_irreps = in_irreps
@@ -42,6 +49,10 @@ class TensorProductConvLayer(torch.nn.Module):
         self.sh_irreps = sh_irreps
         self.edge_feats_dim = edge_feats_dim
         self.aggr = aggr
+        self.edge_chunk_size = edge_chunk_size
+        self.edge_chunk_bytes = edge_chunk_bytes
+        if (edge_chunk_size is not None or edge_chunk_bytes is not None) and aggr not in ("add", "sum", "mean"):
+            raise ValueError(f"Edge chunking supports only the add, sum and mean aggregations, got {aggr}.")
 
         if gate:
             # Optionally apply gated non-linearity
@@ -76,12 +87,50 @@ class TensorProductConvLayer(torch.nn.Module):
         # Optional equivariant batch norm
         self.batch_norm = e3nn.nn.BatchNorm(out_irreps) if batch_norm else None
 
+    def _messages(self, node_attr, src, edge_sh, edge_feat):
+        return self.tp(node_attr[src], edge_sh, weight=self.fc(edge_feat))
+
+    def edge_chunk_len(self, dtype=torch.float32) -> Optional[int]:
+        """Number of edges per chunk, None if the edges are not chunked."""
+        if self.edge_chunk_size is not None:
+            return self.edge_chunk_size
+        if self.edge_chunk_bytes is None:
+            return None
+        # Per-edge tensors: fc hidden and output, gathered node features, spherical harmonics and messages.
+        numel_per_edge = self.fc[0].out_features + self.tp.weight_numel
+        numel_per_edge += self.tp.irreps_in1.dim + self.tp.irreps_in2.dim + self.tp.irreps_out.dim
+        bytes_per_edge = numel_per_edge * torch.finfo(dtype).bits // 8
+        return max(1, self.edge_chunk_bytes // bytes_per_edge)
+
+    def _chunked_scatter(self, node_attr, edge_index, edge_sh, edge_feat, chunk_len):
+        src, dst = edge_index
+        num_nodes = node_attr.shape[0]
+        out = node_attr.new_zeros(num_nodes, self.tp.irreps_out.dim, dtype=torch.float32)
+        for start in range(0, src.shape[0], chunk_len):
+            end = start + chunk_len
+            args = (node_attr, src[start:end], edge_sh[start:end], edge_feat[start:end])
+            if torch.is_grad_enabled():
+                # Recompute the messages in the backward pass, otherwise autograd keeps the tensors of all chunks.
+                tp = checkpoint(self._messages, *args, use_reentrant=False)
+            else:
+                tp = self._messages(*args)
+            out = out.index_add(0, dst[start:end], tp.float())
+        if self.aggr == "mean":
+            count = torch.bincount(dst, minlength=num_nodes).clamp(min=1)
+            out = out / count[:, None].to(out.dtype)
+        return out
+
     def forward(self, node_attr, edge_index, edge_sh, edge_feat):
         src, dst = edge_index
-        # Compute messages
-        tp = self.tp(node_attr[src], edge_sh, weight=self.fc(edge_feat))
-        # Aggregate messages
-        out = scatter(src=tp, index=dst, dim=0, reduce=self.aggr)
+        chunk_len = self.edge_chunk_len(edge_feat.dtype)
+        if chunk_len is not None and chunk_len < src.shape[0]:
+            # Accumulate the messages chunk by chunk to bound the memory of the per-edge tensors.
+            out = self._chunked_scatter(node_attr, edge_index, edge_sh, edge_feat, chunk_len)
+        else:
+            # Compute messages
+            tp = self._messages(node_attr, src, edge_sh, edge_feat)
+            # Aggregate messages, in fp32 also under mixed precision
+            out = scatter(src=tp.float(), index=dst, dim=0, dim_size=node_attr.shape[0], reduce=self.aggr)
         # Optionally apply gated non-linearity and/or batch norm
         if self.gate:
             out = self.gate(out)
@@ -1,3 +1,6 @@
+import logging
+import os
+
 import torch
 
 from e3nn import o3, nn
@@ -6,7 +9,8 @@ from pydantic import ConfigDict
 
 from torch.nn import functional as F
 from torch_geometric.nn import global_add_pool, global_mean_pool
-from typing import Optional, Dict
+from torch_geometric.utils import to_dense_batch
+from typing import Optional, Dict, Tuple, Union
 
 from foldflow.models.components.structure.modules.irreps_tools import reshape_irreps
 from foldflow.models.components.structure.modules.blocks import (
@@ -15,6 +19,11 @@ from foldflow.models.components.structure.modules.blocks import (
 )
 from foldflow.models.components.structure.layers.tfn_layer import TensorProductConvLayer
 
+_log = logging.getLogger(__name__)
+
+AUTOCAST_DTYPES = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+ENCODER_OUTPUTS = ("flat", "padded", "nested")
+
 
 @dataclass(config=ConfigDict(arbitrary_types_allowed=True))
 class MACEConfig:
@@ -38,6 +47,15 @@ class MACEConfig:
     - equivariant_pred (bool): Whether it is an equivariant prediction task (default: False)
     - as_encoder (bool): Whether to use the model as an encoder (default: True)
     - encoder_dim (int): Dimension of the encoder output (default: 256)
+    - edge_chunk_size (Optional[int]): Number of edges per chunk in the message passing layers (default: None)
+    - edge_chunk_bytes (Optional[int]): Memory budget of the per-edge tensors of a chunk, used if
+      `edge_chunk_size` is None (default: None)
+    - encoder_output (str): Layout of the encoder output for a batch of graphs with different numbers of nodes:
+      "flat" returns the (n, d) node features, "padded" returns (batch_size, max_num_nodes, d) features with a
+      (batch_size, max_num_nodes) node mask, and "nested" returns a jagged nested tensor (default: "flat")
+    - precision (str): "fp32", "bf16" or "fp16". With bf16/fp16, the tensor products and linear layers run under
+      autocast, while the radial basis, spherical harmonics, message aggregation and batch norms stay in fp32
+      (default: "fp32")
 
     Note:
     - If `hidden_irreps` is None, the irreps for the intermediate features are computed
@@ -64,6 +82,10 @@ class MACEConfig:
     equivariant_pred: bool = True
     as_encoder: bool = True
     encoder_dim: int = 256
+    edge_chunk_size: Optional[int] = None
+    edge_chunk_bytes: Optional[int] = None
+    encoder_output: str = "flat"
+    precision: str = "fp32"
 
 
 class MACEModel(torch.nn.Module):
@@ -80,6 +102,12 @@ class MACEModel(torch.nn.Module):
         self.emb_dim = conf.emb_dim
         self.equivariant_pred = conf.equivariant_pred
         self.as_encoder = conf.as_encoder
+        if conf.precision not in AUTOCAST_DTYPES:
+            raise ValueError(f"Unknown MACE precision {conf.precision}, expected one of {list(AUTOCAST_DTYPES)}.")
+        self.autocast_dtype = AUTOCAST_DTYPES[conf.precision]
+        if conf.encoder_output not in ENCODER_OUTPUTS:
+            raise ValueError(f"Unknown MACE encoder output {conf.encoder_output}, expected one of {ENCODER_OUTPUTS}.")
+        self.encoder_output = conf.encoder_output
 
         # Edge embedding
         self.radial_embedding = RadialEmbeddingBlock(
@@ -114,6 +142,8 @@ class MACEModel(torch.nn.Module):
                 aggr=conf.aggr,
                 batch_norm=conf.batch_norm,
                 gate=False,
+                edge_chunk_size=conf.edge_chunk_size,
+                edge_chunk_bytes=conf.edge_chunk_bytes,
             )
         )
         self.reshapes.append(reshape_irreps(hidden_irreps))
@@ -140,6 +170,8 @@ class MACEModel(torch.nn.Module):
                     aggr=conf.aggr,
                     batch_norm=conf.batch_norm,
                     gate=False,
+                    edge_chunk_size=conf.edge_chunk_size,
+                    edge_chunk_bytes=conf.edge_chunk_bytes,
                 )
             )
             self.reshapes.append(reshape_irreps(hidden_irreps))
@@ -192,27 +224,88 @@ class MACEModel(torch.nn.Module):
         vectors = batch.pos[batch.edge_index[0]] - batch.pos[batch.edge_index[1]]  # [n_edges, 3]
         lengths = torch.linalg.norm(vectors, dim=-1, keepdim=True)  # [n_edges, 1]
 
+        # Always in fp32, the geometric features are the most sensitive to rounding.
         edge_sh = self.spherical_harmonics(vectors)
         edge_feats = self.radial_embedding(lengths)
 
-        for conv, reshape, prod in zip(self.convs, self.reshapes, self.prods):
-            # Message passing layer
-            h_update = conv(node_attr=h, edge_index=batch.edge_index, edge_sh=edge_sh, edge_feat=edge_feats)
+        with torch.autocast(
+            device_type=h.device.type, dtype=self.autocast_dtype, enabled=self.autocast_dtype is not None
+        ):
+            for conv, reshape, prod in zip(self.convs, self.reshapes, self.prods):
+                # Message passing layer
+                h_update = conv(node_attr=h, edge_index=batch.edge_index, edge_sh=edge_sh, edge_feat=edge_feats)
 
-            # Update node features
-            sc = F.pad(h, (0, h_update.shape[-1] - h.shape[-1]))  # skip connection
-            h = prod(node_feats=reshape(h_update), sc=sc, node_attrs=None)
+                # Update node features
+                sc = F.pad(h, (0, h_update.shape[-1] - h.shape[-1]))  # skip connection
+                h = prod(node_feats=reshape(h_update), sc=sc, node_attrs=None)
 
-        if self.as_encoder:
-            # If used as an encoder, apply the linear layer and batch normalization (if applicable)
-            for layer in self.encoder_head:
-                h = layer(h)
-            return h.view(batch.num_graphs, -1, h.shape[-1])  # (n, final_irreps.dim)
+            if self.as_encoder:
+                # If used as an encoder, apply the linear layer and batch normalization (if applicable)
+                for layer in self.encoder_head:
+                    h = layer(h.float())
+                return self._format_encoder_output(h.float(), batch)
 
-        out = self.pool(h, batch.batch)  # (n, d) -> (batch_size, d)
+        out = self.pool(h.float(), batch.batch)  # (n, d) -> (batch_size, d)
 
         if not self.equivariant_pred:
             # Select only scalars for invariant prediction
             out = out[:, : self.emb_dim]
 
         return self.pred(out)  # (batch_size, out_dim)
+
+    def _format_encoder_output(
+        self, h: torch.Tensor, batch
+    ) -> Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        if self.encoder_output == "flat":
+            # Use `graph_to_dense` with `batch.node_index` to restore the layout of the padded FF2 inputs.
+            return h  # (n, final_irreps.dim)
+        ptr = getattr(batch, "ptr", None)
+        if ptr is None:
+            # A single graph.
+            ptr = torch.tensor([0, h.shape[0]], device=h.device)
+        if self.encoder_output == "padded":
+            graph_idx = torch.repeat_interleave(torch.arange(ptr.shape[0] - 1, device=h.device), ptr.diff())
+            return to_dense_batch(h, graph_idx, batch_size=ptr.shape[0] - 1)  # (batch_size, max_n, d), mask
+        return torch.nested.nested_tensor_from_jagged(h, offsets=ptr)  # (batch_size, j, d)
+
+
+@torch.no_grad()
+def mace_equivariance_error(model: MACEModel, batch, num_rotations: int = 4) -> float:
+    """Relative change of the invariant MACE output under random rotations of the input positions.
+
+    It is zero up to rounding in fp32, use it to check the error introduced by the bf16/fp16 precision policies.
+    """
+    out = model(batch)
+    pos = batch.pos
+    errors = []
+    try:
+        for rot in o3.rand_matrix(num_rotations, dtype=pos.dtype, device=pos.device):
+            batch.pos = pos @ rot.T
+            errors.append((model(batch) - out).norm() / out.norm().clamp(min=1e-12))
+    finally:
+        batch.pos = pos
+    return torch.stack(errors).max().item()
+
+
+def compile_mace(model: MACEModel, cache_dir: Optional[str] = None, dynamic: bool = True) -> torch.nn.Module:
+    """Compiles a MACE model with torch.compile for inference.
+
+    The returned module shares the parameters of `model`. Compiled kernels are stored in the inductor cache, so only
+    the first process compiles the model from scratch and the following ones reuse the kernels.
+
+    Args:
+        model: MACE model to compile.
+        cache_dir: directory of the inductor cache, the inductor default is used if None. Inductor reads it from
+            the TORCHINDUCTOR_CACHE_DIR environment variable when the model is first run, so it is set for the whole
+            process, and only if the variable is unset: a cache directory chosen by the user is kept.
+        dynamic: whether to compile for dynamic numbers of nodes and edges, which avoids recompiling for every
+            protein length.
+    """
+    if cache_dir is not None:
+        env_cache_dir = os.environ.get("TORCHINDUCTOR_CACHE_DIR")
+        if env_cache_dir is None:
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+        elif os.path.abspath(env_cache_dir) != os.path.abspath(cache_dir):
+            _log.warning(f"The inductor cache stays in TORCHINDUCTOR_CACHE_DIR={env_cache_dir}, not in {cache_dir}.")
+    return torch.compile(model, dynamic=dynamic)
@@ -77,9 +77,10 @@ class EquivariantProductBasisBlock(torch.nn.Module):
         self, node_feats: torch.Tensor, sc: Optional[torch.Tensor], node_attrs: Optional[torch.Tensor]
     ) -> torch.Tensor:
         node_feats = self.symmetric_contractions(node_feats, node_attrs)
-        out = self.linear(node_feats)
+        # o3.Linear contracts with tensordot, which autocast does not cover, so it needs fp32 inputs.
+        out = self.linear(node_feats.float())
         if self.batch_norm:
-            out = self.batch_norm(out)
+            out = self.batch_norm(out.float())
         if self.use_sc:
             out = out + sc
         return out
@@ -5,8 +5,12 @@
 ###########################################################################################
 
 import collections
-from typing import List, Union
+import hashlib
+import logging
+import os
+from typing import Dict, List, Optional, Tuple, Union
 
+import e3nn
 import torch
 from e3nn import o3
 
@@ -129,3 +133,93 @@ def U_matrix_real(
             current_ir = ir
     out += [last_ir, stack]
     return out
+
+
+# Bump when the output of `U_matrix_real` changes, so that stale cache files are ignored.
+U_MATRIX_CACHE_VERSION = 1
+U_MATRIX_CACHE_DIR_ENV = "FOLDFLOW_U_MATRIX_CACHE_DIR"
+
+_log = logging.getLogger(__name__)
+_U_MATRIX_MEMO: Dict[Tuple, List] = {}
+
+
+def u_matrix_cache_dir() -> Optional[str]:
+    """Directory of the on-disk U-matrix cache, None if the disk cache is disabled.
+
+    Set the `FOLDFLOW_U_MATRIX_CACHE_DIR` environment variable to change the location, or to an empty string to
+    keep the cache in memory only.
+    """
+    default = os.path.join(os.path.expanduser("~"), ".cache", "foldflow", "u_matrix")
+    cache_dir = os.environ.get(U_MATRIX_CACHE_DIR_ENV, default)
+    return cache_dir or None
+
+
+def _u_matrix_key(irreps_in, irreps_out, correlation, normalization, filter_ir_mid, dtype) -> Tuple:
+    if filter_ir_mid is not None:
+        filter_ir_mid = tuple(str(o3.Irrep(ir)) for ir in filter_ir_mid)
+    dtype = dtype if dtype is not None else torch.get_default_dtype()
+    return (str(o3.Irreps(irreps_in)), str(o3.Irreps(irreps_out)), correlation, normalization, filter_ir_mid, str(dtype))
+
+
+def _u_matrix_cache_path(cache_dir: str, key: Tuple) -> str:
+    versioned_key = (U_MATRIX_CACHE_VERSION, e3nn.__version__) + key
+    digest = hashlib.sha1(repr(versioned_key).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"v{U_MATRIX_CACHE_VERSION}_{digest}.pt")
+
+
+def _load_u_matrix(path: str, key: Tuple) -> Optional[List]:
+    try:
+        payload = torch.load(path, map_location="cpu", weights_only=True)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        _log.warning(f"Ignoring the corrupted U-matrix cache file {path}: {e}")
+        return None
+    if payload.get("version") != U_MATRIX_CACHE_VERSION or tuple(payload.get("key", ())) != key:
+        return None
+    out = []
+    for ir, tensor in zip(payload["irreps"], payload["tensors"]):
+        out += [o3.Irrep(ir), tensor]
+    return out
+
+
+def _save_u_matrix(path: str, key: Tuple, u_matrix: List):
+    payload = {
+        "version": U_MATRIX_CACHE_VERSION,
+        "key": list(key),
+        "irreps": [str(ir) for ir in u_matrix[::2]],
+        "tensors": list(u_matrix[1::2]),
+    }
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save(payload, tmp_path)
+        os.replace(tmp_path, path)  # Atomic, concurrent jobs never read a partially written file.
+    except OSError as e:
+        _log.warning(f"Could not write the U-matrix cache file {path}: {e}")
+
+
+def cached_U_matrix_real(
+    irreps_in: Union[str, o3.Irreps],
+    irreps_out: Union[str, o3.Irreps],
+    correlation: int,
+    normalization: str = "component",
+    filter_ir_mid=None,
+    dtype=None,
+):
+    """`U_matrix_real` memoized in-process and persisted in `u_matrix_cache_dir()`.
+
+    Returns copies of the cached tensors, so callers may register them as buffers and modify them in place.
+    """
+    key = _u_matrix_key(irreps_in, irreps_out, correlation, normalization, filter_ir_mid, dtype)
+    u_matrix = _U_MATRIX_MEMO.get(key)
+    if u_matrix is None:
+        cache_dir = u_matrix_cache_dir()
+        path = _u_matrix_cache_path(cache_dir, key) if cache_dir is not None else None
+        u_matrix = _load_u_matrix(path, key) if path is not None else None
+        if u_matrix is None:
+            u_matrix = U_matrix_real(irreps_in, irreps_out, correlation, normalization, filter_ir_mid, dtype)
+            if path is not None:
+                _save_u_matrix(path, key, u_matrix)
+        _U_MATRIX_MEMO[key] = u_matrix
+    return [x.clone() if isinstance(x, torch.Tensor) else x for x in u_matrix]
@@ -62,13 +62,14 @@ class reshape_irreps(torch.nn.Module):
     def __init__(self, irreps: o3.Irreps) -> None:
         super().__init__()
         self.irreps = irreps
+        # Plain ints, so that the loop below is unrolled by TorchScript and torch.compile.
+        self.dims: List[Tuple[int, int]] = [(mul, ir.dim) for mul, ir in irreps]
 
     def forward(self, tensor: torch.Tensor) -> torch.Tensor:
         ix = 0
         out = []
         batch, _ = tensor.shape
-        for mul, ir in self.irreps:
-            d = ir.dim
+        for mul, d in self.dims:
             field = tensor[:, ix : ix + mul * d]  # [batch, sample, mul * repr]
             ix += mul * d
             field = field.reshape(batch, mul, d)
@@ -11,9 +11,8 @@ import torch
 from e3nn import o3
 from e3nn.util.codegen import CodeGenMixin
 from e3nn.util.jit import compile_mode
-from opt_einsum import contract
 
-from .cg import U_matrix_real
+from .cg import cached_U_matrix_real
 
 
 @compile_mode("script")
@@ -76,11 +75,13 @@ class SymmetricContraction(CodeGenMixin, torch.nn.Module):
                 num_elements=num_elements,
                 weights=self.shared_weights,
             )
+        # Plain strings, so that the forward pass does not iterate over Irreps objects.
+        self.contraction_keys = [str(irrep_out) for irrep_out in self.irreps_out]
 
     def forward(self, x: torch.Tensor, y: Optional[torch.Tensor]):
         outs = []
-        for irrep in self.irreps_out:
-            outs.append(self.contractions[str(irrep)](x, y))
+        for key in self.contraction_keys:
+            outs.append(self.contractions[key](x, y))
         return torch.cat(outs, dim=-1)
 
 
@@ -103,7 +104,7 @@ class Contraction(torch.nn.Module):
         self.correlation = correlation
         dtype = torch.get_default_dtype()
         for nu in range(1, correlation + 1):
-            U_matrix = U_matrix_real(
+            U_matrix = cached_U_matrix_real(
                 irreps_in=self.coupling_irreps,
                 irreps_out=irrep_out,
                 correlation=nu,
@@ -143,7 +144,7 @@ class Contraction(torch.nn.Module):
 
     def forward(self, x: torch.Tensor, y: Optional[torch.Tensor]):
         if self.element_dependent:
-            out = contract(
+            out = torch.einsum(
                 self.equation_main,
                 self.U_tensors(self.correlation),
                 self.weights[str(self.correlation)],
@@ -151,32 +152,31 @@ class Contraction(torch.nn.Module):
                 y,
             )  # TODO: use optimize library and cuTENSOR  # pylint: disable=fixme
             for corr in range(self.correlation - 1, 0, -1):
-                c_tensor = contract(
+                c_tensor = torch.einsum(
                     self.equation_weighting,
                     self.U_tensors(corr),
                     self.weights[str(corr)],
                     y,
                 )
                 c_tensor = c_tensor + out
-                out = contract(self.equation_contract, c_tensor, x)
+                out = torch.einsum(self.equation_contract, c_tensor, x)
 
         else:
-            out = contract(
+            out = torch.einsum(
                 self.equation_main,
                 self.U_tensors(self.correlation),
                 self.weights[str(self.correlation)],
                 x,
             )  # TODO: use optimize library and cuTENSOR  # pylint: disable=fixme
             for corr in range(self.correlation - 1, 0, -1):
-                c_tensor = contract(
+                c_tensor = torch.einsum(
                     self.equation_weighting,
                     self.U_tensors(corr),
                     self.weights[str(corr)],
                 )
                 c_tensor = c_tensor + out
-                out = contract(self.equation_contract, c_tensor, x)
-        resize_shape = torch.prod(torch.tensor(out.shape[1:]))
-        return out.view(out.shape[0], resize_shape)
+                out = torch.einsum(self.equation_contract, c_tensor, x)
+        return out.reshape(out.shape[0], -1)
 
     def U_tensors(self, nu):
         return self._buffers[f"U_matrix_{nu}"]
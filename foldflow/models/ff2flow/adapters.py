@@ -1,9 +1,12 @@
-from typing import Dict, Tuple
+from typing import Dict, Optional, Tuple
 
 import torch
 from esm.esmfold.v1.trunk import RelativePosition
 from torch import nn
 
+from foldflow.models.components.sequence.frozen_esm import weighted_layer_sum
+from foldflow.utils.step_cache import get_or_compute
+
 IMPLEMENTED_REPRESENTATION = ["bb", "seq", "bb_mace"]
 
 
@@ -104,19 +107,47 @@ class SequenceToTrunkNetwork(nn.Module):
         self.esm_single_combine = nn.Parameter(torch.zeros(num_layers + 1))
 
         self.pairwise_positional_embedding = RelativePosition(position_bins, pairwise_state_dim)
+        # `StepInvariantCache` of the sampling trajectory for the features that don't depend on t, set by the model.
+        self.step_cache = None
+
+    def esm_layer_weights(self) -> Optional[torch.Tensor]:
+        """Weights of the ESM layers for `FrozenEsmModel`, which can then sum the layers as it computes them.
+
+        None when the weights are trained, as their gradient needs the representations of every layer.
+        """
+        if torch.is_grad_enabled() and self.esm_single_combine.requires_grad:
+            return None
+        return self.esm_single_combine.detach().softmax(0)
 
-    def forward(self, seq_emb_s, seq_emb_z, res_idx, res_mask):
+    def esm_pair_projection(self) -> Optional[nn.Sequential]:
+        """LayerNorm and first Linear of `pair_mlp`, which `FrozenEsmModel` can apply one ESM layer at a time.
+
+        None when they are trained, as their gradient needs the attention maps of every layer.
+        """
+        projection = self.pair_mlp[:2]
+        if torch.is_grad_enabled() and any(p.requires_grad for p in projection.parameters()):
+            return None
+        return projection
+
+    def forward(self, seq_emb_s, seq_emb_z, res_idx, res_mask, pair_projected: bool = False):
         # single rpr
         seq_emb_s = seq_emb_s.to(self.esm_single_combine.dtype)
         seq_emb_s = seq_emb_s.detach()
-        seq_emb_s = (self.esm_single_combine.softmax(0).unsqueeze(0) @ seq_emb_s).squeeze(2)
+        if seq_emb_s.dim() == 4:
+            # [B, N, num_layers + 1, C] unless ESM already returned the weighted sum, see `esm_layer_weights`.
+            seq_emb_s = weighted_layer_sum(seq_emb_s, self.esm_single_combine.softmax(0))
         single = self.single_mlp(seq_emb_s)
 
         # pair rpr
         seq_emb_z = seq_emb_z.to(self.esm_single_combine.dtype)
         seq_emb_z = seq_emb_z.detach()
-        pair = self.pair_mlp(seq_emb_z)
-        pair = pair + self.pairwise_positional_embedding(res_idx, mask=res_mask)
+        # The ESM attention maps may already be through `esm_pair_projection`.
+        pair = self.pair_mlp[2:](seq_emb_z) if pair_projected else self.pair_mlp(seq_emb_z)
+        pair = pair + get_or_compute(
+            self.step_cache,
+            "seq_to_trunk.pair_position",
+            lambda: self.pairwise_positional_embedding(res_idx, mask=res_mask),
+        )
         return single, pair
 
 
@@ -1,5 +1,6 @@
 # FF modular model for designs with multiple modalities.
 from dataclasses import asdict
+import torch
 
 from foldflow.models.ff2flow.adapters import (
     MACEEncoderToTrunkNetwork,
@@ -16,7 +17,7 @@ from foldflow.models.ff2flow.trunk import (
     FF2TrunkBlockConfig,
     FF2TrunkTransformer,
 )
-from foldflow.models.components.sequence.frozen_esm import FrozenEsmModel
+from foldflow.models.components.sequence.frozen_esm import DEFAULT_CACHE_MAX_BYTES, FrozenEsmModel
 from foldflow.models.components.structure.mace import MACEConfig, MACEModel
 from functools import lru_cache
 from foldflow.models.se3_fm import SE3FlowMatcher
@@ -33,18 +34,31 @@ class FF2Dependencies:
     def flow_matcher(self):
         return SE3FlowMatcher(self.config.flow_matcher)
 
+    def _ipa_attention_kwargs(self):
+        # Attention settings shared by the IPA blocks of the encoder and the decoder.
+        ipa_conf = self.config.model.get("ipa", {})
+        return dict(
+            ipa_chunk_size=ipa_conf.get("chunk_size", None),
+            ipa_key_chunk_size=ipa_conf.get("key_chunk_size", None),
+            ipa_chunk_bytes=ipa_conf.get("chunk_bytes", None),
+            ipa_attn_impl=ipa_conf.get("attn_impl", "reference"),
+        )
+
     @dependency
     def bb_encoder(self) -> FF2StructureNetwork:
         emb_conf = EmbedderConfig(
             use_alphafold_position_embedding=self.config.model.embed.use_alphafold_position_embedding,
             embed_self_conditioning=self.config.model.embed.embed_self_conditioning,
             relpos_k=self.config.model.embed.relpos_k,
+            factorized_edge_embedder=self.config.model.embed.get("factorized_edge_embedder", True),
         )
         self.bb_encoder_conf = FF2StructureNetworkConfig(
             num_blocks=self.config.model.bb_encoder.num_blocks,  # FFOT uses 4
             coordinate_scaling=self.config.model.bb_encoder.coordinate_scaling,
             do_last_edge_update=True,
             embed=emb_conf,
+            checkpointing=self.config.model.get("checkpointing", "none"),
+            **self._ipa_attention_kwargs(),
         )
         bb_encoder = FF2StructureNetwork(
             self.bb_encoder_conf,
@@ -59,12 +73,15 @@ class FF2Dependencies:
             use_alphafold_position_embedding=self.config.model.embed.use_alphafold_position_embedding,
             embed_self_conditioning=self.config.model.embed.embed_self_conditioning,
             relpos_k=self.config.model.embed.relpos_k,
+            factorized_edge_embedder=self.config.model.embed.get("factorized_edge_embedder", True),
         )
         self.bb_decoder_conf = FF2StructureNetworkConfig(
             num_blocks=self.config.model.bb_decoder.num_blocks,
             coordinate_scaling=self.config.model.bb_decoder.coordinate_scaling,
             do_last_edge_update=False,
             embed=emb_conf,
+            checkpointing=self.config.model.get("checkpointing", "none"),
+            **self._ipa_attention_kwargs(),
         )
         bb_decoder = FF2StructureNetwork(
             self.bb_decoder_conf,
@@ -78,10 +95,14 @@ class FF2Dependencies:
         # load & set up the model
         esm_wrapper = FrozenEsmModel(
             self.config.model.esm2_model_key,
+            cache_max_bytes=self.config.model.get("esm_cache_max_bytes", DEFAULT_CACHE_MAX_BYTES),
+            backend=self.config.model.get("esm_backend", "auto"),
+            length_bucket_min_fill=self.config.model.get("esm_length_bucket_min_fill", None),
         )
         esm_wrapper.esm.eval()
         esm_wrapper.esm.requires_grad_(False)
-        esm_wrapper.esm.half()
+        # Set up for the device ESM will most likely run on, it is set up again if it runs on another one.
+        esm_wrapper.prepare_backend("cuda" if torch.cuda.is_available() else "cpu")
 
         return esm_wrapper
 
@@ -100,6 +121,9 @@ class FF2Dependencies:
                 aggr=self.config.model.mace_encoder.aggr,
                 pool=self.config.model.mace_encoder.pool,
                 batch_norm=self.config.model.mace_encoder.batch_norm,
+                edge_chunk_size=self.config.model.mace_encoder.get("edge_chunk_size", None),
+                edge_chunk_bytes=self.config.model.mace_encoder.get("edge_chunk_bytes", None),
+                precision=self.config.model.mace_encoder.get("precision", "fp32"),
             )
             mace = MACEModel(
                 conf=mace_conf,
@@ -177,6 +201,7 @@ class FF2Dependencies:
                 sequence_head_width=self.config.model.modalities_transformer.sequence_head_width,
                 pairwise_head_width=self.config.model.modalities_transformer.pairwise_head_width,
                 chunk_size=self.config.model.modalities_transformer.chunk_size,
+                checkpointing=self.config.model.get("checkpointing", "none"),
             )
             return FF2TrunkTransformer(
                 num_blocks=self.config.model.modalities_transformer.num_blocks,
@@ -3,7 +3,7 @@ from typing import Dict, Tuple, Optional
 import torch
 import logging
 
-from torch_geometric.data import Data, Batch
+from torch_geometric.data import Batch
 
 from foldflow.data import all_atom
 from foldflow.models.ff2flow.adapters import (
@@ -15,13 +15,22 @@ from foldflow.models.ff2flow.adapters import (
 from foldflow.models.ff2flow.ff2_dependencies import FF2Dependencies
 from foldflow.models.ff2flow.structure_network import FF2StructureNetwork
 from foldflow.models.ff2flow.trunk import FF2TrunkTransformer
-from foldflow.models.components.sequence.frozen_esm import FrozenEsmModel
-from foldflow.models.components.structure.mace import MACEModel
-from openfold.utils import rigid_utils as ru
+from foldflow.models.components.sequence.esm_cache import AllMaskEsmTable
+from foldflow.models.components.sequence.frozen_esm import FrozenEsmModel, weighted_layer_sum
+from foldflow.models.components.structure.mace import MACEModel, compile_mace
 from torch import nn
 from foldflow.models.components.sequence.frozen_esm import ESM_REGISTRY
 from foldflow.models.se3_fm import SE3FlowMatcher
-from foldflow.utils.graph_helpers import find_isolated_nodes, build_graph
+from foldflow.utils import frames as fu
+from foldflow.utils.graph_helpers import (
+    GraphConfig,
+    build_graph_from_config,
+    dense_to_graph_batch,
+    find_isolated_nodes,
+    graph_to_dense,
+)
+from foldflow.utils.neighbor_list import VerletGraphCache
+from foldflow.utils.step_cache import StepInvariantCache
 
 
 class FF2Model(nn.Module):
@@ -53,6 +62,25 @@ class FF2Model(nn.Module):
         self.trunk_network = trunk_network
         self.trunk_to_decoder_network = trunk_to_decoder_network
         self.time_embedder = time_embedder
+        self._graph_conf = GraphConfig(**config.model.graph) if bb_mace_encoder is not None else None
+        self._graph_cache = None
+        if self._graph_conf is not None and self._graph_conf.verlet_skin is not None:
+            self._graph_cache = VerletGraphCache(
+                self._graph_conf,
+                skin=self._graph_conf.verlet_skin,
+                max_num_neighbors=self._graph_conf.verlet_max_num_neighbors,
+            )
+        # Kept out of the registered submodules, so that the state dict has no duplicated MACE parameters.
+        self.__dict__["_compiled_mace_encoder"] = None
+        # ESM representations of the fully masked sequences of unconditional sampling, per length.
+        self._all_mask_esm_table = None
+        if config.model.get("esm_all_mask_table", True):
+            max_bytes = config.model.get("esm_all_mask_table_max_bytes", 2**30)
+            self._all_mask_esm_table = AllMaskEsmTable(max_bytes=max_bytes)
+        # Features that don't depend on t, computed once per sampling trajectory. Only the encoder embeds the inputs.
+        self._step_cache = StepInvariantCache() if config.model.get("step_invariant_cache", True) else None
+        self.bb_encoder.embedding_layer.step_cache = self._step_cache
+        self.sequence_to_trunk_network.step_cache = self._step_cache
 
         self._is_conditional_generation = False
         self._is_scaffolding_generation = False
@@ -126,20 +154,20 @@ class FF2Model(nn.Module):
 
     def _get_vectorfields(
         self,
-        pred_rigids: torch.Tensor,
-        init_rigids: torch.Tensor,
+        pred_frames: fu.Frames,
+        init_frames: fu.Frames,
         t: torch.Tensor,
         res_mask: torch.Tensor,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         _, rot_vectorfield = self.flow_matcher.calc_rot_vectorfield(
-            pred_rigids.get_rots().get_rot_mats(),
-            init_rigids.get_rots().get_rot_mats(),
+            pred_frames.rot_mats,
+            init_frames.rot_mats,
             t,
         )
         rot_vectorfield = rot_vectorfield * res_mask[..., None, None]
         trans_vectorfield = self.flow_matcher.calc_trans_vectorfield(
-            pred_rigids.get_trans(),
-            init_rigids.get_trans(),
+            pred_frames.trans,
+            init_frames.trans,
             t[:, None, None],
             scale=True,
         )
@@ -183,26 +211,154 @@ class FF2Model(nn.Module):
         self._is_conditional_generation = False
         super().train(is_training)
 
+    @property
+    def graph_cache(self) -> Optional[VerletGraphCache]:
+        return self._graph_cache
+
+    def reset_graph_cache(self):
+        """Drops the MACE neighbour list. Call it at the start of every new sampling trajectory."""
+        if self._graph_cache is not None:
+            self._graph_cache.reset()
+
+    def _build_mace_graph(self, data: Batch) -> torch.Tensor:
+        # The neighbour list is only reused at inference, where the positions change little between steps.
+        if self._graph_cache is not None and not self.training:
+            return self._graph_cache(data)
+        return build_graph_from_config(data, self._graph_conf)
+
+    @property
+    def step_cache(self) -> Optional[StepInvariantCache]:
+        return self._step_cache
+
+    def reset_step_cache(self):
+        """Drops the step-invariant features. Call it at the start of every new sampling trajectory."""
+        if self._step_cache is not None:
+            self._step_cache.reset()
+
+    def _check_step_cache(self, batch: Dict[str, torch.Tensor]):
+        # The features are reused across the steps of a trajectory only, training always recomputes them.
+        # A change of the residues or of the fixed (motif) residues invalidates them.
+        if self._step_cache is None:
+            return
+        if self.training:
+            self._step_cache.reset()
+            return
+        self._step_cache.check(seq_idx=batch["seq_idx"], res_mask=batch["res_mask"], fixed_mask=batch["fixed_mask"])
+
+    @property
+    def all_mask_esm_table(self) -> Optional[AllMaskEsmTable]:
+        return self._all_mask_esm_table
+
+    def set_all_mask_esm_dir(self, cache_dir: Optional[str]):
+        """Saves the ESM representations of the fully masked sequences to `cache_dir`, e.g. next to the checkpoint."""
+        if self._all_mask_esm_table is not None:
+            self._all_mask_esm_table.cache_dir = cache_dir
+
+    def _esm_readout(self) -> Tuple[Optional[torch.Tensor], Optional[nn.Sequential]]:
+        """Layer weights and pair projection that ESM applies while it runs, when they are not trained."""
+        layer_weights, pair_projection = None, None
+        if self.config.model.get("esm_streaming_readout", True):
+            layer_weights = self.sequence_to_trunk_network.esm_layer_weights()
+        if self.seq_encoder.use_esm_attn_map and self.config.model.get("esm_streaming_pair_projection", True):
+            pair_projection = self.sequence_to_trunk_network.esm_pair_projection()
+        return layer_weights, pair_projection
+
+    def _encode_sequence(
+        self,
+        batch: Dict[str, torch.Tensor],
+        seq_mask_pattern: torch.Tensor,
+        layer_weights: Optional[torch.Tensor] = None,
+        pair_projection: Optional[nn.Sequential] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # With the readouts, ESM returns the weighted sum of its layers instead of all of them, and the projected
+        # attention maps. The stored representations are read out in the same way.
+        def read_out(single_repns: torch.Tensor) -> torch.Tensor:
+            if layer_weights is None:
+                return single_repns
+            return weighted_layer_sum(single_repns, layer_weights.to(single_repns.device))
+
+        def project(pair_repns: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+            if pair_projection is None or pair_repns is None:
+                return pair_repns
+            return pair_projection(pair_repns.to(pair_projection[1].weight))
+
+        # Unconditional sampling masks the whole sequence, so the ESM input only depends on the length.
+        is_unconditional = not (self.training or self._is_conditional_generation or self._is_scaffolding_generation)
+        if self._all_mask_esm_table is not None and is_unconditional and torch.all(seq_mask_pattern == 1):
+            num_batch, num_res = seq_mask_pattern.shape
+            return self._all_mask_esm_table.get(
+                self.seq_encoder,
+                num_batch,
+                num_res,
+                seq_mask_pattern.device,
+                layer_weights=layer_weights,
+                pair_projection=pair_projection,
+            )
+
+        # The ESM store holds the representations of the unmasked sequences only.
+        use_store = torch.zeros_like(batch["res_mask"][:, 0], dtype=torch.bool)
+        needs_pair = self.seq_encoder.use_esm_attn_map
+        if "esm_store_hit" in batch and (batch["esm_pair_repns"].shape[-1] > 0 or not needs_pair):
+            use_store = batch["esm_store_hit"].bool() & torch.all(seq_mask_pattern == 0, dim=-1)
+        if use_store.all():
+            return read_out(batch["esm_single_repns"]), project(batch["esm_pair_repns"]) if needs_pair else None
+
+        live_rows = ~use_store
+        seq_emb_s, seq_emb_z = self.seq_encoder(
+            batch["aatype"][live_rows],
+            batch["chain_idx"][live_rows],
+            attn_mask=batch["res_mask"][live_rows],
+            seq_mask=seq_mask_pattern[live_rows],
+            layer_weights=layer_weights,
+            pair_projection=pair_projection,
+        )
+        if not use_store.any():
+            return seq_emb_s, seq_emb_z
+
+        # Run ESM only on the masked or unknown sequences, and take the others from the store.
+        stored_s = read_out(batch["esm_single_repns"]).to(seq_emb_s, copy=True)
+        stored_s[live_rows] = seq_emb_s.to(stored_s.device)
+        if seq_emb_z is None:
+            return stored_s, None
+        stored_z = project(batch["esm_pair_repns"]).to(seq_emb_z, copy=True)
+        stored_z[live_rows] = seq_emb_z.to(stored_z.device)
+        return stored_s, stored_z
+
+    def _run_mace_encoder(self, data: Batch) -> torch.Tensor:
+        # The compiled MACE encoder is used only at inference, training always runs eagerly.
+        mace_conf = self.config.model.mace_encoder
+        if self.training or not mace_conf.get("compile", False):
+            return self.bb_mace_encoder(data)
+        if self._compiled_mace_encoder is None:
+            self._logger.info("Compiling the MACE encoder for inference.")
+            self.__dict__["_compiled_mace_encoder"] = compile_mace(
+                self.bb_mace_encoder, cache_dir=mace_conf.get("compile_cache_dir", None)
+            )
+        return self._compiled_mace_encoder(data)
+
     def forward(self, batch: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:  # TODO: verify the return type.
         device = batch["rigids_t"].device
-        init_rigids = ru.Rigid.from_tensor_7(batch["rigids_t"])
+        init_frames = fu.frames_from_tensor_7(batch["rigids_t"])
         t = batch["t"]
 
         bb_mask = batch["res_mask"].type(torch.float32)  # [B, N]
         edge_mask = bb_mask[..., None] * bb_mask[..., None, :]
+        self._check_step_cache(batch)
 
         # Sequence representations.
         seq_mask_pattern = self._make_seq_mask_pattern(batch)
 
-        seq_emb_s, seq_emb_z = self.seq_encoder(
-            batch["aatype"],
-            batch["chain_idx"],
-            attn_mask=batch["res_mask"],
-            seq_mask=seq_mask_pattern,
-        )
+        layer_weights, pair_projection = self._esm_readout()
+        seq_emb_s, seq_emb_z = self._encode_sequence(batch, seq_mask_pattern, layer_weights, pair_projection)
         seq_emb_s, seq_emb_z = seq_emb_s.to(device), seq_emb_z.to(device)
         # Processing of the sequence emb (trainable). # LN and Lin. layers.
-        seq_emb_s, seq_emb_z = self.sequence_to_trunk_network(seq_emb_s, seq_emb_z, batch["seq_idx"], batch["res_mask"])
+        seq_emb_s, seq_emb_z = self.sequence_to_trunk_network(
+            seq_emb_s,
+            seq_emb_z,
+            batch["seq_idx"],
+            batch["res_mask"],
+            pair_projected=pair_projection is not None,
+        )
 
         # Structure encoder representations.
         bb_encoder_output = self.bb_encoder(
@@ -217,7 +373,7 @@ class FF2Model(nn.Module):
         )
         bb_emb_s = bb_encoder_output["single_emb"]
         bb_emb_z = bb_encoder_output["pair_emb"]
-        rigids_updated = bb_encoder_output["rigids"]
+        frames_updated = bb_encoder_output["frames"]
         init_single_embed = bb_encoder_output["init_single_embed"]
         init_pair_embed = bb_encoder_output["init_pair_embed"]
 
@@ -225,17 +381,14 @@ class FF2Model(nn.Module):
         has_self_conditioning_output = not torch.all(batch["sc_ca_t"] == 0.0)
 
         if self.bb_mace_encoder is not None and has_self_conditioning_output:
-            # Create a graph using only CA positions.
+            # Create a graph using only CA positions of the non-padded residues.
             ca_pos = batch["sc_ca_t"].to(torch.float32)
             res_idx = batch["residue_index"] if "residue_index" in batch else batch["seq_idx"]
-            atoms = torch.zeros_like(ca_pos[..., 0]).to(torch.long)  # Dummy atomic type, as MACE requires it.
-            data = Batch.from_data_list(
-                [Data(atoms=atoms[i], pos=ca_pos[i], res_idx=res_idx[i]) for i in range(ca_pos.shape[0])]
-            )
+            num_batch, num_res = batch["res_mask"].shape
+            data = dense_to_graph_batch(ca_pos, res_idx, batch["res_mask"])
             # Create edges based on the spatial distances and KNN between CA atoms, but not connecting
-            # CA atoms of the neighbouring residues.
-            max_num_edges = self.config.model.graph.max_squared_res_ratio * (data.num_nodes**2)
-            data.edge_index = build_graph(data, max_edges=max_num_edges, min_residue_distance=5, radius=5, k=10)
+            # CA atoms of the neighbouring residues. Degrees and edge budgets are capped per residue and per protein.
+            data.edge_index = self._build_mace_graph(data)
 
             # Check for isolated nodes.
             assert (
@@ -244,7 +397,8 @@ class FF2Model(nn.Module):
 
             # Compute MACE representations. The result contains only updated O(3)-equivariant node features,
             # the pairwise features are encoded in the node features --> we have only single representation here.
-            bb_mace_emb_s = self.bb_mace_encoder(data)
+            bb_mace_emb_s = self._run_mace_encoder(data)
+            bb_mace_emb_s = graph_to_dense(bb_mace_emb_s, data.node_index, num_batch, num_res)  # [B, N, C]
             if self._debug:
                 self._logger.info(f"The number of edges in the graph: {data.edge_index.shape[1]}")
 
@@ -295,10 +449,10 @@ class FF2Model(nn.Module):
             t=t,
             single_embed=single_embed,
             pair_embed=pair_embed,
-            rigids_t=rigids_updated.to_tensor_7(),
+            rigids_t=fu.frames_to_tensor_7(frames_updated),
             unscale_rigids=False,
         )
-        rigids_updated = bb_decoder_output["rigids"]
+        frames_updated = bb_decoder_output["frames"]
         psi = bb_decoder_output["psi"]
         if self._is_scaffolding_generation:
             mask = batch["fixed_mask"][:, :, None]
@@ -306,13 +460,13 @@ class FF2Model(nn.Module):
             psi = psi * (1 - mask) + gt_psi * mask
 
         res_mask = batch["res_mask"].type(torch.float32)
-        rot_vectorfield, trans_vectorfield = self._get_vectorfields(rigids_updated, init_rigids, t, res_mask)
+        rot_vectorfield, trans_vectorfield = self._get_vectorfields(frames_updated, init_frames, t, res_mask)
         model_out: Dict[str, torch.Tensor] = {}
         model_out["rot_vectorfield"] = rot_vectorfield
         model_out["trans_vectorfield"] = trans_vectorfield
         model_out["psi"] = psi
-        model_out["rigids"] = rigids_updated.to_tensor_7()
-        bb_representations = all_atom.compute_backbone(rigids_updated, psi)
+        model_out["rigids"] = fu.frames_to_tensor_7(frames_updated)
+        bb_representations = all_atom.compute_backbone(frames_updated, psi)
         model_out["atom37"] = bb_representations[0].to(device)
         model_out["atom14"] = bb_representations[-1].to(device)
 
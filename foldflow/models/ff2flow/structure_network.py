@@ -29,6 +29,13 @@ class IPAConfig:
     c_s: int = 256
     update_bb: bool = False
     do_last_edge_update: bool = False
+    chunk_size: Optional[int] = None
+    key_chunk_size: Optional[int] = None
+    chunk_bytes: Optional[int] = None
+    attn_impl: str = "reference"
+    checkpointing: str = "none"
+    num_neighbours: Optional[int] = None  # Sparse IPA over this many neighbours per residue, None is dense.
+    seq_window: int = 8  # Neighbours of the sparse IPA within this many positions in the chain.
 
 
 @dataclass
@@ -42,6 +49,7 @@ class EmbedderConfig:
     max_bin: float = 20.0
     relpos_k: Optional[int] = None
     use_alphafold_position_embedding: Optional[bool] = False
+    factorized_edge_embedder: bool = True
 
 
 @dataclass
@@ -64,6 +72,11 @@ class FF2StructureNetworkConfig:
     use_context: bool = False
     embed: EmbedderConfig = EmbedderConfig()
     do_last_edge_update: bool = False
+    ipa_chunk_size: Optional[int] = None
+    ipa_key_chunk_size: Optional[int] = None
+    ipa_chunk_bytes: Optional[int] = None
+    ipa_attn_impl: str = "reference"
+    checkpointing: str = "none"
     ipa: Optional[IPAConfig] = None
 
     def __post_init__(self):
@@ -82,12 +95,19 @@ class FF2StructureNetworkConfig:
             context_embed_init_size=self.context_embed_init_size,
             attn_type=self.attn_type,
             do_last_edge_update=self.do_last_edge_update,
+            chunk_size=self.ipa_chunk_size,
+            key_chunk_size=self.ipa_key_chunk_size,
+            chunk_bytes=self.ipa_chunk_bytes,
+            attn_impl=self.ipa_attn_impl,
+            checkpointing=self.checkpointing,
         )
 
 
 class FF2StructureNetwork(IpaNetwork):
     def __init__(self, model_conf, flow_matcher, generate_sc_angles=False):
         super().__init__(model_conf, flow_matcher)
+        if self.num_neighbours is not None:
+            raise ValueError("The FF2 trunk needs the dense pair representation, the sparse IPA is FF1 only.")
         self.embedding_layer = Embedder(model_conf)
         self.generate_sc_angles = generate_sc_angles
 
@@ -161,6 +181,7 @@ class FF2StructureNetwork(IpaNetwork):
             "single_emb": single_emb,
             "pair_emb": pair_emb,
             "rigids": rigids,
+            "frames": model_out["final_frames"],
             "psi": psi,
             "init_single_embed": init_single_embed,
             "init_pair_embed": init_pair_embed,
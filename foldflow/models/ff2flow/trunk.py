@@ -5,6 +5,8 @@ from esm.esmfold.v1.tri_self_attn_block import TriangularSelfAttentionBlock
 from pydantic.dataclasses import dataclass
 from torch import nn
 
+from foldflow.utils.checkpointing import check_checkpointing_policy, maybe_checkpoint
+
 
 @dataclass
 class FF2TrunkBlockConfig:
@@ -15,6 +17,7 @@ class FF2TrunkBlockConfig:
     dropout: float = 0.0  # ESMF default
     position_bins: int = 32  # ESMF default
     chunk_size: Optional[int] = None
+    checkpointing: str = "none"  # Only "block" checkpoints the trunk, see `foldflow.utils.checkpointing`.
 
 
 class FF2TrunkTransformer(nn.Module):
@@ -41,6 +44,7 @@ class FF2TrunkTransformer(nn.Module):
             ]
         )
         self.chunk_size = block_config.chunk_size
+        self.checkpointing = check_checkpointing_policy(block_config.checkpointing)
 
     def forward(
         self,
@@ -49,5 +53,8 @@ class FF2TrunkTransformer(nn.Module):
         mask: torch.Tensor,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         for block in self.blocks:
-            single, pair = block(single, pair, mask=mask, chunk_size=self.chunk_size)
+            single, pair = maybe_checkpoint(self.checkpointing == "block", self._run_block, block, single, pair, mask)
         return single, pair
+
+    def _run_block(self, block, single, pair, mask):
+        return block(single, pair, mask=mask, chunk_size=self.chunk_size)
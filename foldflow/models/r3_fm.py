@@ -167,6 +167,49 @@ class R3FM:
         x_t_1 = self._unscale(x_t_1)
         return x_t_1
 
+    def reverse_torch(
+        self,
+        *,
+        x_t: torch.Tensor,
+        v_t: torch.Tensor,
+        t: float,
+        dt: float,
+        mask: torch.Tensor = None,
+        center: bool = True,
+        noise_scale: float = 1.0,
+    ) -> torch.Tensor:
+        """Same as `reverse` with tensors, the positions and the noise stay on the device of `x_t`.
+
+        Args:
+            x_t: [..., 3] current positions at time t in angstroms.
+            v_t: [..., 3] translation vectorfield at time t.
+            t: continuous time in [0, 1].
+            dt: continuous step size in [0, 1].
+            mask: True indicates which residues to update.
+
+        Returns:
+            [..., 3] positions at next step t-1.
+        """
+        if not np.isscalar(t):
+            raise ValueError(f"{t} must be a scalar.")
+        x_t = self._scale(x_t)
+        perturb = -v_t.to(x_t.dtype) * dt  # get the reversed scaled velocity
+
+        if self.stochastic_paths:
+            z = noise_scale * torch.randn_like(perturb)
+            perturb = perturb + self.g * np.sqrt(dt) * z
+
+        if mask is not None:
+            perturb = perturb * mask[..., None]
+        else:
+            mask = torch.ones_like(x_t[..., 0])
+        x_t_1 = x_t + perturb
+        if center:
+            # Center positions to avoid possible accumulation of errors
+            com = torch.sum(x_t_1, dim=-2) / torch.sum(mask, dim=-1)[..., None]
+            x_t_1 = x_t_1 - com[..., None, :]
+        return self._unscale(x_t_1)
+
     def vectorfield_scaling(self, t: float):
         return 1
 
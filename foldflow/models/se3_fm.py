@@ -179,6 +179,65 @@ class SE3FlowMatcher:
             rot_t_1 = self._apply_mask(rot_t_1, rot_t, flow_mask[..., None, None])
         return (rot_t_1, trans_t_1, assemble_rigid_mat(rot_t_1, trans_t_1))
 
+    def reverse_torch(
+        self,
+        rot_t: torch.Tensor,
+        trans_t: torch.Tensor,
+        rot_vectorfield: torch.Tensor,
+        trans_vectorfield: torch.Tensor,
+        t: float,
+        dt: float,
+        flow_mask: torch.Tensor = None,
+        center: bool = True,
+        noise_scale: float = 1.0,
+    ):
+        """Same as `reverse` with tensors, batched over the leading dimensions.
+
+        The rotations, translations and noise stay on the device of the vector fields, so that sampling doesn't
+        copy the state to the host and back at every step.
+
+        Args:
+            rot_t: [..., N, 3, 3] rotations at time t.
+            trans_t: [..., N, 3] translations at time t.
+            rot_vectorfield: [..., N, 3, 3] rotation vectorfield.
+            trans_vectorfield: [..., N, 3] translation vectorfield.
+            t: continuous time in [0, 1].
+            dt: continuous step size in [0, 1].
+            flow_mask: [..., N] which residues to update.
+            center: true to set center of mass to zero after step
+
+        Returns:
+            rot_t_1: [..., N, 3, 3] rotations at time t-1.
+            trans_t_1: [..., N, 3] translations at time t-1.
+        """
+        if not self._do_fm_rot:
+            rot_t_1 = rot_t
+        else:
+            rot_t_1 = self._so3_fm.reverse_torch(
+                rot_t=rot_t,
+                v_t=rot_vectorfield,
+                t=t,
+                dt=dt,
+                noise_scale=noise_scale,
+            )
+        if not self._flow_trans:
+            trans_t_1 = trans_t
+        else:
+            trans_t_1 = self._r3_fm.reverse_torch(
+                x_t=trans_t,
+                v_t=trans_vectorfield,
+                t=t,
+                dt=dt,
+                center=center,
+                noise_scale=noise_scale,
+            )
+
+        if flow_mask is not None:
+            flow_mask = flow_mask.to(trans_t.dtype)
+            trans_t_1 = self._apply_mask(trans_t_1, trans_t, flow_mask[..., None])
+            rot_t_1 = self._apply_mask(rot_t_1, rot_t, flow_mask[..., None, None])
+        return rot_t_1, trans_t_1
+
     def sample_ref(
         self,
         n_samples: int,
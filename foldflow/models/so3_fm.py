@@ -23,15 +23,6 @@ from foldflow.utils.so3_helpers import (
 from foldflow.utils.igso3 import _batch_sample
 
 
-def _flat_vec(vec, return_batch=False):
-    if return_batch:
-        batch = vec.shape[0]
-    vec = rearrange(vec, "t n c -> (t n) c", c=3)
-    if return_batch:
-        return batch, vec
-    return vec
-
-
 class SO3FM:
     def __init__(self, so3_conf, stochastic_paths):
         self.so3_group = SpecialOrthogonal(n=3, point_type="matrix")
@@ -103,22 +94,53 @@ class SO3FM:
         if not np.isscalar(t):
             raise ValueError(f"{t} must be a scalar.")
 
-        perturb = -v_t * dt  # scale the velocity by the time step for performing the Euler step
-
         if flow_mask is not None:
-            perturb *= flow_mask[..., None]
+            v_t = v_t * flow_mask[..., None]
+        rot_t_1 = self.reverse_torch(
+            rot_t=torch.tensor(rot_t).double(),
+            v_t=torch.tensor(v_t).double(),
+            t=t,
+            dt=dt,
+            noise_scale=noise_scale,
+        )
+        return rot_t_1.detach().cpu().numpy()
+
+    def reverse_torch(
+        self,
+        rot_t: torch.Tensor,
+        v_t: torch.Tensor,
+        t: float,
+        dt: float,
+        noise_scale: float = 1.0,
+    ) -> torch.Tensor:
+        """Same as `reverse` with tensors, the rotations and the noise stay on the device of `rot_t`.
+
+        The step is computed in float64, as in `reverse`, and returned in the dtype of `rot_t`.
+
+        Args:
+            rot_t: [..., 3, 3] current rotations at time t.
+            v_t: [..., 3, 3] rotation vectorfield at time t, in the tangent space at rot_t.
+            t: continuous time in [0, 1].
+            dt: continuous step size in [0, 1].
+            noise_scale: scale of the noise to be added.
+
+        Returns:
+            [..., 3, 3] rotations at next step.
+        """
+        if not np.isscalar(t):
+            raise ValueError(f"{t} must be a scalar.")
+
+        perturb = -v_t.double() * dt  # scale the velocity by the time step for performing the Euler step
 
         # Euler step in the direction of the reversed vector field v_t along the geodesic from rot_t towards
         # the data distribution at rot_0
-        rot_t_1 = expmap(R0=torch.tensor(rot_t).double(), tangent=torch.tensor(perturb).double())
+        rot_t_1 = expmap(R0=rot_t.double(), tangent=perturb)
         if self.stochastic_paths:
             z = noise_scale * torch.randn(size=v_t.shape[:-1], device=rot_t_1.device, dtype=torch.float64)
-            z = _flat_vec(z)
-            dB_skew_sym = hat(self.g * np.sqrt(dt) * z)
+            dB_skew_sym = hat(self.g * np.sqrt(dt) * z.reshape(-1, 3))
             dB_skew_sym = dB_skew_sym.reshape(rot_t.shape)
             rot_t_1 = rot_t_1 @ exp(dB_skew_sym)
-        rot_t_1 = rot_t_1.reshape(rot_t.shape)
-        return rot_t_1.detach().cpu().numpy()
+        return rot_t_1.reshape(rot_t.shape).to(rot_t.dtype)
 
     def vectorfield(self, rot_0, rot_t, t):
         """uses rot_0 and rot_t and t to calculate ut"""
@@ -0,0 +1,31 @@
+"""Activation checkpointing policies of the IPA structure networks and of the FF2 trunk.
+
+- "none": every activation is kept for the backward pass.
+- "block": only the inputs of every IPA block and trunk block are kept, their activations are recomputed in the
+  backward pass.
+- "selective": only the invariant point attention and the edge transitions, whose activations scale with the number
+  of residue pairs, are recomputed. The trunk blocks keep their activations.
+"""
+
+from typing import Callable
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+CHECKPOINTING_POLICIES = ("none", "block", "selective")
+
+
+def check_checkpointing_policy(policy: str) -> str:
+    if policy not in CHECKPOINTING_POLICIES:
+        raise ValueError(f"Unknown checkpointing policy {policy}, expected one of {CHECKPOINTING_POLICIES}.")
+    return policy
+
+
+def maybe_checkpoint(enabled: bool, fn: Callable, *args):
+    """`fn(*args)`, recomputed in the backward pass instead of keeping its activations if `enabled`.
+
+    Nothing is checkpointed without autograd, e.g. at inference.
+    """
+    if enabled and torch.is_grad_enabled():
+        return checkpoint(fn, *args, use_reentrant=False)
+    return fn(*args)
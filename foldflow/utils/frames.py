@@ -0,0 +1,178 @@
+"""Tensor-only SE(3) frames for the hot loops of the structure networks.
+
+openfold's `Rigid` stores either the quaternions or the rotation matrices of the frames and recomputes the other
+representation, through a [*, 4, 4, 3, 3] product, at every `apply`, `invert_apply` or `get_rot_mats` call. The
+IPA blocks apply their frames several times per block, so `Frames` keeps both representations together: the rotation
+matrices are computed once, in closed form, when the quaternions change. `Frames` is a NamedTuple of tensors and the
+functions below only use tensor ops, so they can be scripted with TorchScript and traced by `torch.compile`, except
+`frames_from_rigid` and `frames_to_rigid` which convert from and to `Rigid` at the boundaries of the models.
+"""
+
+from typing import NamedTuple, Optional
+
+import torch
+
+from openfold.utils.rigid_utils import Rigid, Rotation
+
+
+class Frames(NamedTuple):
+    """[*] frames, with rotation matrices [*, 3, 3], unit quaternions [*, 4] and translations [*, 3]."""
+
+    rot_mats: torch.Tensor
+    quats: torch.Tensor
+    trans: torch.Tensor
+
+
+def quat_to_rot_mats(quats: torch.Tensor) -> torch.Tensor:
+    """Rotation matrices [*, 3, 3] of the unit quaternions [*, 4], same as `rigid_utils.quat_to_rot`."""
+    a, b, c, d = torch.unbind(quats, dim=-1)
+    aa, bb, cc, dd = a * a, b * b, c * c, d * d
+    ab, ac, ad = a * b, a * c, a * d
+    bc, bd, cd = b * c, b * d, c * d
+    rows = [
+        torch.stack([aa + bb - cc - dd, 2 * (bc - ad), 2 * (bd + ac)], dim=-1),
+        torch.stack([2 * (bc + ad), aa - bb + cc - dd, 2 * (cd - ab)], dim=-1),
+        torch.stack([2 * (bd - ac), 2 * (cd + ab), aa - bb - cc + dd], dim=-1),
+    ]
+    return torch.stack(rows, dim=-2)
+
+
+def rot_mats_to_quats(rot_mats: torch.Tensor) -> torch.Tensor:
+    """Unit quaternions [*, 4] with a non-negative real part of the rotation matrices [*, 3, 3].
+
+    Closed-form replacement of `rigid_utils.rot_to_quat`, which solves an eigenvalue problem. Every row of
+    `candidates` is the quaternion scaled by one of its components, the row of the largest component is the most
+    accurate one.
+    """
+    m00, m01, m02 = torch.unbind(rot_mats[..., 0, :], dim=-1)
+    m10, m11, m12 = torch.unbind(rot_mats[..., 1, :], dim=-1)
+    m20, m21, m22 = torch.unbind(rot_mats[..., 2, :], dim=-1)
+    # Twice the absolute values of the components: [*, 4]
+    q_abs = torch.sqrt(
+        torch.clamp(
+            torch.stack(
+                [1 + m00 + m11 + m22, 1 + m00 - m11 - m22, 1 - m00 + m11 - m22, 1 - m00 - m11 + m22], dim=-1
+            ),
+            min=0.0,
+        )
+    )
+    # [*, 4, 4]
+    candidates = torch.stack(
+        [
+            torch.stack([q_abs[..., 0] ** 2, m21 - m12, m02 - m20, m10 - m01], dim=-1),
+            torch.stack([m21 - m12, q_abs[..., 1] ** 2, m10 + m01, m02 + m20], dim=-1),
+            torch.stack([m02 - m20, m10 + m01, q_abs[..., 2] ** 2, m12 + m21], dim=-1),
+            torch.stack([m10 - m01, m20 + m02, m21 + m12, q_abs[..., 3] ** 2], dim=-1),
+        ],
+        dim=-2,
+    )
+    candidates = candidates / (2.0 * torch.clamp(q_abs[..., None], min=0.1))
+    best = torch.argmax(q_abs, dim=-1, keepdim=True)[..., None].expand_as(candidates[..., :1, :])
+    quats = torch.gather(candidates, -2, best).squeeze(-2)
+    # The rotation matrices are orthonormal up to rounding errors, as are the quaternions before normalizing.
+    quats = quats / torch.linalg.norm(quats, dim=-1, keepdim=True)
+    return torch.where(quats[..., :1] < 0, -quats, quats)
+
+
+def quat_multiply_by_vec(quats: torch.Tensor, vec: torch.Tensor) -> torch.Tensor:
+    """Product [*, 4] of the quaternions [*, 4] by the pure-vector quaternions (0, vec), same as in `rigid_utils`."""
+    a, b, c, d = torch.unbind(quats, dim=-1)
+    x, y, z = torch.unbind(vec, dim=-1)
+    return torch.stack(
+        [
+            -b * x - c * y - d * z,
+            a * x + c * z - d * y,
+            a * y - b * z + d * x,
+            a * z + b * y - c * x,
+        ],
+        dim=-1,
+    )
+
+
+def rot_vec_mul(rot_mats: torch.Tensor, vecs: torch.Tensor) -> torch.Tensor:
+    """Rotations [*, 3, 3] of the vectors [*, 3], as elementwise ops that broadcast over the batch dimensions."""
+    x, y, z = torch.unbind(vecs, dim=-1)
+    return torch.stack(
+        [
+            rot_mats[..., 0, 0] * x + rot_mats[..., 0, 1] * y + rot_mats[..., 0, 2] * z,
+            rot_mats[..., 1, 0] * x + rot_mats[..., 1, 1] * y + rot_mats[..., 1, 2] * z,
+            rot_mats[..., 2, 0] * x + rot_mats[..., 2, 1] * y + rot_mats[..., 2, 2] * z,
+        ],
+        dim=-1,
+    )
+
+
+def frames_from_quats(quats: torch.Tensor, trans: torch.Tensor, normalize_quats: bool = True) -> Frames:
+    """Frames of the quaternions [*, 4] and translations [*, 3]."""
+    # Quaternions are kept in float32, as in `Rotation`.
+    quats = quats.type(torch.float32)
+    if normalize_quats:
+        quats = quats / torch.linalg.norm(quats, dim=-1, keepdim=True)
+    return Frames(quat_to_rot_mats(quats), quats, trans)
+
+
+def frames_from_rot_mats(rot_mats: torch.Tensor, trans: torch.Tensor) -> Frames:
+    """Frames of the rotation matrices [*, 3, 3] and translations [*, 3]."""
+    rot_mats = rot_mats.type(torch.float32)
+    return Frames(rot_mats, rot_mats_to_quats(rot_mats), trans)
+
+
+def frames_from_tensor_7(t: torch.Tensor, normalize_quats: bool = False) -> Frames:
+    """Frames of a [*, 7] tensor of quaternions followed by translations, as `Rigid.from_tensor_7`."""
+    if t.shape[-1] != 7:
+        raise ValueError("Incorrectly shaped input tensor")
+    return frames_from_quats(t[..., :4], t[..., 4:], normalize_quats=normalize_quats)
+
+
+def frames_to_tensor_7(frames: Frames) -> torch.Tensor:
+    """[*, 7] tensor of the quaternions followed by the translations, as `Rigid.to_tensor_7`."""
+    return torch.cat([frames.quats.to(frames.trans.dtype), frames.trans], dim=-1)
+
+
+def frames_from_rigid(rigid: Rigid) -> Frames:
+    """Frames of `rigid`. The quaternions of a `Rigid` built from rotation matrices go through an eigendecomposition."""
+    rots = rigid.get_rots()
+    return Frames(rots.get_rot_mats(), rots.get_quats(), rigid.get_trans())
+
+
+def frames_to_rigid(frames: Frames) -> Rigid:
+    """`Rigid` backed by the quaternions of `frames`."""
+    return Rigid(Rotation(rot_mats=None, quats=frames.quats, normalize_quats=False), frames.trans)
+
+
+def _expand_frames(frames: Frames, pts: torch.Tensor):
+    """Rotations and translations of `frames` [*] broadcastable to the points [*, ..., 3]."""
+    rot_mats, trans = frames.rot_mats, frames.trans
+    for _ in range(pts.dim() - trans.dim()):
+        rot_mats = rot_mats.unsqueeze(-3)
+        trans = trans.unsqueeze(-2)
+    return rot_mats, trans
+
+
+def apply(frames: Frames, pts: torch.Tensor) -> torch.Tensor:
+    """Points [*, ..., 3] in the frames [*] mapped to the global frame, as `rigid[..., None].apply(pts)`."""
+    rot_mats, trans = _expand_frames(frames, pts)
+    return rot_vec_mul(rot_mats, pts) + trans
+
+
+def invert_apply(frames: Frames, pts: torch.Tensor) -> torch.Tensor:
+    """Points [*, ..., 3] in the global frame mapped to the frames [*], as `rigid[..., None].invert_apply(pts)`."""
+    rot_mats, trans = _expand_frames(frames, pts)
+    return rot_vec_mul(rot_mats.transpose(-1, -2), pts - trans)
+
+
+def compose_q_update_vec(
+    frames: Frames, q_update_vec: torch.Tensor, update_mask: Optional[torch.Tensor] = None
+) -> Frames:
+    """Frames updated with [*, 6] updates, quaternion (1, x, y, z) then translation, as `Rigid.compose_q_update_vec`.
+
+    The rotation matrices of the updated frames are computed once here, instead of at every use.
+    """
+    q_vec, t_vec = q_update_vec[..., :3], q_update_vec[..., 3:]
+    quat_update = quat_multiply_by_vec(frames.quats, q_vec)
+    trans_update = rot_vec_mul(frames.rot_mats, t_vec)
+    if update_mask is not None:
+        quat_update = quat_update * update_mask
+        trans_update = trans_update * update_mask
+    return frames_from_quats(frames.quats + quat_update, frames.trans + trans_update)
+
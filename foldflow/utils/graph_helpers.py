@@ -1,17 +1,264 @@
 "Helpers for graph construction and manipulation taken and adapted from TorchDrug"
 
+from typing import Optional, Tuple, Union
+
 import torch
 
+from pydantic.dataclasses import dataclass
 from torch_geometric.data import Batch
 from torch_cluster import radius_graph, knn_graph
 
 
+@dataclass
+class GraphConfig:
+    """
+    Parameters:
+    - knn_k (int): Number of spatial nearest neighbours of each residue (default: 10)
+    - knn_min_dist (int): Minimum sequence separation of the kNN edges (default: 5)
+    - knn_max_dist (Optional[int]): Maximum sequence separation of the kNN edges, no limit if None (default: None)
+    - radius_r (float): Radius of the radius graph in Angstroms (default: 5.0)
+    - radius_min_dist (int): Minimum sequence separation of the radius edges (default: 5)
+    - radius_max_dist (Optional[int]): Maximum sequence separation of the radius edges, no limit if None
+      (default: None)
+    - radius_max_num_neighbors (int): Maximum number of radius edges per residue, the closest ones are kept among
+      all the residues within `radius_r` (default: 10)
+    - max_squared_res_ratio (float): Edge budget of each graph as a fraction of its squared number of residues
+      (default: 0.1)
+    - verlet_skin (Optional[float]): Skin margin in Angstroms of the neighbour list reused across inference steps,
+      disabled if None (default: None)
+    - verlet_max_num_neighbors (int): Maximum number of candidate neighbours per residue in the neighbour list
+      (default: 64)
+
+    Note:
+    - The in-degree of every residue is at most `knn_k + radius_max_num_neighbors + 1`, the last edge coming from
+      the repair of isolated residues. Hence the number of edges grows linearly with the number of residues.
+    """
+
+    knn_k: int = 10
+    knn_min_dist: int = 5
+    knn_max_dist: Optional[int] = None
+    radius_r: float = 5.0
+    radius_min_dist: int = 5
+    radius_max_dist: Optional[int] = None
+    radius_max_num_neighbors: int = 10
+    max_squared_res_ratio: float = 0.1
+    verlet_skin: Optional[float] = None
+    verlet_max_num_neighbors: int = 64
+
+
+def dense_to_graph_batch(
+    pos: torch.Tensor, res_idx: torch.Tensor, res_mask: torch.Tensor, atoms: Optional[torch.Tensor] = None
+) -> Batch:
+    """Converts padded [B, N, ...] residue features to a batch of graphs without the padded residues.
+
+    The `batch` and `ptr` vectors are built directly from `res_mask`, so no per-protein `Data` objects are created.
+    The returned batch stores `node_index`, the position of every node in the flattened [B * N] padded layout,
+    which `graph_to_dense` uses to scatter node features back, and `max_num_nodes`, the padded length N, which bounds
+    the size of every graph without reading the number of nodes back from the device.
+
+    Args:
+        pos: [B, N, 3] node positions.
+        res_idx: [B, N] residue indices.
+        res_mask: [B, N] mask of the real (non-padded) residues.
+        atoms: [B, N] atom types. Defaults to a dummy type 0, as MACE requires one.
+
+    Returns:
+        Batch with `pos`, `res_idx`, `atoms`, `batch`, `ptr`, `node_index` and `max_num_nodes` attributes.
+    """
+    num_batch, num_res = res_mask.shape
+    node_index = res_mask.reshape(-1).bool().nonzero(as_tuple=True)[0]
+    num_nodes_per_graph = res_mask.bool().sum(dim=-1)
+    ptr = torch.cat([num_nodes_per_graph.new_zeros(1), torch.cumsum(num_nodes_per_graph, dim=0)])
+    if atoms is None:
+        atoms = torch.zeros_like(res_idx, dtype=torch.long)
+    return Batch(
+        atoms=atoms.reshape(-1)[node_index],
+        pos=pos.reshape(num_batch * num_res, -1)[node_index],
+        res_idx=res_idx.reshape(-1)[node_index],
+        batch=torch.div(node_index, num_res, rounding_mode="floor"),
+        ptr=ptr,
+        node_index=node_index,
+        max_num_nodes=num_res,
+    )
+
+
+def graph_to_dense(node_feats: torch.Tensor, node_index: torch.Tensor, num_batch: int, num_res: int) -> torch.Tensor:
+    """Scatters [n, C] node features back into the padded [B, N, C] layout, with zeros at the padded residues."""
+    out = node_feats.new_zeros((num_batch * num_res,) + node_feats.shape[1:])
+    out = out.index_copy(0, node_index, node_feats)
+    return out.reshape((num_batch, num_res) + node_feats.shape[1:])
+
+
 def find_isolated_nodes(num_nodes, edge_index):
     deg = torch.bincount(edge_index[1], minlength=num_nodes)
     return (deg == 0).nonzero(as_tuple=True)[0]
 
 
-def build_graph(data: Batch, max_edges: int, min_residue_distance: int, radius: float, k: int):
+def dedup_edges(edge_index: torch.Tensor, num_nodes: int) -> torch.Tensor:
+    """Removes duplicated edges. The output is sorted by (src, dst) just like `torch.unique(edge_index, dim=1)`."""
+    keys = torch.unique(edge_index[0] * num_nodes + edge_index[1])
+    return torch.stack([keys // num_nodes, keys % num_nodes])
+
+
+def edge_budgets_from_total(max_edges: Union[int, float], batch: torch.Tensor, num_graphs: int) -> torch.Tensor:
+    """Splits a total edge budget between the graphs of a batch proportionally to their squared number of nodes."""
+    num_nodes = torch.bincount(batch, minlength=num_graphs).to(torch.float64)
+    share = num_nodes**2 / (num_nodes**2).sum().clamp(min=1.0)
+    return torch.floor(share * float(max_edges)).to(torch.long)
+
+
+def rank_in_groups(values: torch.Tensor, groups: torch.Tensor, num_groups: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Sorts `values` inside each group.
+
+    Returns the permutation that groups the entries and sorts them by value inside their group, and the rank of each
+    permuted entry inside its group. Ties are broken by the input order.
+    """
+    order = torch.sort(values, stable=True).indices
+    order = order[torch.sort(groups[order], stable=True).indices]
+    sorted_groups = groups[order]
+
+    group_sizes = torch.bincount(sorted_groups, minlength=num_groups)
+    group_start = torch.cumsum(group_sizes, dim=0) - group_sizes
+    rank = torch.arange(order.shape[0], device=order.device) - group_start[sorted_groups]
+    return order, rank
+
+
+def clip_edges_per_graph(
+    edge_index: torch.Tensor, pos: torch.Tensor, batch: torch.Tensor, budgets: torch.Tensor
+) -> torch.Tensor:
+    """Keeps the `budgets[g]` shortest edges of every graph g.
+
+    Edges are ranked by length inside their own graph, so a dense protein can't consume the budget of the other
+    proteins in the batch. Ties are broken by the input order of the edges.
+    """
+    src, dst = edge_index
+    edge_dist = (pos[src] - pos[dst]).norm(dim=-1)
+    edge_graph = batch[dst]
+    order, rank = rank_in_groups(edge_dist, edge_graph, budgets.shape[0])
+    keep = order[rank < budgets.to(order.device)[edge_graph[order]]]
+    return edge_index[:, keep]
+
+
+def cap_in_degree(edge_index: torch.Tensor, pos: torch.Tensor, max_degree: int) -> torch.Tensor:
+    """Keeps at most the `max_degree` shortest incoming edges of every node."""
+    src, dst = edge_index
+    edge_dist = (pos[src] - pos[dst]).norm(dim=-1)
+    order, rank = rank_in_groups(edge_dist, dst, pos.shape[0])
+    return edge_index[:, order[rank < max_degree]]
+
+
+def filter_by_residue_distance(
+    edge_index: torch.Tensor, res_idx: torch.Tensor, min_dist: int, max_dist: Optional[int] = None
+) -> torch.Tensor:
+    """Keeps the edges between residues separated by `min_dist <= |i - j| <= max_dist` in the sequence."""
+    residue_distances = (res_idx[edge_index[0]] - res_idx[edge_index[1]]).abs()
+    mask = residue_distances >= min_dist
+    if max_dist is not None:
+        mask = mask & (residue_distances <= max_dist)
+    return edge_index[:, mask]
+
+
+def per_graph_edge_budgets(batch: torch.Tensor, num_graphs: int, max_squared_res_ratio: float) -> torch.Tensor:
+    """Edge budget of each graph, proportional to its own squared number of nodes."""
+    num_nodes = torch.bincount(batch, minlength=num_graphs).to(torch.float64)
+    return torch.floor(max_squared_res_ratio * num_nodes**2).to(torch.long)
+
+
+def connect_isolated_nodes(edge_index: torch.Tensor, pos: torch.Tensor, batch: torch.Tensor) -> torch.Tensor:
+    """Connects every node without incoming edges to its nearest neighbour (ignoring any residue constraint)."""
+    num_nodes = pos.shape[0]
+    isolated = torch.bincount(edge_index[1], minlength=num_nodes) == 0
+    extra_edges = knn_graph(pos, k=1, batch=batch)
+    extra_edges = extra_edges[:, isolated[extra_edges[1]]]
+    return torch.cat([edge_index, extra_edges], dim=1)
+
+
+def build_graph(
+    data: Batch, max_edges: Union[int, float, torch.Tensor], min_residue_distance: int, radius: float, k: int
+):
+    """Builds the edges of a batch of CA graphs without leaving the device of `data`.
+
+    The graph is the union of the radius and kNN graphs without the edges between residues closer than
+    `min_residue_distance` in the sequence. If a graph has more edges than its budget, only its shortest edges are kept.
+    Isolated nodes are connected to their nearest neighbour afterwards.
+
+    Args:
+        data: batch of graphs with `pos`, `res_idx` and `batch` attributes.
+        max_edges: either a total edge budget for the batch, which is split between the graphs proportionally to their
+            squared number of nodes, or a [num_graphs] tensor with the edge budget of each graph.
+        min_residue_distance: minimum sequence separation between connected residues.
+        radius: radius of the radius graph.
+        k: number of neighbours of the kNN graph.
+
+    Returns:
+        [2, E] edge index.
+    """
+    num_nodes = data.num_nodes
+    batch = data.batch if data.batch is not None else torch.zeros_like(data.res_idx)
+    num_graphs = data.num_graphs if data.batch is not None else 1
+
+    # Create initial graph using radius and kNN with residue distance filtering
+    edge_index_radius = radius_graph(data.pos, r=radius, batch=batch)
+    edge_index_knn = knn_graph(data.pos, k=k, batch=batch)
+
+    edge_index = torch.cat([edge_index_radius, edge_index_knn], dim=1)
+    edge_index = filter_by_residue_distance(edge_index, data.res_idx, min_residue_distance)
+    edge_index = dedup_edges(edge_index, num_nodes)
+
+    # Clip every graph to its own edge budget.
+    if torch.is_tensor(max_edges):
+        budgets = max_edges.to(device=edge_index.device, dtype=torch.long)
+    else:
+        budgets = edge_budgets_from_total(max_edges, batch, num_graphs)
+    edge_index = clip_edges_per_graph(edge_index, data.pos, batch, budgets)
+
+    # If there are isolated nodes, connect them to their nearest neighbor (ignoring residue constraint)
+    return connect_isolated_nodes(edge_index, data.pos, batch)
+
+
+def build_graph_from_config(data: Batch, conf: GraphConfig) -> torch.Tensor:
+    """Builds the edges of a batch of CA graphs following the construction policy given by `conf`.
+
+    The radius and kNN edges are filtered by sequence separation independently. The radius edges of each node are
+    capped to its `radius_max_num_neighbors` closest neighbours and every graph is clipped to its own edge budget of
+    `max_squared_res_ratio * num_nodes**2` edges. Isolated nodes are connected to their nearest neighbour afterwards.
+
+    Args:
+        data: batch of graphs with `pos`, `res_idx` and `batch` attributes, and optionally `max_num_nodes`, an upper
+            bound of the number of nodes of a graph. Defaults to the total number of nodes.
+        conf: graph construction policy.
+
+    Returns:
+        [2, E] edge index.
+    """
+    batch = data.batch if data.batch is not None else torch.zeros_like(data.res_idx)
+    num_graphs = data.num_graphs if data.batch is not None else 1
+
+    # Radius edges. `radius_graph` keeps an arbitrary subset of the neighbours beyond `max_num_neighbors`, so the full
+    # radius graph is queried, with a bound no node can reach, and the closest neighbours are kept afterwards. The bound
+    # is known on the host, e.g. the padded length of `dense_to_graph_batch`, so that it doesn't sync with the device.
+    max_graph_size = getattr(data, "max_num_nodes", None) or data.num_nodes
+    edge_index_radius = radius_graph(data.pos, r=conf.radius_r, batch=batch, max_num_neighbors=max_graph_size)
+    edge_index_radius = filter_by_residue_distance(
+        edge_index_radius, data.res_idx, conf.radius_min_dist, conf.radius_max_dist
+    )
+    edge_index_radius = cap_in_degree(edge_index_radius, data.pos, conf.radius_max_num_neighbors)
+
+    # kNN edges.
+    edge_index_knn = knn_graph(data.pos, k=conf.knn_k, batch=batch)
+    edge_index_knn = filter_by_residue_distance(edge_index_knn, data.res_idx, conf.knn_min_dist, conf.knn_max_dist)
+
+    edge_index = dedup_edges(torch.cat([edge_index_radius, edge_index_knn], dim=1), data.num_nodes)
+
+    # Clip every graph to its own edge budget.
+    budgets = per_graph_edge_budgets(batch, num_graphs, conf.max_squared_res_ratio)
+    edge_index = clip_edges_per_graph(edge_index, data.pos, batch, budgets)
+
+    return connect_isolated_nodes(edge_index, data.pos, batch)
+
+
+def build_graph_legacy(data: Batch, max_edges: int, min_residue_distance: int, radius: float, k: int):
+    """Original graph builder with a global edge budget and clipping done in Python. Kept for benchmarking."""
     num_nodes = data.num_nodes
     device = data.pos.device
 
@@ -0,0 +1,151 @@
+"""Verlet neighbour lists for the CA graph of the MACE encoder.
+
+During inference the CA positions change little between consecutive integration steps, so the graph can be
+recomputed from a superset of candidate edges instead of running the radius and kNN searches from scratch.
+The candidate list is built with a skin margin around the graph cutoffs and is reused until some residue has
+moved by more than half of the skin since the list was built.
+"""
+
+import logging
+from typing import Optional
+
+import torch
+from torch_cluster import knn_graph
+from torch_geometric.data import Batch
+
+from foldflow.utils.graph_helpers import (
+    GraphConfig,
+    build_graph_from_config,
+    cap_in_degree,
+    clip_edges_per_graph,
+    dedup_edges,
+    filter_by_residue_distance,
+    per_graph_edge_budgets,
+    rank_in_groups,
+)
+
+
+def graph_from_candidates(
+    candidates: torch.Tensor,
+    pos: torch.Tensor,
+    res_idx: torch.Tensor,
+    batch: torch.Tensor,
+    num_graphs: int,
+    conf: GraphConfig,
+) -> torch.Tensor:
+    """Applies the graph construction policy of `build_graph_from_config` to a set of candidate edges.
+
+    The result is the graph `build_graph_from_config` would build from scratch, as long as `candidates` contains
+    the radius neighbours, the `knn_k` nearest neighbours and the nearest neighbour of every node.
+    """
+    src, dst = candidates
+    edge_dist = (pos[src] - pos[dst]).norm(dim=-1)
+
+    # Radius edges, capped to the closest `radius_max_num_neighbors` per node.
+    edge_index_radius = candidates[:, edge_dist <= conf.radius_r]
+    edge_index_radius = filter_by_residue_distance(
+        edge_index_radius, res_idx, conf.radius_min_dist, conf.radius_max_dist
+    )
+    edge_index_radius = cap_in_degree(edge_index_radius, pos, conf.radius_max_num_neighbors)
+
+    # kNN edges are the closest candidates of every node.
+    order, rank = rank_in_groups(edge_dist, dst, pos.shape[0])
+    edge_index_knn = candidates[:, order[rank < conf.knn_k]]
+    edge_index_knn = filter_by_residue_distance(edge_index_knn, res_idx, conf.knn_min_dist, conf.knn_max_dist)
+
+    edge_index = dedup_edges(torch.cat([edge_index_radius, edge_index_knn], dim=1), pos.shape[0])
+    budgets = per_graph_edge_budgets(batch, num_graphs, conf.max_squared_res_ratio)
+    edge_index = clip_edges_per_graph(edge_index, pos, batch, budgets)
+
+    # Connect isolated nodes to their nearest neighbour.
+    isolated = torch.bincount(edge_index[1], minlength=pos.shape[0]) == 0
+    nearest = candidates[:, order[rank == 0]]
+    return torch.cat([edge_index, nearest[:, isolated[nearest[1]]]], dim=1)
+
+
+class VerletGraphCache:
+    """Reuses the candidate edges of the MACE graph across calls with slowly moving positions.
+
+    For a node i with k-th nearest neighbour at distance d_k(i) when the list is built, every node closer than
+    `max(radius_r, d_k(i) + skin) + skin` is stored as a candidate. As long as no node has moved by more than
+    `skin / 2`, no pair of nodes has moved closer by more than `skin`, so the candidates still contain all the radius
+    and kNN neighbours and the graph computed from them is exact.
+
+    Args:
+        conf: graph construction policy.
+        skin: skin margin in Angstroms.
+        max_num_neighbors: maximum number of candidates per node. If a node has that many neighbours within its
+            cutoff, its candidate list may be incomplete, so the graph is built from scratch and the list is not cached.
+    """
+
+    def __init__(self, conf: GraphConfig, skin: float, max_num_neighbors: int = 64):
+        self.conf = conf
+        self.skin = skin
+        self.max_num_neighbors = max_num_neighbors
+        self._log = logging.getLogger(__name__)
+        self.num_hits = 0
+        self.num_misses = 0
+        self.reset()
+
+    def reset(self):
+        """Drops the cached candidate list, e.g. at the start of a new trajectory."""
+        self._candidates: Optional[torch.Tensor] = None
+        self._ref_pos: Optional[torch.Tensor] = None
+        self._ref_batch: Optional[torch.Tensor] = None
+        self._ref_res_idx: Optional[torch.Tensor] = None
+
+    @property
+    def hit_rate(self) -> float:
+        num_calls = self.num_hits + self.num_misses
+        return self.num_hits / num_calls if num_calls > 0 else 0.0
+
+    def stats(self):
+        return {"hits": self.num_hits, "misses": self.num_misses, "hit_rate": self.hit_rate}
+
+    def _is_valid(self, data: Batch, batch: torch.Tensor) -> bool:
+        if self._candidates is None or self._ref_pos.shape != data.pos.shape:
+            return False
+        if not (torch.equal(self._ref_batch, batch) and torch.equal(self._ref_res_idx, data.res_idx)):
+            return False
+        max_displacement = (data.pos - self._ref_pos).norm(dim=-1).max()
+        return bool(max_displacement <= 0.5 * self.skin)
+
+    def _build_candidates(self, pos: torch.Tensor, batch: torch.Tensor) -> Optional[torch.Tensor]:
+        num_nodes = pos.shape[0]
+        candidates = knn_graph(pos, k=self.max_num_neighbors, batch=batch)
+        cand_dist = (pos[candidates[0]] - pos[candidates[1]]).norm(dim=-1)
+
+        # Distance to the k-th nearest neighbour of every node (or the farthest one in small graphs).
+        order, rank = rank_in_groups(cand_dist, candidates[1], num_nodes)
+        is_knn = rank < self.conf.knn_k
+        dist_k = torch.zeros(num_nodes, dtype=pos.dtype, device=pos.device)
+        dist_k = dist_k.scatter_reduce(
+            0, candidates[1, order[is_knn]], cand_dist[order[is_knn]], reduce="amax", include_self=True
+        )
+        cutoff = torch.clamp(dist_k + self.skin, min=self.conf.radius_r) + self.skin
+
+        # The list of a node is complete only if some of its nearest neighbours fall outside of its cutoff.
+        within_cutoff = cand_dist <= cutoff[candidates[1]]
+        if torch.bincount(candidates[1, within_cutoff], minlength=num_nodes).max() >= self.max_num_neighbors:
+            return None
+        return candidates[:, within_cutoff]
+
+    def __call__(self, data: Batch) -> torch.Tensor:
+        batch = data.batch if data.batch is not None else torch.zeros_like(data.res_idx)
+        num_graphs = data.num_graphs if data.batch is not None else 1
+
+        if self._is_valid(data, batch):
+            self.num_hits += 1
+        else:
+            self.num_misses += 1
+            self.reset()
+            candidates = self._build_candidates(data.pos, batch)
+            if candidates is None:
+                self._log.debug("Too many candidate neighbours, building the graph without the Verlet list.")
+                return build_graph_from_config(data, self.conf)
+            self._candidates = candidates
+            self._ref_pos = data.pos.detach().clone()
+            self._ref_batch = batch.clone()
+            self._ref_res_idx = data.res_idx.clone()
+
+        return graph_from_candidates(self._candidates, data.pos, data.res_idx, batch, num_graphs, self.conf)
@@ -0,0 +1,75 @@
+"""Cache of the step-invariant features of a sampling trajectory.
+
+During inference the model is called once per integration step with the same residue indices and masks, only the
+time, the frames and the self-conditioning positions change. The features computed from the former only, such as the
+sinusoidal embeddings of the residue indices and of their relative offsets, are computed at the first step of a
+trajectory and reused at the following ones.
+"""
+
+from typing import Callable, Dict, Optional
+
+import torch
+
+
+class StepInvariantCache:
+    """Features of a sampling trajectory that don't depend on the integration time.
+
+    The cache is tied to the tensors passed to `check`, typically the residue indices and the residue and fixed masks.
+    When one of them differs from the previous call, e.g. when the motif of a scaffolding problem changes, all the
+    features are dropped. The features may also depend on the model weights, so the cache is only read without
+    autograd and should be reset at the start of every trajectory.
+    """
+
+    def __init__(self):
+        self.num_hits = 0
+        self.num_misses = 0
+        self.reset()
+
+    def reset(self):
+        """Drops the cached features, e.g. at the start of a new trajectory."""
+        self._features: Dict[str, torch.Tensor] = {}
+        self._ref_inputs: Dict[str, torch.Tensor] = {}
+
+    def __len__(self) -> int:
+        return len(self._features)
+
+    @property
+    def hit_rate(self) -> float:
+        num_calls = self.num_hits + self.num_misses
+        return self.num_hits / num_calls if num_calls > 0 else 0.0
+
+    def stats(self):
+        return {"hits": self.num_hits, "misses": self.num_misses, "hit_rate": self.hit_rate, "entries": len(self)}
+
+    def check(self, **inputs: torch.Tensor):
+        """Drops the cached features unless `inputs` are the same as in the previous call."""
+        is_valid = self._ref_inputs.keys() == inputs.keys() and all(
+            self._ref_inputs[name].shape == value.shape and torch.equal(self._ref_inputs[name], value)
+            for name, value in inputs.items()
+        )
+        if not is_valid:
+            self.reset()
+            self._ref_inputs = {name: value.detach().clone() for name, value in inputs.items()}
+
+    def get(self, name: str, compute_fn: Callable[[], torch.Tensor]) -> torch.Tensor:
+        """Cached feature `name`, computed with `compute_fn` if it is missing.
+
+        Nothing is cached with autograd enabled, nor before the first call to `check`.
+        """
+        if torch.is_grad_enabled() or not self._ref_inputs:
+            return compute_fn()
+        if name in self._features:
+            self.num_hits += 1
+            return self._features[name]
+        self.num_misses += 1
+        self._features[name] = compute_fn()
+        return self._features[name]
+
+
+def get_or_compute(
+    cache: Optional[StepInvariantCache], name: str, compute_fn: Callable[[], torch.Tensor]
+) -> torch.Tensor:
+    """`cache.get(name, compute_fn)`, or `compute_fn()` without a cache."""
+    if cache is None:
+        return compute_fn()
+    return cache.get(name, compute_fn)
@@ -123,6 +123,10 @@ class Sampler:
             self.exp = train.Experiment(conf=self._conf, weights_pkl=weights_pkl)
             self.flow_matcher = self.exp.flow_matcher
             self.model = self.exp.model
+            esm_all_mask_dir = self._infer_conf.get("esm_all_mask_dir", None)
+            if esm_all_mask_dir is None:
+                esm_all_mask_dir = os.path.join(os.path.dirname(os.path.abspath(self._weights_path)), "esm_all_mask")
+            self.model.set_all_mask_esm_dir(esm_all_mask_dir)
         self.model = self.model.to(self.device)
         self.model.eval()
         self._folding_model = esm.pretrained.esmfold_v1().eval()
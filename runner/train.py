@@ -33,6 +33,7 @@ from foldflow.models import se3_fm
 from foldflow.models.components import network
 from foldflow.models.ff2flow.flow_model import FF2Model
 from foldflow.models.ff2flow.ff2_dependencies import FF2Dependencies
+from foldflow.utils import frames as fu
 from openfold.utils import rigid_utils as ru
 from tools.analysis import metrics
 from tools.analysis import utils as au
@@ -257,6 +258,8 @@ class Experiment:
             reg=self._fm_conf.reg,
             is_training=False,
         )
+        if train_dataset.esm_store is not None:
+            train_dataset.esm_store.check_model_key(self._model_conf.esm2_model_key)
         if self._use_ddp:
             train_sampler = pdb_data_loader.DistributedTrainSampler(
                 data_conf=self._data_conf,
@@ -897,10 +900,17 @@ class Experiment:
         reverse_steps = np.linspace(min_t, 1.0, num_t)[::-1]
         dt = reverse_steps[0] - reverse_steps[1]
         # dt = 1/num_t
-        all_rigids = [du.move_to_np(copy.deepcopy(sample_feats["rigids_t"]))]
+        # The trajectories stay on the device until the end of the sampling.
+        all_rigids = [sample_feats["rigids_t"].clone()]
         all_bb_prots = []
         all_trans_0_pred = []
         all_bb_0_pred = []
+        if hasattr(self.model, "reset_graph_cache"):
+            # A new trajectory can't reuse the MACE neighbour list of the previous one.
+            self.model.reset_graph_cache()
+        if hasattr(self.model, "reset_step_cache"):
+            # Nor its step-invariant features, the residues or the model weights may have changed.
+            self.model.reset_step_cache()
         with torch.no_grad():
             if self._model_conf.embed.embed_self_conditioning and self_condition:
                 sample_feats = self._set_t_feats(sample_feats, reverse_steps[0], t_placeholder)
@@ -916,20 +926,23 @@ class Experiment:
                     sample_feats["sc_ca_t"] = rigid_pred[..., 4:]
                 fixed_mask = sample_feats["fixed_mask"] * sample_feats["res_mask"]
                 flow_mask = (1 - sample_feats["fixed_mask"]) * sample_feats["res_mask"]
-                rots_t, trans_t, rigids_t = self.flow_matcher.reverse(
-                    rigid_t=ru.Rigid.from_tensor_7(sample_feats["rigids_t"]),
-                    rot_vectorfield=du.move_to_np(rot_vectorfield),
-                    trans_vectorfield=du.move_to_np(trans_vectorfield),
-                    flow_mask=du.move_to_np(flow_mask),
+                frames_t = fu.frames_from_tensor_7(sample_feats["rigids_t"])
+                rots_t, trans_t = self.flow_matcher.reverse_torch(
+                    rot_t=frames_t.rot_mats,
+                    trans_t=frames_t.trans,
+                    rot_vectorfield=rot_vectorfield,
+                    trans_vectorfield=trans_vectorfield,
+                    flow_mask=flow_mask,
                     t=t,
                     dt=dt,
                     center=center,
                     noise_scale=noise_scale,
                 )
+                frames_t = fu.frames_from_rot_mats(rots_t, trans_t)
 
-                sample_feats["rigids_t"] = rigids_t.to_tensor_7().to(device)
+                sample_feats["rigids_t"] = fu.frames_to_tensor_7(frames_t)
                 if aux_traj:
-                    all_rigids.append(du.move_to_np(rigids_t.to_tensor_7()))
+                    all_rigids.append(sample_feats["rigids_t"])
 
                 # Calculate x0 prediction derived from vectorfield predictions.
                 gt_trans_0 = sample_feats["rigids_t"][..., 4:]
@@ -938,15 +951,28 @@ class Experiment:
                 trans_pred_0 = flow_mask[..., None] * pred_trans_0 + fixed_mask[..., None] * gt_trans_0
                 psi_pred = model_out["psi"]
                 if aux_traj:
-                    atom37_0 = all_atom.compute_backbone(ru.Rigid.from_tensor_7(rigid_pred), psi_pred)[0]
-                    all_bb_0_pred.append(du.move_to_np(atom37_0))
-                    all_trans_0_pred.append(du.move_to_np(trans_pred_0))
-                atom37_t = all_atom.compute_backbone(rigids_t, psi_pred)[0]  # take only positions of the bb atoms
-                all_bb_prots.append(du.move_to_np(atom37_t))
+                    atom37_0 = all_atom.compute_backbone(fu.frames_from_tensor_7(rigid_pred), psi_pred)[0]
+                    all_bb_0_pred.append(atom37_0)
+                    all_trans_0_pred.append(trans_pred_0)
+                atom37_t = all_atom.compute_backbone(frames_t, psi_pred)[0]  # take only positions of the bb atoms
+                all_bb_prots.append(atom37_t)
+
+        graph_cache = getattr(self.model, "graph_cache", None)
+        if graph_cache is not None:
+            self._log.debug(f"MACE neighbour list reuse: {graph_cache.stats()}")
+        seq_encoder = getattr(self.model, "seq_encoder", None)
+        if seq_encoder is not None and hasattr(seq_encoder, "cache"):
+            self._log.debug(f"ESM output cache: {seq_encoder.cache.stats()}")
+        step_cache = getattr(self.model, "step_cache", None)
+        if step_cache is not None:
+            self._log.debug(f"Step-invariant features: {step_cache.stats()}")
+        all_mask_esm_table = getattr(self.model, "all_mask_esm_table", None)
+        if all_mask_esm_table is not None:
+            self._log.debug(f"All-mask ESM table: {all_mask_esm_table.stats()}")
 
         # Flip trajectory so that it starts from t=0.
         # This helps visualization.
-        flip = lambda x: np.flip(np.stack(x), axis=(0,))
+        flip = lambda x: np.flip(du.move_to_np(torch.stack(x)), axis=(0,))
         all_bb_prots = flip(all_bb_prots)
         if aux_traj:
             all_rigids = flip(all_rigids)
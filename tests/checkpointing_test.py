@@ -0,0 +1,111 @@
+import os
+
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+from foldflow.models.components.ipa_pytorch import IpaNetwork
+from foldflow.models.ff2flow.trunk import FF2TrunkBlockConfig, FF2TrunkTransformer
+from foldflow.models.se3_fm import SE3FlowMatcher
+from foldflow.utils.checkpointing import CHECKPOINTING_POLICIES
+
+FLOW_MATCHER_CONFIG = os.path.join(os.path.dirname(__file__), "..", "runner", "config", "flow_matcher", "default.yaml")
+
+
+def _ipa_model_conf(checkpointing):
+    return OmegaConf.create(
+        {
+            "node_embed_size": 32,
+            "edge_embed_size": 16,
+            "ipa": {
+                "c_s": 32,
+                "c_z": 16,
+                "c_hidden": 8,
+                "c_skip": 8,
+                "no_heads": 2,
+                "no_qk_points": 2,
+                "no_v_points": 4,
+                "seq_tfmr_num_heads": 4,
+                "seq_tfmr_num_layers": 1,
+                "num_blocks": 2,
+                "coordinate_scaling": 0.1,
+                "checkpointing": checkpointing,
+            },
+        }
+    )
+
+
+def _randomize_zero_weights(model):
+    # The final layers are zero-initialized, which would leave the gradients of the earlier ones at zero.
+    with torch.no_grad():
+        for param in model.parameters():
+            if (param == 0).all():
+                param.normal_(0.0, 0.1)
+
+
+def _grads(model):
+    return {name: param.grad for name, param in model.named_parameters() if param.grad is not None}
+
+
+def test_ipa_network_checkpointing_matches_none():
+    torch.manual_seed(0)
+    flow_matcher = SE3FlowMatcher(OmegaConf.load(FLOW_MATCHER_CONFIG))
+    num_batch, num_res = 2, 12
+    res_mask = torch.ones(num_batch, num_res)
+    res_mask[1, 9:] = 0.0
+    quats = torch.nn.functional.normalize(torch.randn(num_batch, num_res, 4), dim=-1)
+    input_feats = {
+        "res_mask": res_mask,
+        "fixed_mask": (torch.rand(num_batch, num_res) > 0.8).float(),
+        "rigids_t": torch.cat([quats, 10.0 * torch.randn(num_batch, num_res, 3)], dim=-1),
+        "t": torch.rand(num_batch),
+    }
+    node_embed = torch.randn(num_batch, num_res, 32)
+    edge_embed = torch.randn(num_batch, num_res, num_res, 16)
+
+    losses, grads, state_dict = {}, {}, None
+    for policy in CHECKPOINTING_POLICIES:
+        model = IpaNetwork(_ipa_model_conf(policy), flow_matcher)
+        if state_dict is None:
+            _randomize_zero_weights(model)
+            state_dict = model.state_dict()
+        model.load_state_dict(state_dict)
+        model_out = model(node_embed, edge_embed, {k: v.clone() for k, v in input_feats.items()})
+        loss = sum(model_out[k].square().sum() for k in ("rot_vectorfield", "trans_vectorfield", "psi"))
+        loss.backward()
+        losses[policy], grads[policy] = loss.detach(), _grads(model)
+
+    for policy in CHECKPOINTING_POLICIES[1:]:
+        torch.testing.assert_close(losses[policy], losses["none"])
+        assert grads[policy].keys() == grads["none"].keys()
+        for name, grad in grads["none"].items():
+            torch.testing.assert_close(grads[policy][name], grad, atol=1e-5, rtol=1e-5)
+
+
+@pytest.mark.parametrize("policy", CHECKPOINTING_POLICIES[1:])
+def test_trunk_checkpointing_matches_none(policy):
+    torch.manual_seed(0)
+    block_config = dict(sequence_state_dim=32, pairwise_state_dim=16, sequence_head_width=8, pairwise_head_width=8)
+    reference = FF2TrunkTransformer(num_blocks=2, block_config=FF2TrunkBlockConfig(**block_config))
+    _randomize_zero_weights(reference)
+    model = FF2TrunkTransformer(num_blocks=2, block_config=FF2TrunkBlockConfig(**block_config, checkpointing=policy))
+    model.load_state_dict(reference.state_dict())
+
+    num_batch, num_res = 2, 10
+    single = torch.randn(num_batch, num_res, 32)
+    pair = torch.randn(num_batch, num_res, num_res, 16)
+    mask = torch.ones(num_batch, num_res)
+    mask[1, 7:] = 0.0
+    losses = []
+    for trunk in (reference, model):
+        single_out, pair_out = trunk(single, pair, mask)
+        loss = single_out.square().sum() + pair_out.square().sum()
+        loss.backward()
+        losses.append(loss.detach())
+
+    torch.testing.assert_close(losses[1], losses[0])
+    expected = _grads(reference)
+    actual = _grads(model)
+    assert actual.keys() == expected.keys()
+    for name, grad in expected.items():
+        torch.testing.assert_close(actual[name], grad, atol=1e-5, rtol=1e-5)
@@ -0,0 +1,50 @@
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+from foldflow.models.components.network import Embedder
+
+
+def _model_conf(factorized_edge_embedder, embed_self_conditioning):
+    return OmegaConf.create(
+        {
+            "node_embed_size": 32,
+            "edge_embed_size": 16,
+            "embed": {
+                "index_embed_size": 8,
+                "embed_self_conditioning": embed_self_conditioning,
+                "num_bins": 22,
+                "min_bin": 1e-5,
+                "max_bin": 20.0,
+                "factorized_edge_embedder": factorized_edge_embedder,
+            },
+        }
+    )
+
+
+@pytest.mark.parametrize("embed_self_conditioning", [True, False])
+def test_factorized_edge_embed_matches_concatenated(embed_self_conditioning):
+    torch.manual_seed(0)
+    concatenated = Embedder(_model_conf(False, embed_self_conditioning))
+    factorized = Embedder(_model_conf(True, embed_self_conditioning))
+    factorized.load_state_dict(concatenated.state_dict())
+
+    num_batch, num_res = 2, 10
+    # Chain breaks, so that some relative offsets are repeated and some are not.
+    seq_idx = torch.cumsum(torch.randint(1, 4, (num_batch, num_res)), dim=-1)
+    inputs = dict(
+        seq_idx=seq_idx,
+        t=torch.rand(num_batch),
+        fixed_mask=(torch.rand(num_batch, num_res) > 0.7).float(),
+        self_conditioning_ca=10.0 * torch.randn(num_batch, num_res, 3),
+    )
+    node_expected, edge_expected = concatenated(**inputs)
+    node_actual, edge_actual = factorized(**inputs)
+    torch.testing.assert_close(node_actual, node_expected)
+    torch.testing.assert_close(edge_actual, edge_expected, atol=1e-5, rtol=1e-5)
+
+    edge_expected.square().sum().backward()
+    edge_actual.square().sum().backward()
+    expected_params = dict(concatenated.edge_embedder.named_parameters())
+    for name, actual in factorized.edge_embedder.named_parameters():
+        torch.testing.assert_close(actual.grad, expected_params[name].grad, atol=1e-4, rtol=1e-4)
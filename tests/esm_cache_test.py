@@ -0,0 +1,51 @@
+import torch
+
+from foldflow.models.components.sequence.esm_cache import LRUTensorCache
+
+
+def _entry(num_floats):
+    return torch.zeros(num_floats, dtype=torch.float32), None
+
+
+def test_lru_cache_is_bounded_by_bytes():
+    cache = LRUTensorCache(max_bytes=3 * 4 * 10)
+    for key in "abc":
+        cache.put(key, _entry(10))
+    assert len(cache) == 3 and cache.num_bytes == 120
+
+    cache.put("d", _entry(10))
+    assert len(cache) == 3 and cache.num_bytes == 120
+    assert "a" not in cache
+
+    # A larger entry evicts as many entries as needed.
+    cache.put("e", _entry(20))
+    assert list(cache._entries) == ["d", "e"] and cache.num_bytes == 120
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUTensorCache(max_bytes=3 * 4 * 10)
+    for key in "abc":
+        cache.put(key, _entry(10))
+    assert cache.get("a") is not None
+    cache.put("d", _entry(10))
+    assert "b" not in cache and "a" in cache
+
+    # Putting an existing key refreshes it and replaces its size.
+    cache.put("c", _entry(5))
+    cache.put("e", _entry(10))
+    assert list(cache._entries) == ["d", "c", "e"]
+    assert cache.num_bytes == 4 * (10 + 5 + 10)
+
+
+def test_lru_cache_keeps_the_last_entry_and_counts_hits():
+    cache = LRUTensorCache(max_bytes=16)
+    cache.put("a", _entry(10))
+    assert len(cache) == 1 and cache.num_bytes == 40
+    cache.put("b", _entry(10))
+    assert list(cache._entries) == ["b"]
+
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+    assert cache.stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5, "entries": 1, "bytes": 40}
+    cache.clear()
+    assert len(cache) == 0 and cache.num_bytes == 0
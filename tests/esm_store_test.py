@@ -0,0 +1,69 @@
+import pytest
+import torch
+
+from foldflow.data.esm_store import EsmEmbeddingStore, EsmEmbeddingStoreWriter, esm_store_key
+
+SINGLE_SHAPE, PAIR_DIM = (3, 8), 6
+
+
+def _chain(num_res, seed):
+    generator = torch.Generator().manual_seed(seed)
+    aatype = torch.randint(0, 20, (num_res,), generator=generator)
+    single = torch.randn(num_res, *SINGLE_SHAPE, generator=generator)
+    pair = torch.randn(num_res, num_res, PAIR_DIM, generator=generator)
+    return aatype, single, pair
+
+
+def test_esm_store_round_trip(tmp_path):
+    writer = EsmEmbeddingStoreWriter(str(tmp_path), "esm2_650M", SINGLE_SHAPE, PAIR_DIM)
+    chains = {}
+    for seed, num_res in enumerate([5, 9, 3]):
+        aatype, single, pair = _chain(num_res, seed)
+        key = esm_store_key(aatype, torch.ones(num_res))
+        writer.add(key, single, pair)
+        chains[key] = (single, pair)
+    writer.flush()
+
+    store = EsmEmbeddingStore(str(tmp_path))
+    assert len(store) == 3 and store.model_key == "esm2_650M" and store.has_pair
+    for key, (single, pair) in chains.items():
+        stored_single, stored_pair = store.get(key)
+        assert stored_single.dtype == torch.float16
+        torch.testing.assert_close(stored_single.float(), single.half().float())
+        torch.testing.assert_close(stored_pair.float(), pair.half().float())
+    assert store.get("missing") is None
+
+
+def test_esm_store_key_ignores_masked_residue_types():
+    aatype, res_mask = torch.tensor([3, 5, 7]), torch.tensor([1.0, 1.0, 0.0])
+    assert esm_store_key(aatype, res_mask) == esm_store_key(torch.tensor([3, 5, 11]), res_mask)
+    assert esm_store_key(aatype, res_mask) != esm_store_key(aatype, torch.ones(3))
+
+
+def test_esm_store_resume_drops_unflushed_entries(tmp_path):
+    writer = EsmEmbeddingStoreWriter(str(tmp_path), "esm2_650M", SINGLE_SHAPE, PAIR_DIM)
+    _, single, pair = _chain(4, seed=0)
+    writer.add("flushed", single, pair)
+    writer.flush()
+    writer.add("interrupted", *_chain(7, seed=1)[1:])
+
+    writer = EsmEmbeddingStoreWriter(str(tmp_path), "esm2_650M", SINGLE_SHAPE, PAIR_DIM)
+    assert "flushed" in writer and "interrupted" not in writer
+    _, other_single, other_pair = _chain(2, seed=2)
+    writer.add("resumed", other_single, other_pair)
+    writer.flush()
+
+    store = EsmEmbeddingStore(str(tmp_path))
+    torch.testing.assert_close(store.get("flushed")[0].float(), single.half().float())
+    torch.testing.assert_close(store.get("resumed")[1].float(), other_pair.half().float())
+
+
+def test_esm_store_rejects_another_model(tmp_path):
+    writer = EsmEmbeddingStoreWriter(str(tmp_path), "esm2_650M", SINGLE_SHAPE, PAIR_DIM)
+    writer.flush()
+    store = EsmEmbeddingStore(str(tmp_path))
+    store.check_model_key("esm2_650M")
+    with pytest.raises(ValueError, match="esm2_3B"):
+        store.check_model_key("esm2_3B")
+    with pytest.raises(ValueError, match="model_key"):
+        EsmEmbeddingStoreWriter(str(tmp_path), "esm2_3B", SINGLE_SHAPE, PAIR_DIM)
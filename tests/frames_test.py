@@ -0,0 +1,65 @@
+import torch
+from openfold.utils import feats
+from openfold.utils.rigid_utils import Rigid
+
+from foldflow.data import all_atom
+from foldflow.utils import frames as fu
+
+
+def _tensor_7(num_batch=2, num_res=16):
+    quats = torch.nn.functional.normalize(torch.randn(num_batch, num_res, 4), dim=-1)
+    return torch.cat([quats, 5.0 * torch.randn(num_batch, num_res, 3)], dim=-1)
+
+
+def test_frames_match_rigid():
+    torch.manual_seed(0)
+    t = _tensor_7()
+    rigid = Rigid.from_tensor_7(t)
+    frames = fu.frames_from_tensor_7(t)
+    torch.testing.assert_close(frames.rot_mats, rigid.get_rots().get_rot_mats())
+
+    pts = torch.randn(*t.shape[:-1], 4, 5, 3)
+    torch.testing.assert_close(fu.apply(frames, pts), rigid[..., None, None].apply(pts))
+    torch.testing.assert_close(fu.invert_apply(frames, pts), rigid[..., None, None].invert_apply(pts))
+
+    update = 0.1 * torch.randn(*t.shape[:-1], 6)
+    mask = (torch.rand(*t.shape[:-1], 1) > 0.3).float()
+    expected = rigid.compose_q_update_vec(update, mask)
+    actual = fu.compose_q_update_vec(frames, update, mask)
+    torch.testing.assert_close(fu.frames_to_tensor_7(actual), expected.to_tensor_7())
+    torch.testing.assert_close(actual.rot_mats, expected.get_rots().get_rot_mats())
+
+
+def test_rot_mats_to_quats():
+    torch.manual_seed(0)
+    quats = torch.nn.functional.normalize(torch.randn(64, 4), dim=-1)
+    quats = torch.where(quats[..., :1] < 0, -quats, quats)
+    rot_mats = Rigid.from_tensor_7(torch.cat([quats, torch.zeros(64, 3)], dim=-1)).get_rots().get_rot_mats()
+    torch.testing.assert_close(fu.rot_mats_to_quats(rot_mats), quats, atol=1e-5, rtol=1e-5)
+
+
+def test_frames_scriptable():
+    torch.manual_seed(0)
+    frames = fu.frames_from_tensor_7(_tensor_7())
+    pts = torch.randn(*frames.trans.shape[:-1], 3, 3)
+    scripted = torch.jit.script(fu.apply)
+    torch.testing.assert_close(scripted(frames, pts), fu.apply(frames, pts))
+
+
+def test_compute_backbone_matches_rigid_groups():
+    torch.manual_seed(0)
+    rigid = Rigid.from_tensor_7(_tensor_7())
+    psi = torch.nn.functional.normalize(torch.randn(*rigid.shape, 2), dim=-1)
+
+    # All the rigid groups of alanine residues, as in `compute_backbone` before the frames of the backbone
+    # and psi groups were computed directly.
+    aatype = torch.zeros(rigid.shape, dtype=torch.long)
+    all_frames = feats.torsion_angles_to_frames(
+        rigid, psi[..., None, :].expand(*rigid.shape, 7, 2), aatype, all_atom.DEFAULT_FRAMES
+    )
+    expected = all_atom.frames_to_atom14_pos(all_frames, aatype)
+
+    atom37, atom37_mask, _, atom14 = all_atom.compute_backbone(rigid, psi)
+    torch.testing.assert_close(atom14, expected, atol=1e-5, rtol=1e-5)
+    torch.testing.assert_close(all_atom.compute_backbone(fu.frames_from_rigid(rigid), psi)[-1], atom14)
+    assert atom37_mask[..., :5].all() and not atom37_mask[..., 5:].any()
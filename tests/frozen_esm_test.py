@@ -0,0 +1,121 @@
+import copy
+
+import esm
+import pytest
+import torch
+from torch import nn
+
+from foldflow.models.components.sequence import frozen_esm
+from foldflow.models.components.sequence.esm_cache import AllMaskEsmTable
+
+NUM_LAYERS, HEADS = 2, 4
+LENGTHS = [30, 8, 27, 10]
+
+
+def _tiny_esm2():
+    alphabet = esm.data.Alphabet.from_architecture("ESM-1b")
+    return esm.model.esm2.ESM2(num_layers=NUM_LAYERS, embed_dim=32, attention_heads=HEADS, alphabet=alphabet), alphabet
+
+
+@pytest.fixture
+def esm_model(monkeypatch):
+    torch.manual_seed(0)
+    # A small randomly initialised ESM2, the pretrained weights are not needed to compare the readouts.
+    monkeypatch.setitem(frozen_esm.ESM_REGISTRY, "esm2_tiny", _tiny_esm2)
+    model = frozen_esm.FrozenEsmModel("esm2_tiny", backend="fp32", cache_max_bytes=0)
+    return model.eval().requires_grad_(False)
+
+
+def _inputs(lengths=LENGTHS):
+    aatype = torch.randint(0, 20, (len(lengths), max(lengths)))
+    attn_mask = (torch.arange(max(lengths))[None] < torch.tensor(lengths)[:, None]).long()
+    return dict(aa_sequence=aatype, chain_idx=torch.zeros_like(aatype), attn_mask=attn_mask, cache_last_call=False)
+
+
+def _pair_projection(c_out=8):
+    layer_norm, linear = nn.LayerNorm(NUM_LAYERS * HEADS), nn.Linear(NUM_LAYERS * HEADS, c_out)
+    nn.init.normal_(layer_norm.weight, 1.0, 0.1)
+    nn.init.normal_(layer_norm.bias, 0.0, 0.1)
+    return nn.Sequential(layer_norm, linear)
+
+
+@pytest.mark.parametrize("use_pair_projection", [False, True])
+def test_length_buckets_match_unbucketed(esm_model, use_pair_projection):
+    bucketed = copy.deepcopy(esm_model)
+    bucketed.length_bucket_min_fill = 0.75
+    # The rows are not sorted by length, so the outputs of the buckets are scattered back out of order.
+    assert frozen_esm.length_buckets([n + 2 for n in LENGTHS], 0.75) == [[0, 2], [3, 1]]
+
+    inputs = _inputs()
+    pair_projection = _pair_projection() if use_pair_projection else None
+    single_expected, pair_expected = esm_model(**inputs, pair_projection=pair_projection)
+    single_actual, pair_actual = bucketed(**inputs, pair_projection=pair_projection)
+
+    assert single_actual.shape == single_expected.shape and pair_actual.shape == pair_expected.shape
+    # ESM computes representations for the padding tokens it is given, the ones cropped from the second bucket,
+    # which is run on 10 residues, are zeros instead.
+    mask = inputs["attn_mask"].bool()
+    torch.testing.assert_close(single_actual[mask], single_expected[mask], atol=1e-5, rtol=1e-5)
+    assert (single_actual[[1, 3], 10:] == 0).all()
+    # The attention maps of the padding tokens are zeros in both, as is their projection.
+    torch.testing.assert_close(pair_actual, pair_expected, atol=1e-5, rtol=1e-5)
+
+
+def test_layer_readout_matches_stacked_representations(esm_model):
+    inputs = _inputs()
+    layer_weights = torch.softmax(torch.randn(NUM_LAYERS + 1), dim=0)
+    single_repns, _ = esm_model(**inputs)
+    assert single_repns.shape[2] == NUM_LAYERS + 1
+    single_actual, _ = esm_model(**inputs, layer_weights=layer_weights)
+    expected = frozen_esm.weighted_layer_sum(single_repns, layer_weights)
+    torch.testing.assert_close(single_actual, expected, atol=1e-5, rtol=1e-5)
+
+
+def test_streaming_pair_projection_matches_projection():
+    torch.manual_seed(0)
+    pair_projection = _pair_projection()
+    layer_norm, linear = pair_projection
+    x = torch.randn(2, 5, 5, NUM_LAYERS * HEADS)
+    readout = frozen_esm.StreamingPairProjection(layer_norm, linear, num_blocks=NUM_LAYERS)
+    for block_idx, block in enumerate(torch.split(x, HEADS, dim=-1)):
+        readout.add(block_idx, block)
+    torch.testing.assert_close(readout.result(), pair_projection(x), atol=1e-5, rtol=1e-5)
+
+
+def test_pair_readout_matches_attention_map_projection(esm_model):
+    inputs = _inputs()
+    pair_projection = _pair_projection()
+    _, attn_maps = esm_model(**inputs)
+    _, pair_actual = esm_model(**inputs, pair_projection=pair_projection)
+    torch.testing.assert_close(pair_actual, pair_projection(attn_maps), atol=1e-5, rtol=1e-5)
+
+
+def test_auto_backend_follows_device():
+    assert frozen_esm.resolve_esm_backend("auto", "cpu") == "fp32"
+    assert frozen_esm.resolve_esm_backend("auto", "cuda") == "fp16"
+
+
+def test_backend_switch_keeps_fp32_weights(esm_model):
+    fp32_state_dict = copy.deepcopy(esm_model.esm.state_dict())
+    for backend in ("fp16", "bf16", "fp32"):
+        esm_model.backend = backend
+        assert esm_model.prepare_backend("cpu") == backend
+    for name, value in esm_model.esm.state_dict().items():
+        torch.testing.assert_close(value, fp32_state_dict[name], atol=0, rtol=0)
+
+
+def test_all_mask_table_is_bounded(esm_model):
+    lengths = [10, 12, 14]
+    entry_bytes = [4 * n * (NUM_LAYERS + 1) * 32 + 4 * n * n * NUM_LAYERS * HEADS for n in lengths]
+    # Room for the last two lengths only.
+    table = AllMaskEsmTable(max_bytes=entry_bytes[1] + entry_bytes[2])
+    for num_res in lengths:
+        single, pair = table.get(esm_model, batch_size=3, num_res=num_res, device=torch.device("cpu"))
+        assert single.shape[:2] == (3, num_res) and pair.shape[:3] == (3, num_res, num_res)
+    assert len(table) == 2 and table.stats()["bytes"] <= entry_bytes[1] + entry_bytes[2]
+
+    tokens = torch.zeros(1, 12, dtype=torch.long)
+    expected = esm_model(tokens, tokens, attn_mask=torch.ones_like(tokens), seq_mask=torch.ones_like(tokens))
+    actual = table.get(esm_model, batch_size=1, num_res=12, device=torch.device("cpu"))
+    assert table.stats()["hits"] == 1
+    torch.testing.assert_close(actual, expected)
@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+from foldflow.utils.graph_helpers import (
+    GraphConfig,
+    build_graph,
+    build_graph_from_config,
+    build_graph_legacy,
+    dedup_edges,
+    dense_to_graph_batch,
+)
+
+
+@pytest.mark.parametrize("min_residue_distance", [0, 3])
+def test_build_graph_matches_legacy_without_clipping(min_residue_distance):
+    torch.manual_seed(0)
+    pos = torch.cumsum(2.2 * torch.randn(3, 48, 3), dim=1)
+    res_mask = torch.ones(pos.shape[:2])
+    res_mask[1, 30:] = 0
+    res_mask[2, 12:] = 0
+    res_idx = torch.arange(pos.shape[1]).repeat(pos.shape[0], 1)
+    data = dense_to_graph_batch(pos, res_idx, res_mask)
+    # No graph reaches its share of the budget, so neither builder clips any edge.
+    kwargs = dict(max_edges=10**9, min_residue_distance=min_residue_distance, radius=8.0, k=6)
+
+    expected = dedup_edges(build_graph_legacy(data, **kwargs), data.num_nodes)
+    actual = dedup_edges(build_graph(data, **kwargs), data.num_nodes)
+    torch.testing.assert_close(actual, expected)
+
+
+def test_radius_graph_is_not_truncated_by_the_padded_length():
+    torch.manual_seed(0)
+    # Every residue is within the radius of all the residues of its protein, so the graphs are complete.
+    pos = torch.rand(3, 20, 3)
+    res_mask = torch.ones(pos.shape[:2])
+    res_mask[1, 14:] = 0
+    res_mask[2, 5:] = 0
+    res_idx = torch.arange(pos.shape[1]).repeat(pos.shape[0], 1)
+    data = dense_to_graph_batch(pos, res_idx, res_mask)
+    assert data.max_num_nodes == 20
+    conf = GraphConfig(
+        knn_k=1, knn_min_dist=0, radius_r=10.0, radius_min_dist=0, radius_max_num_neighbors=100, max_squared_res_ratio=1
+    )
+
+    edge_index = build_graph_from_config(data, conf)
+    num_nodes = res_mask.sum(dim=-1)
+    assert edge_index.shape[1] == int((num_nodes * (num_nodes - 1)).sum())
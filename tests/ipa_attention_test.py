@@ -0,0 +1,92 @@
+import dataclasses
+
+import pytest
+import torch
+from openfold.utils.rigid_utils import Rigid
+
+from foldflow.models.components.ipa_pytorch import InvariantPointAttention, sparse_neighbours
+from foldflow.models.ff2flow.structure_network import IPAConfig
+
+IPA_CONF = IPAConfig(c_s=32, c_z=16, c_hidden=8, no_heads=4, no_qk_points=4, no_v_points=6)
+
+
+def _inputs(num_batch=2, num_res=24):
+    s = torch.randn(num_batch, num_res, IPA_CONF.c_s)
+    z = torch.randn(num_batch, num_res, num_res, IPA_CONF.c_z)
+    frames = torch.cat([torch.randn(num_batch, num_res, 4), 5.0 * torch.randn(num_batch, num_res, 3)], dim=-1)
+    r = Rigid.from_tensor_7(frames, normalize_quats=True)
+    mask = torch.ones(num_batch, num_res)
+    mask[1, 18:] = 0
+    return s, z, r, mask
+
+
+@pytest.mark.parametrize(
+    "overrides",
+    [
+        dict(attn_impl="dot_product"),
+        dict(chunk_size=5),
+        dict(chunk_size=5, key_chunk_size=7),
+    ],
+)
+def test_ipa_attention_matches_reference(overrides):
+    torch.manual_seed(0)
+    reference = InvariantPointAttention(IPA_CONF)
+    # The output layer is zero-initialized, use random weights so that the attention outputs are compared.
+    torch.nn.init.normal_(reference.linear_out.weight)
+    ipa = InvariantPointAttention(dataclasses.replace(IPA_CONF, **overrides))
+    ipa.load_state_dict(reference.state_dict())
+
+    s, z, r, mask = _inputs()
+    with torch.no_grad():
+        expected = reference(s, z, r, mask)
+        actual = ipa(s, z, r, mask)
+    torch.testing.assert_close(actual, expected, atol=1e-4, rtol=1e-4)
+
+
+def test_sparse_ipa_over_all_residues_matches_dense():
+    torch.manual_seed(0)
+    ipa = InvariantPointAttention(dataclasses.replace(IPA_CONF, num_neighbours=24))
+    torch.nn.init.normal_(ipa.linear_out.weight)
+
+    s, z, r, mask = _inputs()
+    # Every residue attends to all the residues, in a shuffled order.
+    neighbour_idx = torch.argsort(torch.rand(z.shape[:3]), dim=-1)
+    sparse_z = torch.gather(z, 2, neighbour_idx[..., None].expand(-1, -1, -1, z.shape[-1]))
+    with torch.no_grad():
+        expected = ipa(s, z, r, mask)
+        actual = ipa(s, sparse_z, r, mask, neighbour_idx=neighbour_idx)
+    torch.testing.assert_close(actual, expected, atol=1e-4, rtol=1e-4)
+
+
+def test_sparse_neighbours_keep_chain_window():
+    torch.manual_seed(0)
+    num_batch, num_res, num_neighbours, seq_window = 2, 40, 12, 3
+    pos = 10.0 * torch.randn(num_batch, num_res, 3)
+    mask = torch.ones(num_batch, num_res)
+    mask[1, 30:] = 0
+    # A chain break after residue 20 of the first protein.
+    seq_idx = torch.arange(num_res).repeat(num_batch, 1)
+    seq_idx[0, 20:] += 100
+
+    neighbour_idx = sparse_neighbours(pos, mask, num_neighbours, seq_window, seq_idx)
+    assert neighbour_idx.shape == (num_batch, num_res, num_neighbours)
+    for b in range(num_batch):
+        for i in range(num_res):
+            neighbours = set(neighbour_idx[b, i].tolist())
+            window = {j for j in range(num_res) if abs(seq_idx[b, i] - seq_idx[b, j]) <= seq_window and mask[b, j]}
+            assert window <= neighbours
+            assert not any(mask[b, j] == 0 for j in neighbours)
+    # The window of the last residue before the chain break comes first, by sequence separation, and stops there.
+    assert neighbour_idx[0, 19, :4].tolist() == [19, 18, 17, 16]
+
+
+def test_sparse_neighbours_keep_nearest_in_chain_when_window_is_larger():
+    torch.manual_seed(0)
+    pos = 10.0 * torch.randn(1, 30, 3)
+    neighbour_idx = sparse_neighbours(pos, torch.ones(1, 30), num_neighbours=5, seq_window=8)
+    assert set(neighbour_idx[0, 15].tolist()) == {13, 14, 15, 16, 17}
+
+
+def test_sparse_ipa_rejects_neighbours_smaller_than_chain_window():
+    with pytest.raises(ValueError):
+        InvariantPointAttention(dataclasses.replace(IPA_CONF, num_neighbours=16, seq_window=8))
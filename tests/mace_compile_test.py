@@ -0,0 +1,22 @@
+import torch
+
+from foldflow.models.components.structure.mace import MACEConfig, MACEModel, compile_mace
+from foldflow.utils.graph_helpers import GraphConfig, build_graph_from_config, dense_to_graph_batch
+
+
+def test_compiled_mace_matches_eager():
+    torch.manual_seed(0)
+    num_batch, num_res = 2, 40
+    pos = torch.cumsum(2.2 * torch.randn(num_batch, num_res, 3), dim=1)
+    res_mask = torch.ones(num_batch, num_res)
+    res_mask[1, 30:] = 0
+    res_idx = torch.arange(num_res).repeat(num_batch, 1)
+    data = dense_to_graph_batch(pos, res_idx, res_mask)
+    data.edge_index = build_graph_from_config(data, GraphConfig())
+
+    model = MACEModel(MACEConfig(num_layers=2, max_ell=2, emb_dim=16, mlp_dim=16, encoder_dim=32)).eval()
+    compiled_model = compile_mace(model)
+    with torch.no_grad():
+        expected = model(data)
+        actual = compiled_model(data)
+    torch.testing.assert_close(actual, expected, atol=1e-4, rtol=1e-4)
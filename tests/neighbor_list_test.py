@@ -0,0 +1,53 @@
+import torch
+
+from foldflow.utils.graph_helpers import GraphConfig, build_graph_from_config, dedup_edges, dense_to_graph_batch
+from foldflow.utils.neighbor_list import VerletGraphCache
+
+SKIN = 2.0
+
+
+def _data(pos):
+    res_mask = torch.ones(pos.shape[:2])
+    res_mask[1, 50:] = 0
+    res_idx = torch.arange(pos.shape[1]).repeat(pos.shape[0], 1)
+    return dense_to_graph_batch(pos, res_idx, res_mask)
+
+
+def _edge_set(edge_index, num_nodes):
+    return set(map(tuple, dedup_edges(edge_index, num_nodes).t().tolist()))
+
+
+def _random_displacement(shape, max_norm):
+    direction = torch.nn.functional.normalize(torch.randn(shape), dim=-1)
+    return direction * max_norm * torch.rand(shape[:-1] + (1,))
+
+
+def test_verlet_graph_matches_fresh_build_within_half_skin():
+    torch.manual_seed(0)
+    pos = torch.cumsum(2.2 * torch.randn(2, 64, 3), dim=1)
+    conf = GraphConfig()
+    cache = VerletGraphCache(conf, skin=SKIN)
+    cache(_data(pos))
+
+    # The displacements add up to less than skin / 2 from the positions the list was built at.
+    for _ in range(3):
+        pos = pos + _random_displacement(pos.shape, 0.15 * SKIN)
+        data = _data(pos)
+        moved = cache(data)
+        assert _edge_set(moved, data.num_nodes) == _edge_set(build_graph_from_config(data, conf), data.num_nodes)
+    assert cache.num_misses == 1
+
+
+def test_verlet_graph_rebuilds_beyond_half_skin():
+    torch.manual_seed(0)
+    pos = torch.cumsum(2.2 * torch.randn(2, 64, 3), dim=1)
+    conf = GraphConfig()
+    cache = VerletGraphCache(conf, skin=SKIN)
+    cache(_data(pos))
+
+    pos = pos.clone()
+    pos[0, 10] += torch.tensor([0.6 * SKIN, 0.0, 0.0])
+    data = _data(pos)
+    edge_index = cache(data)
+    assert cache.num_misses == 2 and cache.num_hits == 0
+    assert _edge_set(edge_index, data.num_nodes) == _edge_set(build_graph_from_config(data, conf), data.num_nodes)
@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import scipy.linalg
+import torch
+from omegaconf import OmegaConf
+
+from foldflow.models.se3_fm import SE3FlowMatcher
+from foldflow.models.so3_fm import SO3FM
+from foldflow.utils import frames as fu
+
+CONFIG = os.path.join(os.path.dirname(__file__), "..", "runner", "config", "flow_matcher", "default.yaml")
+
+
+def _so3_euler_step_reference(rot_t: np.ndarray, v_t: np.ndarray, dt: float) -> np.ndarray:
+    """Frozen NumPy copy of the deterministic SO(3) step from before `SO3FM.reverse_torch`.
+
+    rot_t_1 = expmap(rot_t, -v_t * dt) = rot_t @ exp(rot_t^T @ (-v_t * dt)), in float64.
+    """
+    rot_t, perturb = rot_t.astype(np.float64), -v_t.astype(np.float64) * dt
+    skew_sym = np.swapaxes(rot_t, -1, -2) @ perturb
+    exp_skew_sym = np.stack([scipy.linalg.expm(m) for m in skew_sym.reshape(-1, 3, 3)]).reshape(skew_sym.shape)
+    return rot_t @ exp_skew_sym
+
+
+def test_reverse_torch_matches_numpy_reverse():
+    torch.manual_seed(0)
+    flow_matcher = SE3FlowMatcher(OmegaConf.load(CONFIG))
+    num_batch, num_res = 2, 12
+    quats = torch.nn.functional.normalize(torch.randn(num_batch, num_res, 4), dim=-1)
+    frames = fu.frames_from_tensor_7(torch.cat([quats, 10.0 * torch.randn(num_batch, num_res, 3)], dim=-1))
+    # Tangent vectors at the rotations, transported from the skew-symmetric matrices at the identity.
+    skew = torch.randn(num_batch, num_res, 3, 3)
+    rot_vectorfield = frames.rot_mats @ (skew - skew.transpose(-1, -2))
+    trans_vectorfield = torch.randn(num_batch, num_res, 3)
+    flow_mask = torch.ones(num_batch, num_res)
+    flow_mask[1, :4] = 0.0
+    kwargs = dict(t=0.5, dt=0.01, center=True)
+
+    # `SO3FM.reverse` wraps `reverse_torch`, so the rotations are checked against the frozen NumPy step, and the
+    # translations against `R3FM.reverse`, which still runs in NumPy.
+    _, trans_expected, _ = flow_matcher.reverse(
+        rigid_t=fu.frames_to_rigid(frames),
+        rot_vectorfield=rot_vectorfield.numpy(),
+        trans_vectorfield=trans_vectorfield.numpy(),
+        flow_mask=flow_mask.numpy(),
+        **kwargs,
+    )
+    rot_t = frames.rot_mats.numpy()
+    rot_expected = _so3_euler_step_reference(rot_t, rot_vectorfield.numpy(), kwargs["dt"])
+    rot_expected = np.where(flow_mask.numpy()[..., None, None] == 1, rot_expected, rot_t)
+    rot_actual, trans_actual = flow_matcher.reverse_torch(
+        rot_t=frames.rot_mats,
+        trans_t=frames.trans,
+        rot_vectorfield=rot_vectorfield,
+        trans_vectorfield=trans_vectorfield,
+        flow_mask=flow_mask,
+        **kwargs,
+    )
+    np.testing.assert_allclose(rot_actual.numpy(), rot_expected, atol=1e-5)
+    np.testing.assert_allclose(trans_actual.numpy(), trans_expected, atol=1e-5)
+
+
+def test_so3_reverse_torch_stochastic_batch_dims():
+    torch.manual_seed(0)
+    so3_conf = OmegaConf.load(CONFIG).so3
+    stochastic_fm, deterministic_fm = SO3FM(so3_conf, stochastic_paths=True), SO3FM(so3_conf, stochastic_paths=False)
+    num_batch, num_res = 2, 12
+    quats = torch.nn.functional.normalize(torch.randn(num_batch, num_res, 4), dim=-1)
+    rot_t = fu.quat_to_rot_mats(quats)
+    skew = torch.randn(num_batch, num_res, 3, 3)
+    v_t = rot_t @ (skew - skew.transpose(-1, -2))
+
+    rot_t_1 = stochastic_fm.reverse_torch(rot_t, v_t, t=0.5, dt=0.01)
+    assert rot_t_1.shape == rot_t.shape and rot_t_1.dtype == rot_t.dtype
+    identity = torch.eye(3).expand_as(rot_t_1)
+    torch.testing.assert_close(rot_t_1 @ rot_t_1.transpose(-1, -2), identity, atol=1e-5, rtol=1e-5)
+    # The noise is drawn per rotation and added on top of the deterministic step.
+    assert not torch.allclose(rot_t_1, deterministic_fm.reverse_torch(rot_t, v_t, t=0.5, dt=0.01))
+    torch.testing.assert_close(
+        stochastic_fm.reverse_torch(rot_t, v_t, t=0.5, dt=0.01, noise_scale=0.0),
+        deterministic_fm.reverse_torch(rot_t, v_t, t=0.5, dt=0.01),
+    )
@@ -0,0 +1,126 @@
+import os
+
+import esm
+import torch
+from omegaconf import OmegaConf
+
+from foldflow.models.components.sequence import frozen_esm
+from foldflow.models.ff2flow.ff2_dependencies import FF2Dependencies
+from foldflow.models.ff2flow.flow_model import FF2Model
+from foldflow.utils.step_cache import StepInvariantCache
+
+CONFIG_DIR = os.path.join(os.path.dirname(__file__), "..", "runner", "config")
+
+
+def _inputs(num_res=8):
+    return dict(
+        seq_idx=torch.arange(num_res)[None],
+        res_mask=torch.ones(1, num_res),
+        fixed_mask=torch.zeros(1, num_res),
+    )
+
+
+class _Counter:
+    def __init__(self):
+        self.num_calls = 0
+
+    def __call__(self):
+        self.num_calls += 1
+        return torch.randn(3)
+
+
+def test_step_cache_hits_across_steps():
+    cache, compute = StepInvariantCache(), _Counter()
+    with torch.no_grad():
+        for _ in range(3):
+            cache.check(**_inputs())
+            value = cache.get("feature", compute)
+    assert compute.num_calls == 1 and cache.num_hits == 2
+    assert value is cache.get("feature", compute)
+
+
+def test_step_cache_resets_when_inputs_change():
+    changes = {
+        "fixed_mask": dict(fixed_mask=torch.tensor([[1.0, 1.0, 0, 0, 0, 0, 0, 0]])),
+        "seq_idx": dict(seq_idx=torch.arange(8)[None] + 1),
+        "shape": _inputs(num_res=9),
+    }
+    for name, change in changes.items():
+        cache, compute = StepInvariantCache(), _Counter()
+        with torch.no_grad():
+            cache.check(**_inputs())
+            cache.get("feature", compute)
+            cache.check(**{**_inputs(), **change})
+            assert len(cache) == 0, name
+            cache.get("feature", compute)
+        assert compute.num_calls == 2, name
+
+
+def test_step_cache_bypassed_with_autograd_or_before_check():
+    cache, compute = StepInvariantCache(), _Counter()
+    with torch.no_grad():
+        cache.get("feature", compute)
+    cache.check(**_inputs())
+    with torch.enable_grad():
+        cache.get("feature", compute)
+        cache.get("feature", compute)
+    assert compute.num_calls == 3 and len(cache) == 0
+
+
+def _tiny_esm2():
+    alphabet = esm.data.Alphabet.from_architecture("ESM-1b")
+    return esm.model.esm2.ESM2(num_layers=2, embed_dim=32, attention_heads=4, alphabet=alphabet), alphabet
+
+
+def _ff2_model(step_invariant_cache):
+    config = OmegaConf.create(
+        {
+            "model": OmegaConf.load(os.path.join(CONFIG_DIR, "model", "ff2_mace.yaml")),
+            "flow_matcher": OmegaConf.load(os.path.join(CONFIG_DIR, "flow_matcher", "default.yaml")),
+            "experiment": {"debug": False},
+        }
+    )
+    config.model.esm2_model_key = "esm2_tiny"
+    config.model.esm_backend = "fp32"
+    config.model.mace_encoder.is_on = False
+    config.model.bb_encoder.num_blocks = 1
+    config.model.bb_decoder.num_blocks = 1
+    config.model.step_invariant_cache = step_invariant_cache
+    return FF2Model.from_dependencies(FF2Dependencies(config))
+
+
+def test_ff2_step_cache_matches_uncached(monkeypatch):
+    monkeypatch.setitem(frozen_esm.ESM_REGISTRY, "esm2_tiny", _tiny_esm2)
+    torch.manual_seed(0)
+    cached = _ff2_model(step_invariant_cache=True).eval()
+    uncached = _ff2_model(step_invariant_cache=False).eval()
+    uncached.load_state_dict(cached.state_dict())
+
+    num_batch, num_res = 2, 12
+    res_mask = torch.ones(num_batch, num_res)
+    res_mask[1, 9:] = 0.0
+    batch = {
+        "res_mask": res_mask,
+        "fixed_mask": torch.zeros(num_batch, num_res),
+        "seq_idx": torch.arange(1, num_res + 1).repeat(num_batch, 1),
+        "chain_idx": torch.zeros(num_batch, num_res, dtype=torch.long),
+        "aatype": torch.randint(0, 20, (num_batch, num_res)),
+    }
+    with torch.no_grad():
+        for step in range(3):
+            batch["t"] = torch.full((num_batch,), 1.0 - 0.1 * step)
+            quats = torch.nn.functional.normalize(torch.randn(num_batch, num_res, 4), dim=-1)
+            batch["rigids_t"] = torch.cat([quats, 10.0 * torch.randn(num_batch, num_res, 3)], dim=-1)
+            batch["sc_ca_t"] = torch.zeros(num_batch, num_res, 3) if step == 0 else batch["rigids_t"][..., 4:]
+            actual, expected = cached(batch), uncached(batch)
+            for key in ("rot_vectorfield", "trans_vectorfield", "psi", "rigids"):
+                torch.testing.assert_close(actual[key], expected[key])
+    assert cached.step_cache.num_hits > 0
+
+    # The fixed residues of a scaffolding problem change: the cached features are dropped.
+    batch["fixed_mask"] = batch["fixed_mask"].clone()
+    batch["fixed_mask"][:, :3] = 1.0
+    with torch.no_grad():
+        cached.step_cache.check(seq_idx=batch["seq_idx"], res_mask=batch["res_mask"], fixed_mask=batch["fixed_mask"])
+        assert len(cached.step_cache) == 0
+        torch.testing.assert_close(cached(batch)["rigids"], uncached(batch)["rigids"])
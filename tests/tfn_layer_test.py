@@ -0,0 +1,41 @@
+import e3nn
+import pytest
+import torch
+
+from foldflow.models.components.structure.layers.tfn_layer import TensorProductConvLayer
+
+IN_IRREPS = e3nn.o3.Irreps("8x0e + 4x1o")
+SH_IRREPS = e3nn.o3.Irreps.spherical_harmonics(2)
+
+
+def _layer(aggr, edge_chunk_size=None):
+    return TensorProductConvLayer(
+        IN_IRREPS, IN_IRREPS, SH_IRREPS, edge_feats_dim=6, mlp_dim=16, aggr=aggr, edge_chunk_size=edge_chunk_size
+    )
+
+
+@pytest.mark.parametrize("aggr", ["add", "mean"])
+def test_chunked_scatter_matches_unchunked(aggr):
+    torch.manual_seed(0)
+    num_nodes, num_edges = 12, 37
+    layer = _layer(aggr)
+    # 5 doesn't divide the 37 edges, so the last chunk is a partial one.
+    chunked_layer = _layer(aggr, edge_chunk_size=5)
+    chunked_layer.load_state_dict(layer.state_dict())
+
+    node_attr = torch.randn(num_nodes, IN_IRREPS.dim)
+    edge_index = torch.randint(num_nodes, (2, num_edges))
+    edge_sh = e3nn.o3.spherical_harmonics(SH_IRREPS, torch.randn(num_edges, 3), normalize=True)
+    edge_feat = torch.randn(num_edges, 6)
+
+    outputs, grads = [], []
+    for model in (layer, chunked_layer):
+        inputs = [node_attr.clone().requires_grad_(True), edge_feat.clone().requires_grad_(True)]
+        out = model(inputs[0], edge_index, edge_sh, inputs[1])
+        out.square().sum().backward()
+        outputs.append(out.detach())
+        grads.append([x.grad for x in inputs] + [p.grad for p in model.parameters()])
+
+    torch.testing.assert_close(outputs[1], outputs[0], atol=1e-5, rtol=1e-5)
+    for actual, expected in zip(grads[1], grads[0]):
+        torch.testing.assert_close(actual, expected, atol=1e-5, rtol=1e-5)
@@ -0,0 +1,88 @@
+import os
+
+import pytest
+import torch
+
+from foldflow.models.components.structure.modules import cg
+
+IRREPS_IN, IRREPS_OUT, CORRELATION = "0e+1o", "0e", 2
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv(cg.U_MATRIX_CACHE_DIR_ENV, str(tmp_path))
+    monkeypatch.setattr(cg, "_U_MATRIX_MEMO", {})
+    return tmp_path
+
+
+def _cached_u_matrix():
+    return cg.cached_U_matrix_real(IRREPS_IN, IRREPS_OUT, CORRELATION, dtype=torch.float32)
+
+
+def _assert_same_u_matrix(actual, expected):
+    assert len(actual) == len(expected)
+    for a, e in zip(actual, expected):
+        if isinstance(e, torch.Tensor):
+            torch.testing.assert_close(a, e)
+        else:
+            assert a == e
+
+
+def test_u_matrix_is_read_back_from_disk(cache_dir, monkeypatch):
+    expected = cg.U_matrix_real(IRREPS_IN, IRREPS_OUT, CORRELATION, dtype=torch.float32)
+    _assert_same_u_matrix(_cached_u_matrix(), expected)
+    key = cg._u_matrix_key(IRREPS_IN, IRREPS_OUT, CORRELATION, "component", None, torch.float32)
+    assert os.listdir(cache_dir) == [os.path.basename(cg._u_matrix_cache_path(str(cache_dir), key))]
+
+    # A new process has an empty memo and reads the disk cache instead of recomputing.
+    monkeypatch.setattr(cg, "_U_MATRIX_MEMO", {})
+    monkeypatch.setattr(cg, "U_matrix_real", lambda *args, **kwargs: pytest.fail("The U-matrix was recomputed."))
+    _assert_same_u_matrix(_cached_u_matrix(), expected)
+
+
+def test_u_matrix_is_written_atomically(cache_dir, monkeypatch):
+    key = cg._u_matrix_key(IRREPS_IN, IRREPS_OUT, CORRELATION, "component", None, torch.float32)
+    path = cg._u_matrix_cache_path(str(cache_dir), key)
+    torch_save = torch.save
+
+    def save_and_check(obj, f):
+        # Readers never see a partially written file under the final name.
+        assert f != path and not os.path.exists(path)
+        torch_save(obj, f)
+
+    monkeypatch.setattr(torch, "save", save_and_check)
+    _cached_u_matrix()
+    assert os.listdir(cache_dir) == [os.path.basename(path)]
+
+    monkeypatch.setattr(torch, "save", torch_save)
+    # A corrupted file is recomputed and replaced.
+    with open(path, "wb") as f:
+        f.write(b"truncated")
+    monkeypatch.setattr(cg, "_U_MATRIX_MEMO", {})
+    expected = cg.U_matrix_real(IRREPS_IN, IRREPS_OUT, CORRELATION, dtype=torch.float32)
+    _assert_same_u_matrix(_cached_u_matrix(), expected)
+    _assert_same_u_matrix(cg._load_u_matrix(path, key), expected)
+
+
+def test_u_matrix_cache_version_invalidates_files(cache_dir, monkeypatch):
+    key = cg._u_matrix_key(IRREPS_IN, IRREPS_OUT, CORRELATION, "component", None, torch.float32)
+    _cached_u_matrix()
+    old_path = cg._u_matrix_cache_path(str(cache_dir), key)
+
+    monkeypatch.setattr(cg, "U_MATRIX_CACHE_VERSION", cg.U_MATRIX_CACHE_VERSION + 1)
+    # The file of the previous version is ignored even if it is read under the new name.
+    assert cg._load_u_matrix(old_path, key) is None
+    new_path = cg._u_matrix_cache_path(str(cache_dir), key)
+    assert new_path != old_path
+
+    num_calls = []
+    u_matrix_real = cg.U_matrix_real
+
+    def counting_u_matrix_real(*args, **kwargs):
+        num_calls.append(1)
+        return u_matrix_real(*args, **kwargs)
+
+    monkeypatch.setattr(cg, "U_matrix_real", counting_u_matrix_real)
+    monkeypatch.setattr(cg, "_U_MATRIX_MEMO", {})
+    _cached_u_matrix()
+    assert len(num_calls) == 1 and os.path.exists(new_path)
@@ -0,0 +1,162 @@
+import os
+
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+from foldflow.models.components.network import VectorFieldNetwork
+from foldflow.models.se3_fm import SE3FlowMatcher
+
+FLOW_MATCHER_CONFIG = os.path.join(os.path.dirname(__file__), "..", "runner", "config", "flow_matcher", "default.yaml")
+NUM_BATCH, NUM_RES = 2, 24
+
+
+def _model_conf(embed_overrides=None, **ipa_overrides):
+    return OmegaConf.create(
+        {
+            "node_embed_size": 32,
+            "edge_embed_size": 16,
+            "embed": {
+                "index_embed_size": 8,
+                "embed_self_conditioning": True,
+                "num_bins": 22,
+                "min_bin": 1e-5,
+                "max_bin": 20.0,
+                **(embed_overrides or {}),
+            },
+            "ipa": {
+                "c_s": 32,
+                "c_z": 16,
+                "c_hidden": 8,
+                "c_skip": 8,
+                "no_heads": 2,
+                "no_qk_points": 2,
+                "no_v_points": 4,
+                "seq_tfmr_num_heads": 4,
+                "seq_tfmr_num_layers": 1,
+                "num_blocks": 2,
+                "coordinate_scaling": 0.1,
+                **ipa_overrides,
+            },
+        }
+    )
+
+
+def _model(embed_overrides=None, step_invariant_cache=True, **ipa_overrides):
+    flow_matcher = SE3FlowMatcher(OmegaConf.load(FLOW_MATCHER_CONFIG))
+    model_conf = _model_conf(embed_overrides, **ipa_overrides)
+    model_conf.step_invariant_cache = step_invariant_cache
+    model = VectorFieldNetwork(model_conf, flow_matcher)
+    # The final layers are zero-initialized, which would leave the gradients of the earlier ones at zero.
+    with torch.no_grad():
+        for param in model.parameters():
+            if (param == 0).all():
+                param.normal_(0.0, 0.1)
+    return model
+
+
+def _input_feats():
+    res_mask = torch.ones(NUM_BATCH, NUM_RES)
+    res_mask[1, 18:] = 0.0
+    quats = torch.nn.functional.normalize(torch.randn(NUM_BATCH, NUM_RES, 4), dim=-1)
+    ca = torch.cumsum(3.8 * torch.nn.functional.normalize(torch.randn(NUM_BATCH, NUM_RES, 3), dim=-1), dim=1)
+    return {
+        "res_mask": res_mask,
+        "fixed_mask": torch.zeros(NUM_BATCH, NUM_RES),
+        "seq_idx": torch.arange(1, NUM_RES + 1).repeat(NUM_BATCH, 1),
+        "rigids_t": torch.cat([quats, ca], dim=-1),
+        "sc_ca_t": ca + torch.randn_like(ca),
+        "t": torch.rand(NUM_BATCH),
+        "torsion_angles_sin_cos": torch.nn.functional.normalize(torch.randn(NUM_BATCH, NUM_RES, 7, 2), dim=-1),
+    }
+
+
+def _loss(model_out, res_mask):
+    mask = res_mask[..., None]
+    return sum((model_out[k] * mask).square().sum() for k in ("trans_vectorfield", "psi")) + (
+        model_out["rot_vectorfield"] * mask[..., None]
+    ).square().sum()
+
+
+def test_sparse_vectorfield_network_forward_backward():
+    torch.manual_seed(0)
+    model = _model(num_neighbours=20, seq_window=4)
+    input_feats = _input_feats()
+    model_out = model(input_feats)
+    assert model_out["rigids"].shape == (NUM_BATCH, NUM_RES, 7)
+    loss = _loss(model_out, input_feats["res_mask"])
+    assert torch.isfinite(loss)
+    loss.backward()
+    grads = [param.grad for param in model.parameters() if param.grad is not None]
+    assert grads and all(torch.isfinite(grad).all() for grad in grads)
+    assert model.embedding_layer.edge_embedder[0].weight.grad.abs().sum() > 0
+
+
+def test_sparse_vectorfield_network_over_all_residues_matches_dense():
+    torch.manual_seed(0)
+    dense = _model()
+    sparse = _model(num_neighbours=NUM_RES)
+    sparse.load_state_dict(dense.state_dict())
+    input_feats = _input_feats()
+
+    expected = dense({k: v.clone() for k, v in input_feats.items()})
+    actual = sparse({k: v.clone() for k, v in input_feats.items()})
+    mask = input_feats["res_mask"].bool()
+    for key in ("rot_vectorfield", "trans_vectorfield", "psi", "rigids"):
+        torch.testing.assert_close(actual[key][mask], expected[key][mask], atol=1e-4, rtol=1e-4)
+
+    _loss(expected, input_feats["res_mask"]).backward()
+    _loss(actual, input_feats["res_mask"]).backward()
+    expected_grads = dict(dense.named_parameters())
+    for name, param in sparse.named_parameters():
+        if param.grad is not None:
+            torch.testing.assert_close(param.grad, expected_grads[name].grad, atol=1e-4, rtol=1e-4)
+
+
+def _trajectory_step(input_feats, step):
+    """Inputs of the `step`-th step of a trajectory: new time, frames and self-conditioning, same residues."""
+    generator = torch.Generator().manual_seed(step)
+    input_feats = dict(input_feats)
+    input_feats["t"] = torch.full((NUM_BATCH,), 1.0 - 0.1 * step)
+    for key, scale in (("rigids_t", 0.1), ("sc_ca_t", 1.0)):
+        input_feats[key] = input_feats[key] + scale * torch.randn(input_feats[key].shape, generator=generator)
+    return input_feats
+
+
+@pytest.mark.parametrize("factorized_edge_embedder", [False, True])
+def test_step_cache_matches_uncached(factorized_edge_embedder):
+    torch.manual_seed(0)
+    embed_overrides = {"factorized_edge_embedder": factorized_edge_embedder}
+    cached = _model(embed_overrides).eval()
+    uncached = _model(embed_overrides, step_invariant_cache=False).eval()
+    uncached.load_state_dict(cached.state_dict())
+    input_feats = _input_feats()
+
+    with torch.no_grad():
+        for step in range(3):
+            step_feats = _trajectory_step(input_feats, step)
+            actual, expected = cached(step_feats), uncached(step_feats)
+            for key in ("rot_vectorfield", "trans_vectorfield", "psi", "rigids"):
+                torch.testing.assert_close(actual[key], expected[key])
+    assert cached.step_cache.num_hits > 0 and len(cached.step_cache) > 0
+
+    # A new trajectory with other weights, e.g. the next checkpoint, must reset the weight-dependent features.
+    with torch.no_grad():
+        for model in (cached, uncached):
+            model.embedding_layer.edge_embedder[0].weight.add_(0.1)
+        step_feats = _trajectory_step(input_feats, 0)
+        if factorized_edge_embedder:
+            stale = cached(step_feats)["trans_vectorfield"]
+            assert not torch.allclose(stale, uncached(step_feats)["trans_vectorfield"])
+        cached.reset_step_cache()
+        torch.testing.assert_close(cached(step_feats)["trans_vectorfield"], uncached(step_feats)["trans_vectorfield"])
+
+
+def test_step_cache_bypassed_in_training():
+    torch.manual_seed(0)
+    model = _model()
+    input_feats = _input_feats()
+    with torch.no_grad():
+        model(input_feats)
+        model(input_feats)
+    assert len(model.step_cache) == 0 and model.step_cache.num_hits == 0
@@ -0,0 +1,155 @@
+"""Peak memory and throughput of a training step of the FF2 structure stack for each activation checkpointing policy.
+
+The bb_encoder, the trunk and the bb_decoder of the `ff2_mace` config are run forward and backward on random frames,
+with random representations in place of the ESM and MACE ones, as in a training step. For every
+policy the peak memory per squared residue of the longest chain gives the `max_squared_res` (batch size * length²)
+that fits in `--memory_budget_gb`. Every case runs in a fresh process, so that its peak memory is not hidden by the
+previous ones.
+
+Sample command:
+> python tools/benchmarks/checkpointing.py --lengths 128 256 --batch_size 2 --device cuda --memory_budget_gb 40
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+
+import torch
+from hydra import compose, initialize_config_dir
+
+from foldflow.models.ff2flow.ff2_dependencies import FF2Dependencies
+from foldflow.utils.checkpointing import CHECKPOINTING_POLICIES
+from tools.benchmarks.mace_suite import current_memory_mb, peak_memory_mb
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "runner", "config")
+
+
+def make_stack(policy: str, device: torch.device):
+    with initialize_config_dir(config_dir=os.path.abspath(CONFIG_DIR), version_base=None):
+        conf = compose(config_name="ff2_mace", overrides=[f"model.checkpointing={policy}"])
+    deps = FF2Dependencies(conf)
+    modules = dict(
+        bb_encoder=deps.bb_encoder,
+        combiner_network=deps.combiner_network,
+        trunk_network=deps.trunk_network,
+        trunk_to_decoder_network=deps.trunk_to_decoder_network,
+        bb_decoder=deps.bb_decoder,
+    )
+    # Sizes of the sequence single and pair representations, and of the MACE single representation.
+    dims = dict(
+        seq_s=conf.model.seq_emb_to_block.single_dim,
+        seq_z=conf.model.seq_emb_to_block.pair_dim,
+        mace_s=conf.model.bb_mace_encoder_to_block.single_dim if conf.model.mace_encoder.is_on else None,
+    )
+    return {name: module.to(device).train() for name, module in modules.items() if module is not None}, dims
+
+
+def make_batch(num_res: int, batch_size: int, dims, device: torch.device):
+    quats = torch.nn.functional.normalize(torch.randn(batch_size, num_res, 4), dim=-1)
+    trans = 10.0 * torch.randn(batch_size, num_res, 3)
+    return dict(
+        res_mask=torch.ones(batch_size, num_res, device=device),
+        fixed_mask=torch.zeros(batch_size, num_res, device=device),
+        seq_idx=torch.arange(1, num_res + 1, device=device).repeat(batch_size, 1),
+        chain_idx=torch.ones(batch_size, num_res, device=device),
+        t=torch.rand(batch_size, device=device),
+        rigids_t=torch.cat([quats, trans], dim=-1).to(device),
+        sc_ca_t=trans.to(device),
+        seq_s=torch.randn(batch_size, num_res, dims["seq_s"], device=device),
+        seq_z=torch.randn(batch_size, num_res, num_res, dims["seq_z"], device=device),
+        mace_s=torch.randn(batch_size, num_res, dims["mace_s"], device=device) if dims["mace_s"] else None,
+    )
+
+
+def training_step(modules, batch):
+    """The structure part of `FF2Model.forward`, followed by a backward pass."""
+    encoder_out = modules["bb_encoder"](
+        res_mask=batch["res_mask"],
+        fixed_mask=batch["fixed_mask"],
+        seq_idx=batch["seq_idx"],
+        chain_idx=batch["chain_idx"],
+        t=batch["t"],
+        rigids_t=batch["rigids_t"],
+        self_conditioning_ca=batch["sc_ca_t"],
+    )
+    single, pair = modules["combiner_network"](
+        {"bb": encoder_out["single_emb"], "seq": batch["seq_s"], "bb_mace": batch["mace_s"]},
+        {"bb": encoder_out["pair_emb"], "seq": batch["seq_z"]},
+    )
+    if "trunk_network" in modules:
+        single, pair = modules["trunk_network"](single, pair, mask=batch["res_mask"])
+    single, pair = modules["trunk_to_decoder_network"](single, pair)
+    decoder_out = modules["bb_decoder"](
+        res_mask=batch["res_mask"],
+        fixed_mask=batch["fixed_mask"],
+        t=batch["t"],
+        single_embed=0.5 * (single + encoder_out["init_single_embed"]),
+        pair_embed=0.5 * (pair + encoder_out["init_pair_embed"]),
+        rigids_t=encoder_out["rigids"].to_tensor_7(),
+    )
+    loss = decoder_out["rigids"].to_tensor_7().square().mean() + decoder_out["psi"].square().mean()
+    loss.backward()
+    for module in modules.values():
+        module.zero_grad(set_to_none=True)
+
+
+def run_case(policy: str, num_res: int, args, queue):
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    modules, dims = make_stack(policy, device)
+    batch = make_batch(num_res, args.batch_size, dims, device)
+
+    def step():
+        training_step(modules, batch)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    mem_before = current_memory_mb(device)
+    step()  # Warm-up, also reaches the peak memory of the step.
+    peak_mem = peak_memory_mb(device) - mem_before
+
+    start = time.perf_counter()
+    for _ in range(args.num_repeats):
+        step()
+    queue.put(((time.perf_counter() - start) / args.num_repeats, peak_mem))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[64, 128, 256])
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--policies", nargs="+", default=list(CHECKPOINTING_POLICIES), choices=CHECKPOINTING_POLICIES)
+    parser.add_argument("--memory_budget_gb", type=float, default=40.0)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--num_repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    print(f"{'policy':>10} {'length':>7} {'step [ms]':>10} {'res/s':>9} {'peak [MB]':>10} {'B/res²':>9}")
+    bytes_per_squared_res = {}
+    for policy in args.policies:
+        for num_res in sorted(args.lengths):
+            queue = context.Queue()
+            process = context.Process(target=run_case, args=(policy, num_res, args, queue))
+            process.start()
+            step_time, peak_mem = queue.get()
+            process.join()
+            num_squared_res = args.batch_size * num_res**2
+            # The longest chain sets the estimate, the fixed memory costs matter less there.
+            bytes_per_squared_res[policy] = 2**20 * peak_mem / num_squared_res
+            print(
+                f"{policy:>10} {num_res:>7} {1e3 * step_time:>10.1f} {args.batch_size * num_res / step_time:>9.0f} "
+                f"{peak_mem:>10.1f} {bytes_per_squared_res[policy]:>9.0f}"
+            )
+
+    print(f"\nmax_squared_res within {args.memory_budget_gb} GB:")
+    for policy, per_squared_res in bytes_per_squared_res.items():
+        print(f"{policy:>10} {int(args.memory_budget_gb * 2**30 / per_squared_res):>12}")
+
+
+if __name__ == "__main__":
+    main()
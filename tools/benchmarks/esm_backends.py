@@ -0,0 +1,79 @@
+"""Accuracy and latency of the ESM backends of `FrozenEsmModel` over sequence lengths.
+
+Every backend is compared with the fp32 backend on the same random sequences, see `esm_backend_error`. The latency is
+the mean wall time of a forward pass, after a warm-up pass. By default the benchmark runs on CPU, the device of the
+int8 backend.
+
+Sample command:
+> python tools/benchmarks/esm_backends.py --model_key esm2_650M --lengths 100 200 400 --output esm_backends.json
+"""
+
+import argparse
+import copy
+import json
+import time
+
+import torch
+
+from foldflow.models.components.sequence.frozen_esm import FrozenEsmModel, esm_backend_error
+from tools.benchmarks.mace_suite import environment
+
+
+def time_forward(model: FrozenEsmModel, aatype: torch.Tensor, num_repeats: int) -> float:
+    chain_idx = torch.zeros_like(aatype)
+    attn_mask = torch.ones_like(aatype)
+    run = lambda: model(aatype, chain_idx, attn_mask=attn_mask, cache_last_call=False)
+    run()  # Warm-up, also sets up the backend.
+    if aatype.device.type == "cuda":
+        torch.cuda.synchronize(aatype.device)
+    start = time.perf_counter()
+    for _ in range(num_repeats):
+        run()
+    if aatype.device.type == "cuda":
+        torch.cuda.synchronize(aatype.device)
+    return (time.perf_counter() - start) / num_repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model_key", type=str, default="esm2_650M")
+    parser.add_argument("--backends", nargs="+", default=["fp32", "bf16", "int8"])
+    parser.add_argument("--lengths", type=int, nargs="+", default=[100, 200, 400])
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--no_pair", action="store_true")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--num_repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="esm_backends.json")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    reference = FrozenEsmModel(args.model_key, use_esm_attn_map=not args.no_pair, cache_max_bytes=0, backend="fp32")
+    reference.esm.eval()
+    reference = reference.to(device)
+    models = {}
+    for backend in args.backends:
+        models[backend] = copy.deepcopy(reference)
+        models[backend].backend = backend
+
+    generator = torch.Generator().manual_seed(args.seed)
+    results = []
+    print(f"{'backend':>8} {'length':>6} {'time [ms]':>10} {'single err':>11} {'min cos':>8} {'pair err':>9}")
+    for num_res in args.lengths:
+        aatype = torch.randint(0, 20, (args.batch_size, num_res), generator=generator).to(device)
+        for backend, model in models.items():
+            errors = esm_backend_error(model, reference, aatype)
+            wall_time = time_forward(model, aatype, args.num_repeats)
+            results.append(dict(backend=backend, num_res=num_res, wall_time_s=wall_time, **errors))
+            print(
+                f"{backend:>8} {num_res:>6} {1e3 * wall_time:>10.2f} {errors['single_rel_error']:>11.2e} "
+                f"{errors['single_min_cos']:>8.4f} {errors.get('pair_rel_error', float('nan')):>9.2e}"
+            )
+
+    with open(args.output, "w") as f:
+        json.dump(dict(environment=environment(), args=vars(args), results=results), f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""CPU benchmark of the tensorized graph builder against the legacy one.
+
+Sample command:
+> python tools/benchmarks/graph_builder.py --lengths 100 200 400 --batch_size 4
+"""
+
+import argparse
+import time
+
+import torch
+from torch_geometric.data import Batch, Data
+
+from foldflow.utils.graph_helpers import build_graph, build_graph_legacy
+
+
+def random_ca_chain(num_res: int, generator: torch.Generator) -> torch.Tensor:
+    """Random walk with 3.8A steps, which is the distance between consecutive CA atoms."""
+    steps = torch.randn(num_res, 3, generator=generator)
+    steps = 3.8 * steps / steps.norm(dim=-1, keepdim=True)
+    pos = torch.cumsum(steps, dim=0)
+    return pos - pos.mean(dim=0, keepdim=True)
+
+
+def make_batch(num_res: int, batch_size: int, generator: torch.Generator) -> Batch:
+    data_list = []
+    for _ in range(batch_size):
+        pos = random_ca_chain(num_res, generator)
+        data_list.append(
+            Data(atoms=torch.zeros(num_res, dtype=torch.long), pos=pos, res_idx=torch.arange(1, num_res + 1))
+        )
+    return Batch.from_data_list(data_list)
+
+
+def time_fn(fn, num_repeats: int) -> float:
+    fn()  # warm-up
+    start = time.perf_counter()
+    for _ in range(num_repeats):
+        fn()
+    return (time.perf_counter() - start) / num_repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[100, 200, 400, 600])
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--max_squared_res_ratio", type=float, default=0.02)
+    parser.add_argument("--radius", type=float, default=5.0)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--min_residue_distance", type=int, default=5)
+    parser.add_argument("--num_repeats", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generator = torch.Generator().manual_seed(args.seed)
+    print(f"{'length':>8} {'edges':>8} {'legacy [ms]':>12} {'tensorized [ms]':>16} {'speedup':>8}")
+    for num_res in args.lengths:
+        data = make_batch(num_res, args.batch_size, generator)
+        # A tight budget, so that the clipping path is exercised by both builders.
+        max_edges = args.max_squared_res_ratio * data.num_nodes * num_res
+        kwargs = dict(max_edges=max_edges, min_residue_distance=args.min_residue_distance, radius=args.radius, k=args.k)
+
+        legacy_time = time_fn(lambda: build_graph_legacy(data, **kwargs), args.num_repeats)
+        new_time = time_fn(lambda: build_graph(data, **kwargs), args.num_repeats)
+        num_edges = build_graph(data, **kwargs).shape[1]
+        print(
+            f"{num_res:>8} {num_edges:>8} {1e3 * legacy_time:>12.2f} {1e3 * new_time:>16.2f} "
+            f"{legacy_time / new_time:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
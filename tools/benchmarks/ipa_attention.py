@@ -0,0 +1,109 @@
+"""CPU latency and peak memory of the InvariantPointAttention implementations against the reference one.
+
+Each implementation is loaded with the weights of the reference, the maximum absolute difference of its output is
+reported next to its latency. The dot_product attention skips the [B, N, N, H, P_q, 3] point displacements of the
+reference but, like it, materializes the [B, H, N, N] attention weights, which the query-dependent pair values need.
+Peak memory is the peak resident set size growth of a forward pass, measured in a fresh
+process for every implementation and length.
+
+Sample command:
+> python tools/benchmarks/ipa_attention.py --lengths 128 256 512 --batch_size 2 --impls reference dot_product chunked
+"""
+
+import argparse
+import dataclasses
+import multiprocessing
+import resource
+
+import torch
+from openfold.utils.rigid_utils import Rigid
+
+from foldflow.models.components.ipa_pytorch import InvariantPointAttention
+from foldflow.models.ff2flow.structure_network import IPAConfig
+from tools.benchmarks.graph_builder import random_ca_chain, time_fn
+
+IMPLS = {
+    "reference": dict(),
+    "dot_product": dict(attn_impl="dot_product"),
+    "chunked": dict(chunk_size=64),
+}
+
+
+def make_inputs(ipa_conf: IPAConfig, num_res: int, batch_size: int, seed: int):
+    generator = torch.Generator().manual_seed(seed)
+    s = torch.randn(batch_size, num_res, ipa_conf.c_s, generator=generator)
+    z = torch.randn(batch_size, num_res, num_res, ipa_conf.c_z, generator=generator)
+    quats = torch.randn(batch_size, num_res, 4, generator=generator)
+    trans = torch.stack([random_ca_chain(num_res, generator) for _ in range(batch_size)])
+    r = Rigid.from_tensor_7(torch.cat([quats, trans], dim=-1), normalize_quats=True)
+    return s, z, r, torch.ones(batch_size, num_res)
+
+
+def make_ipa(ipa_conf: IPAConfig, impl: str, seed: int) -> InvariantPointAttention:
+    torch.manual_seed(seed)
+    ipa = InvariantPointAttention(dataclasses.replace(ipa_conf, **IMPLS[impl])).eval()
+    # The output layer is zero-initialized, use random weights so that the errors are measured.
+    torch.nn.init.normal_(ipa.linear_out.weight)
+    return ipa
+
+
+def run_case(ipa_conf: IPAConfig, impl: str, num_res: int, args, queue):
+    s, z, r, mask = make_inputs(ipa_conf, num_res, args.batch_size, args.seed)
+    reference = make_ipa(ipa_conf, "reference", args.seed)
+    ipa = make_ipa(ipa_conf, impl, args.seed)
+    with torch.no_grad():
+        max_err = (ipa(s, z, r, mask) - reference(s, z, r, mask)).abs().max().item()
+        del reference
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        latency = time_fn(lambda: ipa(s, z, r, mask), args.num_repeats)
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    queue.put((latency, peak_rss / 1024, max_err))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[128, 256, 512])
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--impls", type=str, nargs="+", default=list(IMPLS), choices=list(IMPLS))
+    parser.add_argument("--c_s", type=int, default=256)
+    parser.add_argument("--c_z", type=int, default=128)
+    parser.add_argument("--c_hidden", type=int, default=16)
+    parser.add_argument("--no_heads", type=int, default=12)
+    parser.add_argument("--no_qk_points", type=int, default=4)
+    parser.add_argument("--no_v_points", type=int, default=8)
+    parser.add_argument("--num_repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    ipa_conf = IPAConfig(
+        c_s=args.c_s,
+        c_z=args.c_z,
+        c_hidden=args.c_hidden,
+        no_heads=args.no_heads,
+        no_qk_points=args.no_qk_points,
+        no_v_points=args.no_v_points,
+    )
+    context = multiprocessing.get_context("spawn")
+    print(
+        "dot_product skips the [B, N, N, H, P_q, 3] point displacements, but the pair values need the [B, H, N, N] "
+        "attention weights, so it materializes them like the reference; chunked bounds both by the query block size."
+    )
+    print(f"{'length':>8} {'impl':>12} {'latency [ms]':>13} {'peak RSS [MB]':>14} {'speedup':>8} {'max err':>9}")
+    for num_res in args.lengths:
+        reference_latency = None
+        for impl in args.impls:
+            queue = context.Queue()
+            process = context.Process(target=run_case, args=(ipa_conf, impl, num_res, args, queue))
+            process.start()
+            latency, peak_rss, max_err = queue.get()
+            process.join()
+            if reference_latency is None:
+                reference_latency = latency
+            print(
+                f"{num_res:>8} {impl:>12} {1e3 * latency:>13.2f} {peak_rss:>14.1f} "
+                f"{reference_latency / latency:>7.2f}x {max_err:>9.1e}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""CPU inference latency of the compiled MACE encoder against the eager one.
+
+The compile time of the first call is reported separately, it drops once the inductor cache is warm.
+
+Sample command:
+> python tools/benchmarks/mace_compile.py --lengths 100 200 400 --batch_size 4 --cache_dir /tmp/foldflow_inductor
+"""
+
+import argparse
+import time
+
+import torch
+
+from foldflow.models.components.structure.mace import MACEConfig, MACEModel, compile_mace
+from foldflow.utils.graph_helpers import GraphConfig, build_graph_from_config, dense_to_graph_batch
+from tools.benchmarks.graph_builder import random_ca_chain, time_fn
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[100, 200, 400, 600])
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--num_layers", type=int, default=2)
+    parser.add_argument("--max_ell", type=int, default=2)
+    parser.add_argument("--emb_dim", type=int, default=64)
+    parser.add_argument("--mlp_dim", type=int, default=64)
+    parser.add_argument("--encoder_dim", type=int, default=128)
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--num_repeats", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    generator = torch.Generator().manual_seed(args.seed)
+    mace_conf = MACEConfig(
+        num_layers=args.num_layers,
+        max_ell=args.max_ell,
+        emb_dim=args.emb_dim,
+        mlp_dim=args.mlp_dim,
+        encoder_dim=args.encoder_dim,
+    )
+    model = MACEModel(mace_conf).eval()
+    compiled_model = compile_mace(model, cache_dir=args.cache_dir)
+
+    print(
+        f"{'length':>8} {'edges':>8} {'compile [s]':>12} {'eager [ms]':>11} {'compiled [ms]':>14} "
+        f"{'speedup':>8} {'max err':>9}"
+    )
+    for num_res in args.lengths:
+        pos = torch.stack([random_ca_chain(num_res, generator) for _ in range(args.batch_size)])
+        res_idx = torch.arange(1, num_res + 1).repeat(args.batch_size, 1)
+        data = dense_to_graph_batch(pos, res_idx, torch.ones(args.batch_size, num_res))
+        data.edge_index = build_graph_from_config(data, GraphConfig())
+
+        with torch.no_grad():
+            start = time.perf_counter()
+            compiled_out = compiled_model(data)
+            compile_time = time.perf_counter() - start
+            max_err = (compiled_out - model(data)).abs().max().item()
+            eager_time = time_fn(lambda: model(data), args.num_repeats)
+            compiled_time = time_fn(lambda: compiled_model(data), args.num_repeats)
+        print(
+            f"{num_res:>8} {data.edge_index.shape[1]:>8} {compile_time:>12.1f} {1e3 * eager_time:>11.2f} "
+            f"{1e3 * compiled_time:>14.2f} {eager_time / compiled_time:>7.1f}x {max_err:>9.1e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
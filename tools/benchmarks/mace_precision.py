@@ -0,0 +1,59 @@
+"""Latency, accuracy and equivariance error of the MACE encoder precision policies.
+
+For every policy, the output is compared to the fp32 output of the same weights, and the equivariance error is the
+relative change of the invariant output under random rotations of the input (see `mace_equivariance_error`).
+
+Sample command:
+> python tools/benchmarks/mace_precision.py --lengths 100 200 400 --precisions fp32 bf16
+"""
+
+import argparse
+
+import torch
+
+from foldflow.models.components.structure.mace import MACEConfig, MACEModel, mace_equivariance_error
+from foldflow.utils.graph_helpers import GraphConfig, build_graph_from_config, dense_to_graph_batch
+from tools.benchmarks.graph_builder import random_ca_chain, time_fn
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[100, 200, 400])
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--precisions", nargs="+", default=["fp32", "bf16", "fp16"])
+    parser.add_argument("--num_layers", type=int, default=2)
+    parser.add_argument("--emb_dim", type=int, default=64)
+    parser.add_argument("--mlp_dim", type=int, default=64)
+    parser.add_argument("--encoder_dim", type=int, default=128)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--num_repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    generator = torch.Generator().manual_seed(args.seed)
+    conf = dict(num_layers=args.num_layers, emb_dim=args.emb_dim, mlp_dim=args.mlp_dim, encoder_dim=args.encoder_dim)
+    reference = MACEModel(MACEConfig(**conf)).to(args.device).eval()
+    models = {}
+    for precision in args.precisions:
+        models[precision] = MACEModel(MACEConfig(**conf, precision=precision)).to(args.device).eval()
+        models[precision].load_state_dict(reference.state_dict())
+
+    print(f"{'length':>8} {'precision':>10} {'time [ms]':>10} {'rel err':>9} {'equiv err':>10}")
+    for num_res in args.lengths:
+        pos = torch.stack([random_ca_chain(num_res, generator) for _ in range(args.batch_size)])
+        res_idx = torch.arange(1, num_res + 1).repeat(args.batch_size, 1)
+        data = dense_to_graph_batch(pos, res_idx, torch.ones(args.batch_size, num_res)).to(args.device)
+        data.edge_index = build_graph_from_config(data, GraphConfig())
+
+        with torch.no_grad():
+            expected = reference(data)
+            for precision, model in models.items():
+                rel_err = ((model(data) - expected).norm() / expected.norm()).item()
+                equiv_err = mace_equivariance_error(model, data)
+                run_time = time_fn(lambda: model(data), args.num_repeats)
+                print(f"{num_res:>8} {precision:>10} {1e3 * run_time:>10.2f} {rel_err:>9.1e} {equiv_err:>10.1e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""Scaling benchmark of the MACE encoder and of its TensorProductConvLayer on synthetic CA graphs.
+
+Every case is run in a fresh process, so that the peak memory of a case is not hidden by the previous ones. Peak
+memory is measured from the memory in use before the first pass: the peak resident set size on CPU, which also
+counts the peak of the imports and the setup, and the peak allocated memory on CUDA. The forward pass is measured
+without autograd, the backward pass includes the forward pass it differentiates.
+
+By default the parameters are varied one at a time around a base case made of the first value of every list. Use
+`--full_grid` to run all their combinations instead.
+
+Sample command:
+> python tools/benchmarks/mace_suite.py --lengths 100 200 400 --ks 10 20 --max_ells 1 2 --output mace_suite.json
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import platform
+import resource
+import subprocess
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List
+
+import e3nn
+import torch
+from e3nn import o3
+
+from foldflow.models.components.structure.layers.tfn_layer import TensorProductConvLayer
+from foldflow.models.components.structure.mace import MACEConfig, MACEModel
+from foldflow.utils.graph_helpers import build_graph, dense_to_graph_batch, per_graph_edge_budgets
+from tools.benchmarks.graph_builder import random_ca_chain
+
+COMPONENTS = ("mace", "conv")
+
+
+@dataclass(frozen=True)
+class BenchmarkCase:
+    component: str
+    num_res: int
+    batch_size: int
+    k: int
+    radius: float
+    max_ell: int
+    correlation: int
+    num_layers: int
+    emb_dim: int
+    mlp_dim: int
+    pass_type: str  # "forward" or "backward"
+
+
+def make_graph(case: BenchmarkCase, seed: int):
+    generator = torch.Generator().manual_seed(seed)
+    pos = torch.stack([random_ca_chain(case.num_res, generator) for _ in range(case.batch_size)])
+    res_idx = torch.arange(1, case.num_res + 1).repeat(case.batch_size, 1)
+    data = dense_to_graph_batch(pos, res_idx, torch.ones(case.batch_size, case.num_res))
+    # The whole radius + kNN graph, the edge density is set by `k` and `radius`.
+    max_edges = per_graph_edge_budgets(data.batch, data.num_graphs, 1.0)
+    data.edge_index = build_graph(data, max_edges=max_edges, min_residue_distance=2, radius=case.radius, k=case.k)
+    return data
+
+
+def make_workload(case: BenchmarkCase, data, device: torch.device):
+    """Returns the module under benchmark and a function running it on `data`."""
+    mace_conf = MACEConfig(
+        max_ell=case.max_ell,
+        correlation=case.correlation,
+        num_layers=case.num_layers,
+        emb_dim=case.emb_dim,
+        mlp_dim=case.mlp_dim,
+    )
+    mace = MACEModel(mace_conf).to(device)
+    if case.component == "mace":
+        return mace, lambda: mace(data)
+
+    # A hidden-to-hidden message passing layer, as in all but the first MACE layer.
+    conv: TensorProductConvLayer = mace.convs[-1]
+    vectors = data.pos[data.edge_index[0]] - data.pos[data.edge_index[1]]
+    edge_sh = mace.spherical_harmonics(vectors).detach()
+    edge_feats = mace.radial_embedding(vectors.norm(dim=-1, keepdim=True)).detach()
+    node_attr = o3.Irreps(conv.in_irreps).randn(data.num_nodes, -1, device=device)
+    return conv, lambda: conv(node_attr=node_attr, edge_index=data.edge_index, edge_sh=edge_sh, edge_feat=edge_feats)
+
+
+def current_memory_mb(device: torch.device) -> float:
+    if device.type == "cuda":
+        return torch.cuda.memory_allocated(device) / 2**20
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+    except OSError:
+        return peak_memory_mb(device)
+
+
+def peak_memory_mb(device: torch.device) -> float:
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10  # KiB on Linux
+
+
+def run_case(case: BenchmarkCase, device_name: str, num_repeats: int, seed: int) -> Dict:
+    torch.manual_seed(seed)
+    device = torch.device(device_name)
+    data = make_graph(case, seed).to(device)
+    module, fn = make_workload(case, data, device)
+    module.train(case.pass_type == "backward")
+
+    def step():
+        if case.pass_type == "forward":
+            with torch.no_grad():
+                fn()
+        else:
+            fn().square().sum().backward()
+            module.zero_grad(set_to_none=True)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    mem_before = current_memory_mb(device)
+    step()  # Warm-up, also reaches the peak memory of the pass.
+    peak_mem = peak_memory_mb(device) - mem_before
+
+    start = time.perf_counter()
+    for _ in range(num_repeats):
+        step()
+    wall_time = (time.perf_counter() - start) / num_repeats
+
+    num_edges = data.edge_index.shape[1]
+    return dict(
+        **asdict(case),
+        num_nodes=data.num_nodes,
+        num_edges=num_edges,
+        wall_time_s=wall_time,
+        nodes_per_s=data.num_nodes / wall_time,
+        edges_per_s=num_edges / wall_time,
+        peak_memory_mb=peak_mem,
+    )
+
+
+def make_cases(args) -> List[BenchmarkCase]:
+    axes = dict(
+        num_res=args.lengths,
+        k=args.ks,
+        max_ell=args.max_ells,
+        correlation=args.correlations,
+        num_layers=args.num_layers,
+        emb_dim=args.emb_dims,
+    )
+    if args.full_grid:
+        values = [dict(zip(axes, combination)) for combination in itertools.product(*axes.values())]
+    else:
+        base = {name: axis[0] for name, axis in axes.items()}
+        values = [base] + [{**base, name: value} for name, axis in axes.items() for value in axis[1:]]
+
+    cases = []
+    for component in args.components:
+        for pass_type in ("forward", "backward"):
+            for value in values:
+                case = BenchmarkCase(
+                    component=component,
+                    batch_size=args.batch_size,
+                    radius=args.radius,
+                    mlp_dim=args.mlp_dim,
+                    pass_type=pass_type,
+                    **value,
+                )
+                cases.append(case)
+    return cases
+
+
+def environment() -> Dict:
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(
+        git_commit=commit,
+        torch=torch.__version__,
+        e3nn=e3nn.__version__,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        processor=platform.processor(),
+        num_threads=torch.get_num_threads(),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--components", nargs="+", default=list(COMPONENTS), choices=COMPONENTS)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[100, 200, 400])
+    parser.add_argument("--ks", type=int, nargs="+", default=[10, 20])
+    parser.add_argument("--max_ells", type=int, nargs="+", default=[2, 1])
+    parser.add_argument("--correlations", type=int, nargs="+", default=[3, 2])
+    parser.add_argument("--num_layers", type=int, nargs="+", default=[2, 4])
+    parser.add_argument("--emb_dims", type=int, nargs="+", default=[64, 32])
+    parser.add_argument("--full_grid", action="store_true")
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--radius", type=float, default=5.0)
+    parser.add_argument("--mlp_dim", type=int, default=64)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--num_repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="mace_suite.json")
+    args = parser.parse_args()
+
+    cases = make_cases(args)
+    results = []
+    context = multiprocessing.get_context("spawn")
+    print(f"{'component':>9} {'pass':>8} {'nodes':>6} {'edges':>7} {'time [ms]':>10} {'edges/s':>10} {'mem [MB]':>9}")
+    for case in cases:
+        with context.Pool(1) as pool:
+            result = pool.apply(run_case, (case, args.device, args.num_repeats, args.seed))
+        results.append(result)
+        print(
+            f"{case.component:>9} {case.pass_type:>8} {result['num_nodes']:>6} {result['num_edges']:>7} "
+            f"{1e3 * result['wall_time_s']:>10.2f} {result['edges_per_s']:>10.0f} {result['peak_memory_mb']:>9.1f}"
+        )
+
+    with open(args.output, "w") as f:
+        json.dump(dict(environment=environment(), args=vars(args), results=results), f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Precomputes the ESM representations of the unmasked chains of a metadata CSV into an ESM store.
+
+Set `data.esm_store_path` to the output directory to serve them through `PdbDataset`. An interrupted run can be
+resumed by running the same command again. The pair representations take N^2 * num_layers * num_heads * 2 bytes per
+chain of length N, use `--no_pair` to store only the single representations of models without attention maps.
+
+Sample command:
+> python tools/build_esm_store.py --csv_path metadata.csv --output_dir esm_store --model_key esm2_650M
+"""
+
+import argparse
+import logging
+
+import pandas as pd
+import torch
+from tqdm import tqdm
+
+from foldflow.data import utils as du
+from foldflow.data.esm_store import EsmEmbeddingStoreWriter, esm_store_key
+from foldflow.models.components.sequence.frozen_esm import ESM_BACKENDS, FrozenEsmModel
+
+
+def read_chain(processed_path: str):
+    """AF2 residue types, chain indices and backbone mask of the modeled residues, as served by `PdbDataset`."""
+    processed_feats = du.parse_chain_feats(du.read_pkl(processed_path))
+    modeled_idx = processed_feats["modeled_idx"]
+    modeled = slice(modeled_idx.min(), modeled_idx.max() + 1)
+    aatype = torch.as_tensor(processed_feats["aatype"][modeled]).long()
+    chain_idx = torch.as_tensor(processed_feats["chain_index"][modeled]).long()
+    res_mask = torch.as_tensor(processed_feats["bb_mask"][modeled])
+    return aatype, chain_idx, res_mask
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--csv_path", type=str, required=True)
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--model_key", type=str, default="esm2_650M")
+    parser.add_argument("--no_pair", action="store_true")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    # The backend of the model that will read the store, see `resolve_esm_backend`.
+    parser.add_argument("--backend", type=str, default="auto", choices=ESM_BACKENDS)
+    parser.add_argument("--flush_every", type=int, default=100)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    esm = FrozenEsmModel(args.model_key, use_esm_attn_map=not args.no_pair, cache_max_bytes=0, backend=args.backend)
+    esm.esm.eval()
+    esm.esm.requires_grad_(False)
+    esm = esm.to(args.device)
+
+    pair_dim = None if args.no_pair else esm.num_layers * esm.attn_head
+    writer = EsmEmbeddingStoreWriter(
+        args.output_dir, args.model_key, single_shape=(esm.num_layers + 1, esm.single_dim), pair_dim=pair_dim
+    )
+
+    csv = pd.read_csv(args.csv_path)
+    num_added = 0
+    for processed_path in tqdm(csv["processed_path"]):
+        aatype, chain_idx, res_mask = read_chain(processed_path)
+        key = esm_store_key(aatype, res_mask)
+        if key in writer:
+            continue
+        single, pair = esm(
+            aatype[None].to(args.device),
+            chain_idx[None].to(args.device),
+            attn_mask=res_mask[None].to(args.device),
+            seq_mask=None,
+            cache_last_call=False,
+        )
+        writer.add(key, single[0], pair[0] if pair is not None else None)
+        num_added += 1
+        if num_added % args.flush_every == 0:
+            writer.flush()
+    writer.flush()
+    logging.info(f"Added {num_added} chains, the store at {args.output_dir} has {len(writer.index['entries'])}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Prebuilds the on-disk U-matrix cache of the MACE encoders defined in the model configs.
+
+The cache is written to `$FOLDFLOW_U_MATRIX_CACHE_DIR` (default: ~/.cache/foldflow/u_matrix), which every training
+and inference process then reads instead of recomputing the Clebsch-Gordan coefficients.
+
+Sample command:
+> python tools/warmup_u_matrix_cache.py --configs runner/config/model/*.yaml --dtypes float32 float64
+"""
+
+import argparse
+import glob
+import os
+import time
+
+import torch
+from omegaconf import OmegaConf
+
+from foldflow.models.components.structure.modules.cg import u_matrix_cache_dir
+from foldflow.models.ff2flow.ff2_dependencies import FF2Dependencies
+
+DEFAULT_CONFIGS = os.path.join(os.path.dirname(__file__), "..", "runner", "config", "model", "*.yaml")
+
+
+def warmup(config_path: str, dtype: torch.dtype) -> bool:
+    model_conf = OmegaConf.load(config_path)
+    if "mace_encoder" not in model_conf:
+        return False
+    # The MACE encoder only reads `model.mace_encoder`, which is what the U-matrices depend on.
+    model_conf.mace_encoder.is_on = True
+    default_dtype = torch.get_default_dtype()
+    torch.set_default_dtype(dtype)
+    try:
+        FF2Dependencies(OmegaConf.create({"model": model_conf})).bb_mace_encoder
+    finally:
+        torch.set_default_dtype(default_dtype)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--configs", nargs="+", default=sorted(glob.glob(DEFAULT_CONFIGS)))
+    parser.add_argument("--dtypes", nargs="+", default=["float32"], choices=["float32", "float64"])
+    args = parser.parse_args()
+
+    if u_matrix_cache_dir() is None:
+        raise ValueError("The on-disk U-matrix cache is disabled, set FOLDFLOW_U_MATRIX_CACHE_DIR to a directory.")
+    print(f"U-matrix cache directory: {u_matrix_cache_dir()}")
+    for config_path in args.configs:
+        for dtype_name in args.dtypes:
+            start = time.perf_counter()
+            if not warmup(config_path, getattr(torch, dtype_name)):
+                print(f"{config_path}: no mace_encoder block, skipped.")
+                break
+            print(f"{config_path} ({dtype_name}): {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()